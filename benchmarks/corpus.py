@@ -0,0 +1,92 @@
+import random
+from typing import Dict, List
+
+# a small vocabulary, so repos overlap in words the way real starred repos do
+WORDS = """
+agent analysis api app async auth automation browser build cache chart cli client cloud
+compiler config container dashboard data database dataframe debugger deploy desktop docs
+editor embedded engine fast framework game generator graph http image inference kubernetes
+language library lightweight linter llm logging machine manager markdown mobile model
+monitoring network notebook orm parser pipeline plot plugin proxy queue realtime scraper
+search security server simple static storage stream terminal testing theme toolkit tracing
+type ui validation vector visualisation web workflow
+""".split()
+
+LANGUAGES = [
+    "Python",
+    "JavaScript",
+    "TypeScript",
+    "Rust",
+    "Go",
+    "R",
+    "Ruby",
+    "C++",
+    "Java",
+    "Shell",
+    "Jupyter Notebook",
+    "HTML",
+    "CSS",
+]
+
+TOPICS = [
+    "cli",
+    "data-science",
+    "dataframe",
+    "deep-learning",
+    "devops",
+    "hacktoberfest",
+    "llm",
+    "machine-learning",
+    "python",
+    "rust",
+    "tidyverse",
+    "visualization",
+    "web",
+    "web-development",
+]
+
+
+def make_node(number: int, rng: random.Random) -> Dict:
+    """
+    A starred repository, shaped like a node of the GraphQL `starredRepositories` edges
+    """
+    owner = f"owner-{rng.randrange(max(number // 5, 1) + 1)}"
+    name = "-".join(rng.sample(WORDS, rng.randint(1, 3))) + f"-{number}"
+    primary_language = rng.choice(LANGUAGES) if rng.random() < 0.9 else None
+    languages = sorted(
+        {primary_language} | set(rng.sample(LANGUAGES, rng.randint(0, 4)))
+        if primary_language
+        else []
+    )
+    description = (
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 20))).capitalize()
+        if rng.random() < 0.85
+        else None
+    )
+
+    return {
+        "name": name,
+        "nameWithOwner": f"{owner}/{name}",
+        "owner": {"login": owner},
+        "url": f"https://github.com/{owner}/{name}",
+        "homepageUrl": f"https://{name}.dev" if rng.random() < 0.3 else None,
+        "description": description,
+        "repositoryTopics": {
+            "nodes": [
+                {"topic": {"name": topic}}
+                for topic in rng.sample(TOPICS, rng.randint(0, 5))
+            ]
+        },
+        # star counts are long tailed, most repos have a few and some have a lot
+        "stargazerCount": int(rng.paretovariate(1.2) * 10),
+        "primaryLanguage": {"name": primary_language} if primary_language else None,
+        "languages": {"nodes": [{"name": language} for language in languages]},
+    }
+
+
+def generate_corpus(size: int, seed: int = 0) -> List[Dict]:
+    """
+    `size` synthetic starred repos, the same ones for the same size and seed
+    """
+    rng = random.Random(f"{seed}:{size}")
+    return [make_node(number, rng) for number in range(size)]
@@ -0,0 +1,521 @@
+"""
+Time each stage of `read`, and `shoot`, `astrologer` and `neighbours` queries, over synthetic star corpora
+
+    python -m benchmarks.run run --sizes 1000 --sizes 10000
+
+GitHub and OpenAI are replaced by local stubs, so runs are free, offline and repeatable. Each corpus
+size is measured in its own process, so its peak RSS isn't inflated by the sizes before it.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+from typing import Callable, Dict, List, Optional
+
+import structlog
+import typer
+from rich import print
+from rich.table import Table
+
+from starpilot.utils.profiling import peak_rss_mb
+
+logger = structlog.get_logger(__name__)
+
+app = typer.Typer()
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# stages faster than this are too noisy to call a regression
+MIN_REGRESSION_SECONDS = 0.05
+
+QUERY_WORDS = [
+    "fast web server",
+    "dataframe analysis",
+    "machine learning model",
+    "terminal ui toolkit",
+    "static site generator",
+    "vector search database",
+    "async http client",
+    "plot visualisation library",
+    "kubernetes deploy automation",
+    "markdown parser",
+]
+QUERY_LANGUAGES = ["Python", "Rust", "R", "Go", "TypeScript"]
+# `shoot --batch` is for scripts with many queries, so it is timed over this many times `--queries`
+BATCH_QUERIES_PER_QUERY = 50
+
+
+class StageTimer:
+    """
+    Records how long each stage takes, how many items it handles, and the peak RSS after it
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict] = {}
+
+    def run(self, stage: str, items: int, function: Callable):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+
+        self.stages[stage] = {
+            "seconds": seconds,
+            "items": items,
+            "per_second": items / seconds if seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        logger.info("Benchmarked stage", stage=stage, seconds=round(seconds, 3))
+
+        return result
+
+    def run_queries(self, stage: str, queries: List[str], function: Callable) -> None:
+        # the first query imports and loads what the method needs, which isn't per query
+        function(queries[0])
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            function(query)
+            latencies.append(time.perf_counter() - start)
+
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        self.stages[stage] = {
+            "seconds": sum(latencies),
+            "items": len(queries),
+            "per_second": len(queries) / sum(latencies),
+            "p50_ms": median(latencies_ms),
+            "p95_ms": latencies_ms[
+                min(int(len(latencies_ms) * 0.95), len(latencies) - 1)
+            ],
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        logger.info(
+            "Benchmarked queries", stage=stage, p50_ms=self.stages[stage]["p50_ms"]
+        )
+
+    def skip(self, stage: str, reason: str) -> None:
+        self.stages[stage] = {"skipped": reason}
+        logger.warning("Skipped stage", stage=stage, reason=reason)
+
+
+def measure_size(
+    size: int,
+    base_url: str,
+    workdir: str,
+    store_backend: str,
+    dimensions: int,
+    queries: int,
+) -> Dict:
+    """
+    Run every stage of `read` over a corpus, then query the store it built
+    """
+    from langchain.vectorstores.utils import filter_complex_metadata
+    from langchain.schema.document import Document
+
+    import starpilot.utils.sync as sync
+    import starpilot.utils.utils as utils
+    from benchmarks.stubs import corpus_login
+    from starpilot.utils.constellations import Constellations
+    from starpilot.utils.facets import FacetIndex
+    from starpilot.utils.lexical import LexicalIndex
+    from starpilot.utils.neighbours import build_neighbour_graph
+    from starpilot.utils.vocabulary import build_vocabulary, save_vocabulary
+    from starpilot.utils.server import QueryEngine
+    from starpilot.utils.tokens import TokenCounter
+
+    timer = StageTimer()
+    vectorstore_path = os.path.join(workdir, "vectorstore")
+
+    pages = timer.run(
+        "fetch",
+        size,
+        lambda: list(
+            utils.iter_user_starred_repos(
+                corpus_login(size), "benchmark", url=f"{base_url}/graphql"
+            )
+        ),
+    )
+
+    def _format() -> List[Dict]:
+        # every repo is kept, so the later stages see the whole corpus
+        top_k = utils.TopKRepos(None)
+        for page in pages:
+            for repo in page:
+                top_k.push(utils.format_repo(repo))
+        return top_k.sorted()
+
+    formatted_repos = timer.run("format", size, _format)
+
+    timer.run(
+        "save",
+        size,
+        lambda: utils.save_repo_contents_to_disk(
+            formatted_repos, os.path.join(workdir, "repo_content.jsonl")
+        ),
+    )
+
+    try:
+        TokenCounter(model=utils.EMBEDDING_MODEL, cache_path=None).encoding
+        tokenizer_error = None
+    except Exception as exception:
+        # tiktoken downloads its encodings on first use
+        tokenizer_error = f"no tiktoken encoding: {exception}"
+
+    def _prepare() -> List[Document]:
+        if tokenizer_error is None:
+            return utils.prepare_documents(formatted_repos)
+        # the same documents, without the token counts that need tiktoken
+        return filter_complex_metadata(
+            [
+                document
+                for document in map(utils.create_document, formatted_repos)
+                if document.page_content != ""
+            ]
+        )
+
+    documents = timer.run("prepare", size, _prepare)
+    texts = [document.page_content for document in documents]
+
+    if tokenizer_error is None:
+        token_counter = TokenCounter(model=utils.EMBEDDING_MODEL, cache_path=None)
+        timer.run("tokenise", len(texts), lambda: token_counter.count(texts))
+    else:
+        timer.skip("tokenise", tokenizer_error)
+
+    embedding_function = utils.create_embedding_function(
+        backend=utils.EmbeddingBackends.openai, dimensions=dimensions
+    )
+    vectors = timer.run(
+        "embed", len(texts), lambda: embedding_function.embed_documents(texts)
+    )
+
+    def _persist() -> None:
+        vectorstore = utils.create_vectorstore(
+            vectorstore_path, utils.StoreBackends(store_backend), embedding_function
+        )
+        ids = [sync.document_id(document) for document in documents]
+        for start in range(0, len(documents), 5000):
+            end = start + 5000
+            vectorstore._collection.upsert(  # type: ignore
+                ids=ids[start:end],
+                embeddings=vectors[start:end],
+                documents=texts[start:end],
+                metadatas=[document.metadata for document in documents[start:end]],
+            )
+        sync.save_store_info(
+            vectorstore_path,
+            {
+                "store_backend": store_backend,
+                "embedding_backend": utils.EmbeddingBackends.openai.value,
+                "embedding_model": utils.EMBEDDING_MODEL,
+                "dimensions": dimensions,
+            },
+        )
+        sync.save_manifest(
+            vectorstore_path,
+            {
+                sync.document_id(document): sync.hash_document(document)
+                for document in documents
+            },
+        )
+
+    timer.run("persist", len(documents), _persist)
+
+    def _index() -> None:
+        LexicalIndex.build(formatted_repos).save(vectorstore_path)
+        FacetIndex.build(formatted_repos).save(vectorstore_path)
+        save_vocabulary(vectorstore_path, build_vocabulary(formatted_repos))
+
+    timer.run("index", len(formatted_repos), _index)
+
+    def _neighbour_graph() -> None:
+        build_neighbour_graph(
+            utils.open_vectorstore(vectorstore_path),
+            sync.load_manifest(vectorstore_path) or {},
+        ).save(vectorstore_path)
+
+    timer.run("neighbour_graph", len(documents), _neighbour_graph)
+
+    def _constellations() -> None:
+        ids, stored_vectors = utils.load_stored_vectors(
+            utils.open_vectorstore(vectorstore_path)
+        )
+        Constellations.build(
+            ids,
+            stored_vectors,
+            sync.content_hashes(sync.load_manifest(vectorstore_path) or {}, ids),
+            {repo["nameWithOwner"]: repo for repo in formatted_repos},
+        ).save(vectorstore_path)
+
+    timer.run("constellations", len(documents), _constellations)
+
+    engine = timer.run("open", 1, lambda: QueryEngine(vectorstore_path))
+
+    # every query is different, so none are answered by the embedding cache
+    shoot_queries = [
+        f"{QUERY_WORDS[number % len(QUERY_WORDS)]} {number}"
+        for number in range(queries)
+    ]
+    for method in ("similarity", "lexical", "hybrid"):
+        timer.run_queries(
+            f"shoot:{method}",
+            shoot_queries,
+            lambda query, method=method: engine.shoot(query, method=method, k=10),
+        )
+
+    # a script's worth of queries answered together, none of them seen before
+    batch_queries = [
+        f"{QUERY_WORDS[number % len(QUERY_WORDS)]} batch {number}"
+        for number in range(queries * BATCH_QUERIES_PER_QUERY)
+    ]
+    timer.run(
+        "shoot:batch",
+        len(batch_queries),
+        lambda: engine.shoot_batch(batch_queries, k=10),
+    )
+
+    # stars spread through the corpus, looked up in the graph with no embedding call
+    neighbour_repos = [
+        sync.document_id(documents[number * len(documents) // queries])
+        for number in range(queries)
+    ]
+    timer.run_queries(
+        "neighbours",
+        neighbour_repos,
+        lambda repo: engine.neighbours(repo, k=10),
+    )
+
+    # queries the rule parser understands, so no LLM is called
+    astrologer_queries = [
+        f"{QUERY_LANGUAGES[number % len(QUERY_LANGUAGES)]} "
+        f"{QUERY_WORDS[number % len(QUERY_WORDS)]} with over {number} stars"
+        for number in range(queries)
+    ]
+    timer.run_queries(
+        "astrologer",
+        astrologer_queries,
+        lambda query: engine.astrologer(query, k=10),
+    )
+
+    return {"size": size, "peak_rss_mb": peak_rss_mb(), "stages": timer.stages}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    The stages, and peak RSS, that are more than `tolerance` worse than the baseline
+
+    Sizes and stages the baseline has no timing for are reported too, so they can't go unchecked
+    """
+    regressions = []
+    for size, result in results.items():
+        if (baseline_result := baseline.get(size)) is None:
+            regressions.append(f"{size} repos: not in the baseline")
+            continue
+
+        for stage, timing in result["stages"].items():
+            if "seconds" not in timing:
+                continue
+            baseline_timing = baseline_result["stages"].get(stage, {})
+            if "seconds" not in baseline_timing:
+                regressions.append(f"{size} repos {stage}: not in the baseline")
+                continue
+            if (
+                timing["seconds"] > baseline_timing["seconds"] * (1 + tolerance)
+                and timing["seconds"] - baseline_timing["seconds"]
+                > MIN_REGRESSION_SECONDS
+            ):
+                regressions.append(
+                    f"{size} repos {stage}: {timing['seconds']:.3f}s, "
+                    f"baseline {baseline_timing['seconds']:.3f}s"
+                )
+
+        if result["peak_rss_mb"] > baseline_result["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{size} repos peak RSS: {result['peak_rss_mb']:.0f}MB, "
+                f"baseline {baseline_result['peak_rss_mb']:.0f}MB"
+            )
+
+    return regressions
+
+
+def create_report_table(results: Dict, baseline: Dict) -> Table:
+    table = Table(title="Benchmarks")
+    table.add_column("Repos", justify="right")
+    table.add_column("Stage", no_wrap=True)
+    for column in ["Seconds", "Per second", "p50 / p95 ms"]:
+        table.add_column(column, justify="right")
+    table.add_column("Peak RSS MB", justify="right")
+    table.add_column("vs baseline", justify="right")
+
+    for size, result in results.items():
+        for stage, timing in result["stages"].items():
+            if "skipped" in timing:
+                table.add_row(size, stage, "skipped", "", "", "", "")
+                continue
+
+            baseline_seconds = (
+                baseline.get(size, {}).get("stages", {}).get(stage, {}).get("seconds")
+            )
+            table.add_row(
+                size,
+                stage,
+                f"{timing['seconds']:.3f}",
+                f"{timing['per_second']:.0f}" if timing["per_second"] else "",
+                (
+                    f"{timing['p50_ms']:.1f} / {timing['p95_ms']:.1f}"
+                    if "p50_ms" in timing
+                    else ""
+                ),
+                f"{timing['peak_rss_mb']:.0f}",
+                (
+                    f"{(timing['seconds'] / baseline_seconds - 1) * 100:+.0f}%"
+                    if baseline_seconds
+                    else ""
+                ),
+            )
+
+    return table
+
+
+@app.command()
+def measure(
+    size: int,
+    base_url: str,
+    workdir: str,
+    store_backend: str = "chroma",
+    dimensions: int = 256,
+    queries: int = 20,
+) -> None:
+    """
+    Measure one corpus size and print the results as JSON, run by `run` in a fresh process
+    """
+    result = measure_size(size, base_url, workdir, store_backend, dimensions, queries)
+    sys.stdout.write(json.dumps(result) + "\n")
+
+
+@app.command()
+def run(
+    sizes: List[int] = typer.Option(
+        [1000, 10000, 100000], help="Numbers of starred repos to benchmark"
+    ),
+    store_backend: str = typer.Option("chroma", help="chroma or numpy"),
+    dimensions: int = typer.Option(
+        256, help="Length of the fake embeddings, shorter ones keep the stub fast"
+    ),
+    queries: int = typer.Option(20, help="Number of queries to time per method"),
+    baseline_path: str = typer.Option(BASELINE_PATH, help="Baseline to compare to"),
+    tolerance: float = typer.Option(
+        0.25, help="Flag stages this much slower than the baseline"
+    ),
+    save_baseline: bool = typer.Option(
+        False, help="Save these results as the new baseline"
+    ),
+    output: Optional[str] = typer.Option(None, help="Also save the results here"),
+) -> None:
+    """
+    Benchmark every corpus size against local stand-ins for GitHub and OpenAI
+    """
+    from benchmarks.stubs import start_stubs
+
+    settings = {
+        "store_backend": store_backend,
+        "dimensions": dimensions,
+        "queries": queries,
+    }
+
+    base_url, stop = start_stubs()
+    results = {}
+    try:
+        for size in sizes:
+            workdir = tempfile.mkdtemp(prefix=f"starpilot-benchmark-{size}-")
+            try:
+                completed = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.run",
+                        "measure",
+                        str(size),
+                        base_url,
+                        workdir,
+                        "--store-backend",
+                        store_backend,
+                        "--dimensions",
+                        str(dimensions),
+                        "--queries",
+                        str(queries),
+                    ],
+                    # caches are written to the working directory, so every run starts cold
+                    cwd=workdir,
+                    env={
+                        **os.environ,
+                        "PYTHONPATH": os.pathsep.join(
+                            filter(
+                                None,
+                                [
+                                    os.path.dirname(os.path.dirname(__file__)),
+                                    os.environ.get("PYTHONPATH"),
+                                ],
+                            )
+                        ),
+                        "OPENAI_BASE_URL": f"{base_url}/v1",
+                        "OPENAI_API_KEY": "benchmark",
+                        "STARPILOT_GITHUB_URL": f"{base_url}/graphql",
+                    },
+                    stdout=subprocess.PIPE,
+                    check=True,
+                    text=True,
+                )
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results[str(size)] = json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        stop()
+
+    # one baseline per combination of settings, so every store backend is checked
+    baselines: List[Dict] = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as file:
+            baselines = json.load(file)["baselines"]
+    matching = next(
+        (saved for saved in baselines if saved["settings"] == settings), None
+    )
+    baseline: Dict = matching["results"] if matching is not None else {}
+
+    print(create_report_table(results, baseline))
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump({"settings": settings, "results": results}, file, indent=2)
+
+    if save_baseline:
+        if matching is None:
+            matching = {"settings": settings, "results": {}}
+            baselines.append(matching)
+        matching["results"] = {**matching["results"], **results}
+        with open(baseline_path, "w") as file:
+            json.dump({"baselines": baselines}, file, indent=2)
+        logger.info("Saved baseline", path=baseline_path)
+        return
+
+    if matching is None:
+        logger.warning(
+            "No baseline was measured with these settings, not comparing",
+            settings=settings,
+            baselines=[saved["settings"] for saved in baselines],
+        )
+        return
+
+    if regressions := compare(results, baseline, tolerance):
+        for regression in regressions:
+            print(f"[red]Regression[/red] {regression}")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from aiohttp import web
+
+from benchmarks.corpus import generate_corpus
+
+PAGE_SIZE = 100
+DEFAULT_DIMENSIONS = 1536
+
+
+def corpus_login(size: int) -> str:
+    """
+    The login of the synthetic user whose stars are a corpus of `size` repos
+    """
+    return f"synthetic-{size}"
+
+
+def starred_at(number: int) -> str:
+    """
+    When the `number`th star of a corpus was made, newest first like GitHub's `STARRED_AT DESC`
+    """
+    return (
+        datetime(2024, 1, 1, tzinfo=timezone.utc) - timedelta(minutes=number)
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _word_vector(word: str, dimensions: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions)
+
+
+class FakeEmbedder:
+    """
+    Deterministic embeddings, the normalised sum of a random vector per word
+
+    Texts that share words get similar vectors, so searches over them behave like real ones
+    """
+
+    def __init__(self):
+        self._words: Dict[Tuple[str, int], np.ndarray] = {}
+
+    def embed(self, texts: List[str], dimensions: int) -> np.ndarray:
+        vectors = np.zeros((len(texts), dimensions))
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()) or [""]:
+                if (key := (word, dimensions)) not in self._words:
+                    self._words[key] = _word_vector(word, dimensions)
+                vectors[row] += self._words[key]
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def create_stub_app() -> web.Application:
+    """
+    One app standing in for GitHub's GraphQL API at `/graphql` and OpenAI's at `/v1/embeddings`
+    """
+    corpora: Dict[str, List[Dict]] = {}
+    embedder = FakeEmbedder()
+
+    async def graphql(request: web.Request) -> web.Response:
+        variables = (await request.json())["variables"]
+        login = variables["login"]
+        if login not in corpora:
+            corpora[login] = generate_corpus(int(login.rsplit("-", 1)[1]))
+        nodes = corpora[login]
+
+        start = int(variables["after"]) + 1 if variables.get("after") else 0
+        end = min(start + PAGE_SIZE, len(nodes))
+
+        return web.json_response(
+            {
+                "data": {
+                    "user": {
+                        "login": login,
+                        "name": "Synthetic User",
+                        "starredRepositories": {
+                            "totalCount": len(nodes),
+                            "pageInfo": {
+                                "hasNextPage": end < len(nodes),
+                                "endCursor": str(end - 1),
+                            },
+                            "edges": [
+                                {
+                                    "cursor": str(number),
+                                    "starredAt": starred_at(number),
+                                    "node": nodes[number],
+                                }
+                                for number in range(start, end)
+                            ],
+                        },
+                    }
+                }
+            },
+            headers={"X-RateLimit-Remaining": "4999"},
+        )
+
+    async def embeddings(request: web.Request) -> web.Response:
+        payload = await request.json()
+        texts = payload["input"]
+        vectors = embedder.embed(texts, payload.get("dimensions") or DEFAULT_DIMENSIONS)
+
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": vector}
+                    for index, vector in enumerate(vectors.tolist())
+                ],
+                "model": payload["model"],
+                "usage": {
+                    "prompt_tokens": sum(len(text.split()) for text in texts),
+                    "total_tokens": sum(len(text.split()) for text in texts),
+                },
+            }
+        )
+
+    app = web.Application(client_max_size=64 * 1024**2)
+    app.router.add_post("/graphql", graphql)
+    app.router.add_post("/v1/embeddings", embeddings)
+    return app
+
+
+def start_stubs(host: str = "127.0.0.1", port: int = 0) -> Tuple[str, Callable]:
+    """
+    Serve the stub app from a background thread
+
+    Returns its base url, and a function that stops it
+    """
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_stub_app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    bound_port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return f"http://{host}:{bound_port}", stop
@@ -1,25 +1,21 @@
+import itertools
+import json
 import logging
 import os
-import shutil
-from typing import Annotated
+import sys
+import uuid
+from typing import Annotated, Dict, List
 
 import dotenv
 import structlog
 import typer
-from langchain.chains.query_constructor.base import (
-    StructuredQueryOutputParser,
-    get_query_constructor_prompt,
-)
-from langchain.chains.query_constructor.ir import Comparator
-from langchain.chains.query_constructor.schema import AttributeInfo
-from langchain.retrievers.self_query.base import SelfQueryRetriever
-from langchain.retrievers.self_query.chroma import ChromaTranslator
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI
-from langchain_openai.embeddings import OpenAIEmbeddings
 from rich import print
 from typing_extensions import Optional
 
+import starpilot.utils.generations as generations
+import starpilot.utils.profiling as profiling
+import starpilot.utils.server as server
+import starpilot.utils.sync as sync
 import starpilot.utils.utils as utils
 
 # Setup for icecream
@@ -99,83 +95,486 @@ def setup(
 
 # Typer commands
 @app.command()
+@profiling.profiled("read")
 def read(
     user: str,
     k: Optional[int] = typer.Option(900, help="Number of repositories to load"),
+    rebuild: bool = typer.Option(
+        False,
+        help="Rebuild the vectorstore from scratch instead of only syncing the stars that changed",
+    ),
+    full: bool = typer.Option(
+        False,
+        help="Read every star, refreshing the star counts and descriptions of repos read before, instead of stopping at the stars the last read reached",
+    ),
+    resume: bool = typer.Option(
+        False,
+        help="Carry on from where an interrupted read with the same options stopped, instead of starting again",
+    ),
+    dry_run: bool = typer.Option(
+        False,
+        help="Estimate the tokens and cost of embedding the stars without calling the embeddings API",
+    ),
+    concurrency: int = typer.Option(
+        4, help="Number of embedding requests to send at once"
+    ),
+    embedding_backend: utils.EmbeddingBackends = typer.Option(
+        "openai",
+        help="Embed with the OpenAI API, or locally on the CPU with no network or API cost",
+    ),
+    dimensions: Optional[int] = typer.Option(
+        None,
+        help="Ask the OpenAI model for vectors shortened to this many dimensions",
+    ),
+    quantisation: Optional[utils.Quantisations] = typer.Option(
+        None,
+        help="Also keep a compact int8 or float16 copy of the vectors that queries are scored against. Defaults to the current store's setting, none for a new store",
+    ),
+    store_backend: Optional[utils.StoreBackends] = typer.Option(
+        None,
+        help="Store the vectors in chroma, or in one memory mapped matrix that opens instantly and is searched exactly. Defaults to the current store's backend, chroma for a new store",
+    ),
+    profile: bool = typer.Option(
+        False,
+        help="Write cProfile stats, for snakeviz, and a JSON summary of each stage to ./starpilot-profiles",
+    ),
 ) -> None:
     """
     Read stars from GitHub
     """
+    import starpilot.utils.checkpoint as checkpoint
+    import starpilot.utils.compact as compact
+    import starpilot.utils.constellations as constellations
+    import starpilot.utils.facets as facets
+    import starpilot.utils.lexical as lexical
+    import starpilot.utils.neighbours as neighbours
+    import starpilot.utils.vocabulary as vocabulary
+    from starpilot.utils.embeddings import embedding_progress
+    from starpilot.utils.tokens import TokenCounter
+
+    if (
+        dimensions is not None
+        and embedding_backend is not utils.EmbeddingBackends.openai
+    ):
+        raise typer.BadParameter(
+            "Only the openai backend can shorten vectors", param_hint="--dimensions"
+        )
 
-    GITHUB_API_KEY = os.environ["GITHUB_API_KEY"]
-    embedding_function = OpenAIEmbeddings(model="text-embedding-3-large")
+    # one read at a time, or the second to finish would publish a store without the first's changes
+    with generations.write_lock(VECTORSTORE_PATH):
+        GITHUB_API_KEY = os.environ["GITHUB_API_KEY"]
+        model = utils.embedding_model(embedding_backend)
+        # only the OpenAI backend bills per token
+        token_counter = (
+            TokenCounter(model=model)
+            if embedding_backend is utils.EmbeddingBackends.openai
+            else None
+        )
 
-    repos = utils.get_user_starred_repos(
-        username=user,
-        github_api_key=GITHUB_API_KEY,
-    )
+        # queries keep reading the current generation while the new one is built beside it
+        current_path = generations.current_path(VECTORSTORE_PATH)
+        manifest = (
+            None
+            if rebuild or current_path is None
+            else sync.load_manifest(current_path)
+        )
 
-    formatted_repos = []
-    for repo in repos:
-        formatted_repos.append(utils.format_repo(repo))
+        # stores built before their settings were recorded held full length OpenAI vectors in chroma
+        previous_info = {
+            "store_backend": utils.StoreBackends.chroma.value,
+            "embedding_backend": utils.EmbeddingBackends.openai.value,
+            "dimensions": None,
+            "quantisation": utils.Quantisations.none.value,
+            **((current_path and sync.load_store_info(current_path)) or {}),
+        }
+        # changing how the store is kept rebuilds it, so that only happens when asked for
+        if store_backend is None:
+            store_backend = utils.StoreBackends(previous_info["store_backend"])
+        if quantisation is None:
+            quantisation = utils.Quantisations(previous_info["quantisation"])
+
+        store_info = {
+            "store_backend": store_backend.value,
+            "embedding_backend": embedding_backend.value,
+            "embedding_model": model,
+            "dimensions": dimensions,
+            "quantisation": quantisation.value,
+            # cached query results are only valid for the version of the store they came from
+            "store_version": uuid.uuid4().hex,
+        }
+        changed = [
+            setting
+            for setting in ("store_backend", "embedding_backend", "dimensions")
+            if previous_info[setting] != store_info[setting]
+        ]
+        if manifest is not None and changed:
+            # vectors from different backends or of different lengths can't share a store, so every repo is embedded again
+            logger.info("Vectorstore settings changed, rebuilding it", changed=changed)
+            manifest = None
+
+        # where each user's last read got to, so the next one only fetches the stars added since
+        fetches = {} if manifest is None else previous_info.get("fetches", {})
+        store_info["fetches"] = fetches
+        previous_fetch = fetches.get(user.lower(), {})
+        fetch = utils.StarredReposFetch(
+            since=(
+                None
+                if full or dry_run or previous_fetch.get("k") != k
+                else previous_fetch.get("newest_starred_at")
+            ),
+            known_total=previous_fetch.get("total_count"),
+        )
 
-    # order by stars and pick top k
-    top_k_formatted_repos = sorted(
-        formatted_repos, key=lambda x: x["stargazerCount"], reverse=True
-    )[:k]
+        if dry_run:
+            top_k = utils.TopKRepos(k)
+            for page in utils.iter_user_starred_repos(
+                username=user, github_api_key=GITHUB_API_KEY, fetch=fetch
+            ):
+                for repo in page:
+                    top_k.push(utils.format_repo(repo))
+
+            with profiling.span("prepare", repos=len(top_k)):
+                repo_documents = utils.prepare_documents(
+                    top_k.sorted(), token_counter=token_counter
+                )
+            diff = sync.diff_manifest(manifest or {}, repo_documents)
+            to_embed = diff.added + diff.updated_content
+
+            if token_counter is None:
+                print(
+                    f"{len(repo_documents)} repos, {len(to_embed)} to embed locally with {model}: no API cost"
+                )
+                return
+
+            tokens = sum(
+                token_counter.count([document.page_content for document in to_embed])
+            )
+
+            print(
+                f"{len(repo_documents)} repos, {len(to_embed)} to embed with {model}: "
+                f"{tokens} tokens, estimated cost ${token_counter.cost(tokens):.4f}"
+            )
+            return
+
+        # every user's stars share one store, repos starred by several users are embedded once
+        users = {} if manifest is None else sync.load_users(current_path)
+        other_users = {
+            other_user: repo_ids
+            for other_user, repo_ids in users.items()
+            if other_user != user.lower()
+        }
+
+        if current_path is not None and manifest is None:
+            # a store without a manifest was built before syncing existed, so its ids can't be matched up
+            if dropped_users := sorted(sync.load_users(current_path)):
+                logger.warning(
+                    "Rebuilding the vectorstore drops the other users' stars",
+                    users=dropped_users,
+                )
+
+        # a read can only carry on from a checkpoint of the same read, from the same store
+        copy_from = None if manifest is None else current_path
+        read_settings = {
+            "user": user.lower(),
+            "k": k,
+            "copied_from": copy_from,
+            "since": fetch.since,
+            "known_total": fetch.known_total,
+            **{
+                setting: store_info[setting]
+                for setting in (
+                    "store_backend",
+                    "embedding_backend",
+                    "embedding_model",
+                    "dimensions",
+                )
+            },
+        }
+        read_checkpoint = (
+            checkpoint.find_resumable(VECTORSTORE_PATH, read_settings)
+            if resume
+            else None
+        )
 
-    utils.save_repo_contents_to_disk(repo_contents=top_k_formatted_repos)
+        if read_checkpoint is not None:
+            store_path = read_checkpoint.generation_path
+            # the repos the interrupted read embedded are in its manifest, so they aren't embedded again
+            manifest = sync.load_manifest(store_path)
+            if read_checkpoint.fetch_state is not None:
+                fetch = utils.StarredReposFetch.from_state(read_checkpoint.fetch_state)
+            logger.info(
+                "Resuming interrupted read",
+                generation=os.path.basename(store_path),
+                pages=len(read_checkpoint.pages),
+                stored=len(manifest or {}),
+            )
+        else:
+            # a sync starts from a copy of the current store, a rebuild from nothing
+            store_path = generations.create_generation(
+                VECTORSTORE_PATH, copy_from=copy_from
+            )
+            read_checkpoint = checkpoint.ReadCheckpoint.create(
+                store_path, read_settings
+            )
+
+        # pages the interrupted read fetched are replayed, and only the pages after them are fetched
+        pages = itertools.chain(
+            read_checkpoint.pages,
+            (
+                utils.iter_user_starred_repos(
+                    username=user,
+                    github_api_key=GITHUB_API_KEY,
+                    fetch=fetch,
+                    after=fetch.after_cursor,
+                    on_page=lambda repos: read_checkpoint.add_page(
+                        repos, fetch.state()
+                    ),
+                )
+                if not read_checkpoint.pages or fetch.after_cursor is not None
+                else []
+            ),
+        )
 
-    vectorstore_path = "./vectorstore-chroma"
+        carried_ids = set()
 
-    if os.path.exists(vectorstore_path):
-        logger.debug("Removing previous vectorstore", path=vectorstore_path)
-        shutil.rmtree(vectorstore_path)
+        def _carry_over() -> List[Dict]:
+            """
+            The user's repos from earlier reads, when the fetch stopped at the stars it already knew
+            """
+            if fetch.complete:
+                return []
+            carried = [
+                repo
+                for repo in utils.load_stored_repos(vectorstore)
+                if repo.get(sync.user_flag(user))
+            ]
+            carried_ids.update(repo["nameWithOwner"] for repo in carried)
+            return carried
+
+        with embedding_progress() as progress:
+            vectorstore = utils.create_vectorstore(
+                store_path,
+                store_backend,
+                utils.create_embedding_function(
+                    backend=embedding_backend,
+                    dimensions=dimensions,
+                    max_concurrency=concurrency,
+                    token_counter=token_counter,
+                    progress=progress,
+                ),
+            )
+            sync.save_store_info(store_path, store_info)
+
+            # pages are formatted, embedded and upserted while the next pages are still being fetched
+            manifest, top_k_formatted_repos = sync.stream_into_vectorstore(
+                vectorstore=vectorstore,
+                pages=pages,
+                manifest=manifest or {},
+                k=k,
+                on_batch=lambda stored: sync.save_manifest(store_path, stored),
+                user=user,
+                other_users=other_users,
+                carry_over=_carry_over,
+            )
+
+        if token_counter is not None:
+            token_counter.log_total()
+
+        users = {
+            **other_users,
+            user.lower(): [
+                repo["nameWithOwner"]
+                for repo in top_k_formatted_repos
+                if repo.get("content")
+            ],
+        }
+
+        # the indexes cover every user's stars, not just the ones read now
+        with profiling.span("load_stored") as span:
+            stored_repos = utils.load_stored_repos(vectorstore)
+            span.add(repos=len(stored_repos))
+
+        with profiling.span("index", repos=len(stored_repos)):
+            lexical.LexicalIndex.build(stored_repos).save(store_path)
+            vocabulary.save_vocabulary(
+                store_path, vocabulary.build_vocabulary(stored_repos)
+            )
+
+            # the stored metadata joins languages with spaces, so facets come from the freshly read repos, then
+            # the previous facet index, and only then the metadata of repos neither of those describe
+            fresh_repos = {
+                repo["nameWithOwner"]: repo
+                for repo in top_k_formatted_repos
+                if repo["nameWithOwner"] not in carried_ids
+            }
+            previous_facets = facets.FacetIndex.load(store_path)
+            previous_records = previous_facets.records() if previous_facets else {}
+            described_repos = {
+                repo["nameWithOwner"]: fresh_repos.get(repo["nameWithOwner"])
+                or previous_records.get(repo["nameWithOwner"])
+                or repo
+                for repo in stored_repos
+            }
+            facets.FacetIndex.build(described_repos.values(), users).save(store_path)
+
+        sync.save_users(store_path, users)
+        sync.save_manifest(store_path, manifest)
+
+        compact_index_path = os.path.join(store_path, compact.COMPACT_INDEX_FILENAME)
+        if quantisation is not utils.Quantisations.none:
+            with profiling.span("compact"):
+                compact.build_compact_index(vectorstore, quantisation).save(store_path)
+        elif os.path.exists(compact_index_path):
+            os.remove(compact_index_path)
+
+        with profiling.span("load_vectors") as span:
+            stored_ids, stored_vectors = utils.load_stored_vectors(vectorstore)
+            stored_hashes = sync.content_hashes(manifest, stored_ids)
+            span.add(repos=len(stored_ids))
+
+        # the graph and constellations copied from the current store are only updated around the repos that changed
+        with profiling.span("neighbours", repos=len(stored_ids)):
+            neighbours.NeighbourGraph.build(
+                stored_ids,
+                stored_vectors,
+                stored_hashes,
+                previous=neighbours.NeighbourGraph.load(store_path),
+            ).save(store_path)
+
+        with profiling.span("constellations", repos=len(stored_ids)):
+            constellations.Constellations.build(
+                stored_ids,
+                stored_vectors,
+                stored_hashes,
+                described_repos,
+                previous=constellations.Constellations.load(store_path),
+            ).save(store_path)
+
+        fetches[user.lower()] = {
+            "newest_starred_at": fetch.newest_starred_at,
+            "total_count": fetch.total_count,
+            "k": k,
+        }
+        sync.save_store_info(
+            store_path,
+            {**store_info, "fetches": fetches, "store_version": uuid.uuid4().hex},
+        )
 
-    # # IDEA: Set the collection to be the user's name, then only rebuild the vector store for that user, and allow the user to search a different users stars without a rebuild
-    # # IDEA: Compare the results of the existing vectorstore to the results of the GitHub API and only CRUD the files that have changed
+        read_checkpoint.remove()
+        generations.publish(VECTORSTORE_PATH, store_path)
+        generations.collect_garbage(VECTORSTORE_PATH)
 
-    repo_documents = utils.prepare_documents()
+        with profiling.span("save", repos=len(top_k_formatted_repos)) as span:
+            utils.save_repo_contents_to_disk(repo_contents=top_k_formatted_repos)
+            span.add(bytes=os.path.getsize(utils.REPO_CONTENTS_PATH))
 
-    Chroma.from_documents(
-        documents=repo_documents,
-        embedding=embedding_function,
-        persist_directory=vectorstore_path,
-    )
+        logger.info(
+            "User starred repos",
+            user=user,
+            number_of_repos=len(top_k_formatted_repos),
+            total_stars=fetch.total_count,
+            new_stars=None if fetch.complete else fetch.new_stars,
+        )
 
 
 @app.command()
+@profiling.profiled("shoot")
 def shoot(
-    query: str,
+    query: Optional[str] = typer.Argument(
+        None, help="The query, or leave it out and pass --batch"
+    ),
     method: utils.SearchMethods = typer.Option(
         "similarity", help="The search method to use"
     ),
     k: Optional[int] = typer.Option(
         3, help="Number of results to fetch from the vectorstore"
     ),
+    embedding_backend: Optional[utils.EmbeddingBackends] = typer.Option(
+        None,
+        help="Fail unless the stars were embedded with this backend, by default whichever backend embedded them is used",
+    ),
+    rerank: int = typer.Option(
+        0,
+        help="Re-score this many of the best matches from the compact index against the full precision vectors",
+    ),
+    user: Optional[str] = typer.Option(
+        None,
+        help="Only search the stars of this user, by default the stars of every user that has been read are searched",
+    ),
+    profile: bool = typer.Option(
+        False,
+        help="Answer the query here rather than from the cache or server, and write cProfile stats and a JSON summary to ./starpilot-profiles",
+    ),
+    batch: Optional[typer.FileText] = typer.Option(
+        None,
+        help="Answer every query in this file, one per line or - for stdin, embedding them in one batch",
+    ),
+    output: typer.FileTextWrite = typer.Option(
+        "-",
+        help="Where --batch writes its results, one JSON line per query, by default stdout",
+    ),
 ):
     """
     An embedding search of the vectorstore
     """
 
-    if not os.path.exists(VECTORSTORE_PATH):
+    if (query is None) == (batch is None):
+        raise typer.BadParameter("Pass either a query or --batch")
+
+    if generations.current_path(VECTORSTORE_PATH) is None:
         raise Exception("Please load the stars before shooting")
 
-    retriever = utils.create_retriever(
-        vectorstore_path=VECTORSTORE_PATH,
-        k=k,  # type: ignore
-        method=method.value,  # type: ignore
+    payload = {"method": method.value, "k": k}
+    if embedding_backend is not None:
+        payload["embedding_backend"] = embedding_backend.value
+    if rerank:
+        payload["rerank"] = rerank
+    if user is not None:
+        payload["user"] = user
+
+    if batch is not None:
+        # the results may be going to stdout, so the logs go to stderr
+        structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+
+        queries = [line.strip() for line in batch if line.strip()]
+        for record in server.answer_batch(queries, payload, VECTORSTORE_PATH):
+            output.write(json.dumps(record) + "\n")
+        return
+
+    results = server.answer_query(
+        "shoot",
+        {"query": query, **payload},
+        VECTORSTORE_PATH,
+        cache_results=True,
+        local=profile,
     )
 
-    print(utils.create_results_table(retriever.get_relevant_documents(query)))
+    print(utils.create_results_table(results))
 
 
 @app.command()
+@profiling.profiled("astrologer")
 def astrologer(
     query: str,
     k: Optional[int] = typer.Option(
         3, help="Number of results to fetch from the vectorstore"
     ),
+    embedding_backend: Optional[utils.EmbeddingBackends] = typer.Option(
+        None,
+        help="Fail unless the stars were embedded with this backend, by default whichever backend embedded them is used",
+    ),
+    rerank: int = typer.Option(
+        0,
+        help="Re-score this many of the best matches from the compact index against the full precision vectors",
+    ),
+    user: Optional[str] = typer.Option(
+        None,
+        help="Only search the stars of this user, by default the stars of every user that has been read are searched",
+    ),
+    profile: bool = typer.Option(
+        False,
+        help="Answer the query here rather than from the cache or server, and write cProfile stats and a JSON summary to ./starpilot-profiles",
+    ),
 ):
     """
     A self-query of the vectorstore that allows the user to search for a repo while filtering by attributes
@@ -188,139 +587,155 @@ def astrologer(
 
     """
 
-    if not os.path.exists(VECTORSTORE_PATH):
+    if generations.current_path(VECTORSTORE_PATH) is None:
         raise Exception("Please load the stars before shooting")
 
-    OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-    OPENAI_ORG_ID = os.environ["OPENAI_ORG_ID"]
-
-    metadata_field_info = [
-        # IDEA: create valid specific example values on data load for each users content
-        AttributeInfo(
-            name="languages",
-            description="the programming languages of a repo. Example: ['python', 'R', 'Rust']",
-            type="string",
-        ),
-        AttributeInfo(
-            name="name",
-            description="the name of a repository. Example: 'langchain'",
-            type="string",
-        ),
-        AttributeInfo(
-            name="topics",
-            description="the topics a repository is tagged with. Example: ['data-science', 'machine-learning', 'web-development', 'tidyverse']",
-            type="string",
-        ),
-        AttributeInfo(
-            name="url",
-            description="the url of a repository on GitHub",
-            type="string",
-        ),
-        AttributeInfo(
-            name="stargazerCount",
-            description="the number of stars a repository has on GitHub",
-            type="number",
-        ),
-    ]
-
-    document_content_description = "content describing a repository on GitHub"
-
-    llm = ChatOpenAI(
-        api_key=OPENAI_API_KEY,  # type: ignore
-        organization=OPENAI_ORG_ID,
-        model="gpt-3.5-turbo",
+    payload = {"query": query, "k": k}
+    if embedding_backend is not None:
+        payload["embedding_backend"] = embedding_backend.value
+    if rerank:
+        payload["rerank"] = rerank
+    if user is not None:
+        payload["user"] = user
+
+    results = server.answer_query(
+        "astrologer", payload, VECTORSTORE_PATH, local=profile
     )
 
-    # https://python.langchain.com/docs/modules/data_connection/retrievers/self_query#constructing-from-scratch-with-lcel
-    # https://github.com/langchain-ai/langchain/blob/master/cookbook/self_query_hotel_search.ipynb
+    print(utils.create_results_table(results))
 
-    prompt = get_query_constructor_prompt(
-        document_content_description,
-        metadata_field_info,
-        examples=[
-            (
-                "Python machine learning repos",
-                {
-                    "query": "machine learning",
-                    "filter": 'eq("primaryLanguage", "Python")',
-                },
-            ),
-            (
-                "Dataframe crates",
-                {"query": "data frame", "filter": 'eq("primaryLanguage", "Rust")'},
-            ),
-            (
-                "Web server gems",
-                {"query": "web server", "filter": 'eq("primaryLanguage", "Ruby")'},
-            ),
-            (
-                "date parsing npm packages",
-                {
-                    "query": "date parsing",
-                    "filter": 'eq("primaryLanguage", "JavaScript")',
-                },
-            ),
-            (
-                "What R packages do time series analysis",
-                {"query": "time series", "filter": 'eq("primaryLanguage", "R")'},
-            ),
-            (
-                "draw a graph of data in Python",
-                {"query": "graph", "filter": 'eq("primaryLanguage", "Python")'},
-            ),
-            (
-                "web app with R",
-                {"query": "web app", "filter": 'eq("primaryLanguage", "R")'},
-            ),
-            (
-                "functional programming CRAN",
-                {
-                    "query": "functional programming",
-                    "filter": 'eq("primaryLanguage", "R")',
-                },
-            ),
-            (
-                "data frame packages with 100 stars or more",
-                {
-                    "query": "data frame",
-                    "filter": 'gte("stargazerCount", 100)',
-                },
-            ),
-            (
-                "data frame packages with 100 stars or more",
-                {
-                    "query": "data frame",
-                    "filter": 'gte("stargazerCount", 100)',
-                },
-            ),
-        ],
-        allowed_comparators=[
-            Comparator.EQ,
-            Comparator.NE,
-            Comparator.GT,
-            Comparator.GTE,
-            Comparator.LT,
-            Comparator.LTE,
-        ],
+
+@app.command()
+@profiling.profiled("neighbours")
+def neighbours(
+    repo: str = typer.Argument(
+        ..., help="One of the stars that have been read, as owner/name"
+    ),
+    k: Optional[int] = typer.Option(3, help="Number of similar stars to fetch"),
+    user: Optional[str] = typer.Option(
+        None,
+        help="Only return the stars of this user, by default the stars of every user that has been read are returned",
+    ),
+    profile: bool = typer.Option(
+        False,
+        help="Answer the query here rather than from the cache or server, and write cProfile stats and a JSON summary to ./starpilot-profiles",
+    ),
+):
+    """
+    The stars most similar to one of your stars, compared by their stored vectors with no embedding call
+
+    Example:
+    ```
+    starpilot neighbours pytest-dev/pytest
+    ```
+
+    """
+
+    if generations.current_path(VECTORSTORE_PATH) is None:
+        raise Exception("Please load the stars before shooting")
+
+    payload = {"repo": repo, "k": k}
+    if user is not None:
+        payload["user"] = user
+
+    # a lookup in the neighbour graph is as quick as the result cache, so there's nothing to cache
+    results = server.answer_query(
+        "neighbours", payload, VECTORSTORE_PATH, local=profile
     )
 
-    output_parser = StructuredQueryOutputParser.from_components()
+    print(utils.create_results_table(results))
+
 
-    query_constructor = prompt | llm | output_parser
+@app.command()
+def constellations(
+    members: int = typer.Option(
+        5,
+        help="Number of each constellation's most typical stars to list, or 0 to list all of them",
+    ),
+    user: Optional[str] = typer.Option(
+        None,
+        help="Only list the stars of this user, by default the stars of every user that has been read are listed",
+    ),
+):
+    """
+    Browse your stars by theme, as the clusters of similar stars that `read` found
+    """
+    import starpilot.utils.constellations as constellations
 
-    vectorstore = Chroma(
-        persist_directory=VECTORSTORE_PATH,
-        embedding_function=OpenAIEmbeddings(model="text-embedding-3-large"),
+    if (store_path := generations.current_path(VECTORSTORE_PATH)) is None:
+        raise Exception("Please load the stars before shooting")
+
+    if (found := constellations.Constellations.load(store_path)) is None:
+        raise Exception("Please read the stars again to find their constellations")
+
+    candidate_ids = None
+    if user is not None:
+        if (repo_ids := sync.load_users(store_path).get(user.lower())) is None:
+            raise Exception(
+                f"The stars of {user} haven't been read. Run `starpilot read {user}` first"
+            )
+        candidate_ids = set(repo_ids)
+
+    print(
+        constellations.create_constellations_table(
+            found.summary(members, candidate_ids)
+        )
     )
 
-    retriever = SelfQueryRetriever(
-        query_constructor=query_constructor,  # type: ignore because it's documented as a pattern https://python.langchain.com/docs/modules/data_connection/retrievers/self_query#constructing-from-scratch-with-lcel:~:text=The%20next%20key,Integrations%20section.
-        vectorstore=vectorstore,
-        structured_query_translator=ChromaTranslator(),
-        search_kwargs={"k": k},
-        verbose=True,
+
+@app.command()
+def quantisation_report(
+    k: int = typer.Option(10, help="Number of neighbours to measure recall over"),
+    sample: int = typer.Option(200, help="Number of stored stars to use as queries"),
+    rerank: int = typer.Option(
+        0,
+        help="Re-score this many of the best compact matches against the full precision vectors",
+    ),
+):
+    """
+    Compare the recall and scored size of shortened and quantised vectors, to choose `read --dimensions` and `--quantisation`
+    """
+    import starpilot.utils.compact as compact
+
+    if (store_path := generations.current_path(VECTORSTORE_PATH)) is None:
+        raise Exception("Please load the stars before shooting")
+
+    _, vectors = utils.load_stored_vectors(utils.open_vectorstore(store_path))
+
+    # only the OpenAI models keep working when their vectors are cut short
+    dimensions = [None]
+    if utils.check_embedding_backend(store_path) is utils.EmbeddingBackends.openai:
+        dimensions += [d for d in (1024, 512, 256) if d < vectors.shape[1]]
+
+    report = compact.recall_report(
+        vectors,
+        dimensions=dimensions,
+        quantisations=list(utils.Quantisations),
+        k=k,
+        rerank_candidates=rerank,
+        sample=sample,
     )
 
-    results = retriever.invoke(query)
+    print(compact.create_report_table(report))
 
-    print(utils.create_results_table(results))
+
+@app.command()
+def rollback():
+    """
+    Switch queries back to the stars as they were before the last read
+    """
+
+    with generations.write_lock(VECTORSTORE_PATH):
+        generations.rollback(VECTORSTORE_PATH)
+
+
+@app.command()
+def serve(
+    host: str = typer.Option(server.SERVER_HOST, help="Host to listen on"),
+    port: int = typer.Option(server.SERVER_PORT, help="Port to listen on"),
+):
+    """
+    Keep the vectorstore loaded and answer shoot, astrologer and neighbours queries from other starpilot commands
+    """
+
+    server.serve(VECTORSTORE_PATH, host=host, port=port)
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+import time
+from array import array
+from typing import Dict, List, Optional
+
+import structlog
+from langchain_core.embeddings import Embeddings
+
+import starpilot.utils.profiling as profiling
+from starpilot.utils.utils import CACHE_DIR
+
+logger = structlog.get_logger(__name__)
+
+EMBEDDING_CACHE_PATH = os.path.join(CACHE_DIR, "embeddings.sqlite3")
+
+
+def hash_text(text: str) -> str:
+    """
+    Hash a piece of text to use as a cache key
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A persistent, size limited, least recently used store of embedding vectors
+
+    Vectors are keyed by the embedding model and a hash of the embedded text, so the same text
+    embedded for a different user, a rebuilt vectorstore, or as a query is only paid for once.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = 100_000,
+    ):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+
+    def get(self, model: str, content_hashes: List[str]) -> Dict[str, List[float]]:
+        """
+        Get the cached vectors for some content hashes, marking them as recently used
+        """
+        found: Dict[str, List[float]] = {}
+
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        # stay under sqlite's limit on the number of query parameters
+        for start in range(0, len(unique_hashes), 500):
+            chunk = unique_hashes[start : start + 500]
+            rows = self._connection.execute(
+                f"""
+                SELECT content_hash, vector FROM embeddings
+                WHERE model = ? AND content_hash IN ({",".join("?" * len(chunk))})
+                """,
+                [model, *chunk],
+            )
+            for content_hash, vector in rows:
+                found[content_hash] = array("f", vector).tolist()
+
+        if found:
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND content_hash = ?",
+                [(now, model, content_hash) for content_hash in found],
+            )
+            self._connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(unique_hashes) - len(found)
+
+        return found
+
+    def put(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        """
+        Cache vectors by content hash, evicting the least recently used beyond `max_entries`
+        """
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+            [
+                (model, content_hash, array("f", vector).tobytes(), now)
+                for content_hash, vector in vectors.items()
+            ],
+        )
+        self._evict()
+        self._connection.commit()
+
+    def _evict(self) -> None:
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+
+        if (excess := count - self.max_entries) > 0:
+            logger.debug("Evicting embeddings from cache", evicted=excess)
+            self._connection.execute(
+                """
+                DELETE FROM embeddings WHERE rowid IN (
+                    SELECT rowid FROM embeddings ORDER BY last_used, rowid LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wrap an embedding function so that both document and query embeddings go through an `EmbeddingCache`
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model: str,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self.underlying = underlying
+        self.model = model
+        self.cache = cache if cache is not None else EmbeddingCache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        content_hashes = [hash_text(text) for text in texts]
+        vectors = self.cache.get(self.model, content_hashes)
+
+        missing = {
+            content_hash: text
+            for content_hash, text in zip(content_hashes, texts)
+            if content_hash not in vectors
+        }
+
+        logger.info(
+            "Embedding cache",
+            kind="documents",
+            hits=len(set(content_hashes)) - len(missing),
+            misses=len(missing),
+            total_hits=self.cache.hits,
+            total_misses=self.cache.misses,
+        )
+
+        if missing:
+            with profiling.span("embed", texts=len(missing)):
+                computed = dict(
+                    zip(
+                        missing.keys(),
+                        self.underlying.embed_documents(list(missing.values())),
+                    )
+                )
+            self.cache.put(self.model, computed)
+            vectors.update(computed)
+
+        return [vectors[content_hash] for content_hash in content_hashes]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed many queries with one batched call for the ones that aren't cached
+
+        Queries are keyed by their exact text, just as `embed_query` does, so either can reuse the other's
+        """
+        content_hashes = [hash_text(text) for text in texts]
+        vectors = self.cache.get(self.model, content_hashes)
+
+        missing = {
+            content_hash: text
+            for content_hash, text in zip(content_hashes, texts)
+            if content_hash not in vectors
+        }
+        if missing:
+            with profiling.span("embed_query", queries=len(missing)):
+                computed = dict(
+                    zip(
+                        missing.keys(),
+                        self.underlying.embed_documents(list(missing.values())),
+                    )
+                )
+            self.cache.put(self.model, computed)
+            vectors.update(computed)
+
+        logger.info(
+            "Embedding cache",
+            kind="queries",
+            hits=len(set(content_hashes)) - len(missing),
+            misses=len(missing),
+            total_hits=self.cache.hits,
+            total_misses=self.cache.misses,
+        )
+
+        return [vectors[content_hash] for content_hash in content_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        start = time.perf_counter()
+        # keyed by the exact text embedded, "React" and "react" may embed differently
+        content_hash = hash_text(text)
+
+        vector = self.cache.get(self.model, [content_hash]).get(content_hash)
+        hit = vector is not None
+
+        if vector is None:
+            with profiling.span("embed_query"):
+                vector = self.underlying.embed_query(text)
+            self.cache.put(self.model, {content_hash: vector})
+
+        logger.info(
+            "Embedding cache",
+            kind="query",
+            hit=hit,
+            latency_ms=round((time.perf_counter() - start) * 1000, 2),
+            total_hits=self.cache.hits,
+            total_misses=self.cache.misses,
+        )
+
+        return vector
@@ -0,0 +1,120 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import structlog
+
+import starpilot.utils.generations as generations
+
+logger = structlog.get_logger(__name__)
+
+CHECKPOINT_FILENAME = "starpilot-checkpoint.jsonl"
+
+
+class ReadCheckpoint:
+    """
+    The pages of stars a read has fetched, appended to a file in the generation it is building
+
+    The first line holds the settings of the read, and every line after it a page and the state of the
+    fetch once that page arrived. The repos that are already embedded are the ones in the generation's
+    manifest, which is saved after every batch. So a resumed read replays the pages, embeds only the
+    repos the manifest is missing, and asks GitHub for the pages after the last one
+    """
+
+    def __init__(
+        self,
+        generation_path: str,
+        settings: Dict,
+        pages: Optional[List[List[Dict]]] = None,
+        fetch_state: Optional[Dict] = None,
+    ):
+        self.generation_path = generation_path
+        self.settings = settings
+        self.pages = pages or []
+        self.fetch_state = fetch_state
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.generation_path, CHECKPOINT_FILENAME)
+
+    @classmethod
+    def create(cls, generation_path: str, settings: Dict) -> "ReadCheckpoint":
+        """
+        Start the checkpoint of a read into a new generation
+        """
+        checkpoint = cls(generation_path, settings)
+        with open(checkpoint.path, "w") as file:
+            file.write(json.dumps({"settings": settings}) + "\n")
+
+        return checkpoint
+
+    @classmethod
+    def load(cls, generation_path: str) -> Optional["ReadCheckpoint"]:
+        """
+        Load the checkpoint of a generation, if a read into it was interrupted
+        """
+        path = os.path.join(generation_path, CHECKPOINT_FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as file:
+            lines = file.read().splitlines()
+
+        try:
+            settings = json.loads(lines[0])["settings"]
+        except (IndexError, ValueError, KeyError):
+            return None
+
+        pages, fetch_state = [], None
+        for number, line in enumerate(lines[1:], start=1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the read was killed while it was appending this page, which is fetched again
+                with open(path, "w") as file:
+                    file.write("".join(line + "\n" for line in lines[:number]))
+                break
+            pages.append(entry["repos"])
+            fetch_state = entry["fetch"]
+
+        return cls(generation_path, settings, pages, fetch_state)
+
+    def add_page(self, repos: List[Dict], fetch_state: Dict) -> None:
+        """
+        Append a page as soon as it arrives, with the state of the fetch after it
+        """
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"repos": repos, "fetch": fetch_state}) + "\n")
+
+    def remove(self) -> None:
+        """
+        Remove the checkpoint once the read has finished, so a copy of the generation doesn't carry it
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def find_resumable(root: str, settings: Dict) -> Optional[ReadCheckpoint]:
+    """
+    The checkpoint of the latest interrupted read, if it was a read with the same settings
+    """
+    for generation_path in generations.unpublished(root):
+        if (checkpoint := ReadCheckpoint.load(generation_path)) is None:
+            continue
+
+        if checkpoint.settings != settings:
+            logger.warning(
+                "The interrupted read had different settings or started from a different store, "
+                "reading from the beginning",
+                changed=sorted(
+                    setting
+                    for setting in {*settings, *checkpoint.settings}
+                    if settings.get(setting) != checkpoint.settings.get(setting)
+                ),
+            )
+            return None
+
+        return checkpoint
+
+    logger.info("There is no interrupted read to resume, reading from the beginning")
+    return None
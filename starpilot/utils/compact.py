@@ -0,0 +1,414 @@
+from __future__ import annotations
+
+import itertools
+import os
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import structlog
+
+from starpilot.utils.utils import Quantisations, get_documents
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+    from langchain_community.vectorstores import Chroma
+    from rich.table import Table
+
+logger = structlog.get_logger(__name__)
+
+COMPACT_INDEX_FILENAME = "starpilot-compact.npz"
+
+SCORE_BLOCK_ROWS = 4096
+# the most scores a batch of queries holds at once, 64MB of float32
+MAX_SCORES = 2**24
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale vectors to unit length, so a dot product is their cosine similarity
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def truncate(vectors: np.ndarray, dimensions: Optional[int]) -> np.ndarray:
+    """
+    Keep the first `dimensions` of each vector, as the embeddings API's `dimensions` parameter does
+
+    Only meaningful for models trained to front load information, like `text-embedding-3-*`
+    """
+    if dimensions is None or dimensions >= vectors.shape[-1]:
+        return normalise(vectors)
+    return normalise(vectors[..., :dimensions])
+
+
+def quantise(
+    vectors: np.ndarray, quantisation: Quantisations
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compress unit vectors, returning the codes and the scale that turns each row of codes back into a vector
+
+    int8 uses a symmetric scale per vector, so the largest component of each vector maps to 127
+    """
+    vectors = normalise(np.asarray(vectors, dtype=np.float32))
+
+    if quantisation is Quantisations.int8:
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, np.newaxis]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    dtype = np.float16 if quantisation is Quantisations.float16 else np.float32
+    return vectors.astype(dtype), np.ones(len(vectors), dtype=np.float32)
+
+
+class CompactIndex:
+    """
+    A quantised copy of every vector in the store, scored with one matrix product per query
+
+    The full precision vectors stay in Chroma and are only read back to re-rank the top candidates
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        codes: np.ndarray,
+        scales: np.ndarray,
+        quantisation: Quantisations,
+    ):
+        self.ids = list(ids)
+        self.codes = codes
+        self.scales = scales
+        self.quantisation = quantisation
+        self._positions = {repo_id: position for position, repo_id in enumerate(ids)}
+
+    @classmethod
+    def build(
+        cls, ids: Sequence[str], vectors: np.ndarray, quantisation: Quantisations
+    ) -> CompactIndex:
+        codes, scales = quantise(vectors, quantisation)
+        return cls(ids, codes, scales, quantisation)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def save(self, vectorstore_path: str) -> None:
+        path = os.path.join(vectorstore_path, COMPACT_INDEX_FILENAME)
+
+        # write then rename, so a query never loads a half written index
+        with open(path + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                ids=np.array(self.ids, dtype=str),
+                codes=self.codes,
+                scales=self.scales,
+                quantisation=np.array(self.quantisation.value),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, vectorstore_path: str) -> Optional[CompactIndex]:
+        path = os.path.join(vectorstore_path, COMPACT_INDEX_FILENAME)
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"].tolist(),
+                codes=arrays["codes"],
+                scales=arrays["scales"],
+                quantisation=Quantisations(str(arrays["quantisation"])),
+            )
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        candidate_ids: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        The `k` ids most similar to `query`, optionally only considering `candidate_ids`
+        """
+        return self.search_batch(
+            np.asarray(query)[np.newaxis], k, candidate_ids=candidate_ids
+        )[0]
+
+    def search_batch(
+        self,
+        queries: np.ndarray,
+        k: int,
+        candidate_ids: Optional[Iterable[str]] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        The `k` ids most similar to each row of `queries`, scoring every query in one matrix product
+
+        Queries are scored in blocks, so the scores held at once stay under `MAX_SCORES`
+        """
+        queries = normalise(np.asarray(queries, dtype=np.float32))
+
+        if candidate_ids is None:
+            ids = self.ids
+            codes, scales = self.codes, self.scales
+        else:
+            positions = np.array(
+                [
+                    self._positions[repo_id]
+                    for repo_id in candidate_ids
+                    if repo_id in self._positions
+                ],
+                dtype=np.int64,
+            )
+            ids = [self.ids[position] for position in positions]
+            codes, scales = self.codes[positions], self.scales[positions]
+
+        if len(codes) == 0:
+            return [[] for _ in queries]
+
+        k = min(k, len(codes))
+        query_block = max(1, MAX_SCORES // len(codes))
+        matches: List[List[Tuple[str, float]]] = []
+
+        for query_start in range(0, len(queries), query_block):
+            block_queries = queries[query_start : query_start + query_block]
+
+            scores = np.empty((len(codes), len(block_queries)), dtype=np.float32)
+            # upcast a block of codes at a time, so a query never holds a full precision copy of the index
+            for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+                block = codes[start : start + SCORE_BLOCK_ROWS].astype(np.float32)
+                scores[start : start + SCORE_BLOCK_ROWS] = block @ block_queries.T
+            scores *= scales[:, np.newaxis]
+
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            top = np.take_along_axis(
+                top,
+                np.argsort(-np.take_along_axis(scores, top, axis=0), axis=0),
+                axis=0,
+            )
+
+            matches.extend(
+                [(ids[index], float(scores[index, column])) for index in top[:, column]]
+                for column in range(len(block_queries))
+            )
+
+        return matches
+
+
+def build_compact_index(
+    vectorstore: Chroma, quantisation: Quantisations
+) -> CompactIndex:
+    """
+    Quantise every vector in the store into a compact index
+    """
+    stored = vectorstore._collection.get(include=["embeddings"])
+    vectors = np.array(stored["embeddings"] or [], dtype=np.float32)
+
+    index = CompactIndex.build(stored["ids"], vectors, quantisation)
+
+    logger.info(
+        "Built compact index",
+        vectors=len(index),
+        quantisation=quantisation.value,
+        size_bytes=index.nbytes,
+        full_size_bytes=vectors.nbytes,
+    )
+
+    return index
+
+
+def rerank(
+    vectorstore: Chroma, query: np.ndarray, candidates: List[str], k: int
+) -> List[Tuple[str, float]]:
+    """
+    Re-score candidates against their full precision vectors from the store
+    """
+    return rerank_batch(vectorstore, np.asarray(query)[np.newaxis], [candidates], k)[0]
+
+
+def rerank_batch(
+    vectorstore: Chroma,
+    queries: np.ndarray,
+    candidates: List[List[str]],
+    k: int,
+) -> List[List[Tuple[str, float]]]:
+    """
+    Re-score each query's candidates against their full precision vectors, read from the store once
+    """
+    if not (union := list(dict.fromkeys(itertools.chain.from_iterable(candidates)))):
+        return [[] for _ in candidates]
+
+    stored = vectorstore._collection.get(ids=union, include=["embeddings"])
+    vectors = normalise(np.array(stored["embeddings"], dtype=np.float32))
+    rows = {repo_id: row for row, repo_id in enumerate(stored["ids"])}
+    queries = normalise(np.asarray(queries, dtype=np.float32))
+
+    reranked = []
+    for query, query_candidates in zip(queries, candidates):
+        candidate_ids = [repo_id for repo_id in query_candidates if repo_id in rows]
+        scores = vectors[[rows[repo_id] for repo_id in candidate_ids]] @ query
+        order = np.argsort(-scores)[:k]
+        reranked.append(
+            [(candidate_ids[index], float(scores[index])) for index in order]
+        )
+
+    return reranked
+
+
+def search_documents(
+    vectorstore: Chroma,
+    index: CompactIndex,
+    query: str,
+    k: int,
+    rerank_candidates: int = 0,
+    where: Optional[Dict] = None,
+    candidate_ids: Optional[List[str]] = None,
+) -> List[Document]:
+    """
+    Search the compact index, then fetch the documents of the best matches from the store
+
+    Only `candidate_ids` are scored if given, otherwise a `where` filter is resolved to candidate ids
+    by the store before any vector is scored
+    """
+    query_vector = np.array(vectorstore.embeddings.embed_query(query))  # type: ignore
+
+    return search_documents_batch(
+        vectorstore,
+        index,
+        query_vector[np.newaxis],
+        k,
+        rerank_candidates,
+        where,
+        candidate_ids,
+    )[0]
+
+
+def search_documents_batch(
+    vectorstore: Chroma,
+    index: CompactIndex,
+    query_vectors: np.ndarray,
+    k: int,
+    rerank_candidates: int = 0,
+    where: Optional[Dict] = None,
+    candidate_ids: Optional[List[str]] = None,
+) -> List[List[Document]]:
+    """
+    Like `search_documents` for many query vectors at once, fetching every result's document in one call
+    """
+    if candidate_ids is None and where:
+        candidate_ids = vectorstore._collection.get(where=where, include=[])["ids"]
+
+    matches = index.search_batch(
+        query_vectors, max(k, rerank_candidates), candidate_ids=candidate_ids
+    )
+    if rerank_candidates:
+        matches = rerank_batch(
+            vectorstore,
+            query_vectors,
+            [[repo_id for repo_id, _ in query_matches] for query_matches in matches],
+            k,
+        )
+
+    ids = [[repo_id for repo_id, _ in query_matches[:k]] for query_matches in matches]
+    documents = {
+        document.metadata["nameWithOwner"]: document
+        for document in get_documents(
+            vectorstore, list(dict.fromkeys(itertools.chain.from_iterable(ids)))
+        )
+    }
+
+    return [
+        [documents[repo_id] for repo_id in query_ids if repo_id in documents]
+        for query_ids in ids
+    ]
+
+
+def recall_report(
+    vectors: np.ndarray,
+    dimensions: Sequence[Optional[int]],
+    quantisations: Sequence[Quantisations],
+    k: int = 10,
+    rerank_candidates: int = 0,
+    sample: int = 200,
+    seed: int = 0,
+) -> List[Dict]:
+    """
+    Measure recall@k and the scored size of every combination of dimensions and quantisation
+
+    A sample of the stored vectors are used as queries, and recall is measured against an exact
+    search over the full vectors, so no embedding calls are needed. The sizes are of the compact
+    index that queries score, which is kept beside the full precision vectors rather than instead of them
+    """
+    if len(vectors) == 0:
+        raise Exception("There are no stored vectors to measure recall against")
+    if k < 1:
+        raise Exception("Recall can only be measured over at least one neighbour")
+
+    vectors = normalise(np.asarray(vectors, dtype=np.float32))
+    ids = [str(position) for position in range(len(vectors))]
+
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(vectors), size=min(sample, len(vectors)), replace=False)
+
+    def _exact(matrix: np.ndarray, query: int) -> List[int]:
+        scores = matrix @ matrix[query]
+        return np.argsort(-scores)[:k].tolist()
+
+    truth = {query: set(_exact(vectors, query)) for query in queries}
+
+    report = []
+    for dimension in dimensions:
+        reduced = truncate(vectors, dimension)
+        for quantisation in quantisations:
+            index = CompactIndex.build(ids, reduced, quantisation)
+
+            hits = 0
+            for query in queries:
+                matches = index.search(reduced[query], max(k, rerank_candidates))
+                positions = [int(repo_id) for repo_id, _ in matches]
+                if rerank_candidates:
+                    # re-rank against the full precision vectors, as `search_documents` does
+                    scores = vectors[positions] @ vectors[query]
+                    positions = [positions[i] for i in np.argsort(-scores)]
+                hits += len(truth[query] & set(positions[:k]))
+
+            report.append(
+                {
+                    "dimensions": reduced.shape[1],
+                    "quantisation": quantisation.value,
+                    "scored_bytes_per_vector": index.nbytes // len(index),
+                    "index_size_bytes": index.nbytes,
+                    f"recall@{k}": hits / (len(queries) * min(k, len(vectors))),
+                }
+            )
+
+    return report
+
+
+def create_report_table(report: List[Dict]) -> Table:
+    """
+    Create a rich table from a recall report
+    """
+    from rich.table import Table
+
+    table = Table(
+        title="Recall vs scored size",
+        caption="The compact index is stored beside the full precision vectors, so it saves scoring work, not storage",
+    )
+
+    for column in report[0] if report else []:
+        table.add_column(column.replace("_", " ").capitalize())
+
+    for row in report:
+        table.add_row(
+            *(
+                f"{value:.3f}" if isinstance(value, float) else str(value)
+                for value in row.values()
+            )
+        )
+
+    return table
@@ -0,0 +1,341 @@
+from __future__ import annotations
+
+import os
+from collections import Counter
+from typing import TYPE_CHECKING, Collection, Dict, List, Optional, Sequence
+
+import numpy as np
+import structlog
+
+from starpilot.utils.compact import normalise
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+logger = structlog.get_logger(__name__)
+
+CONSTELLATIONS_FILENAME = "starpilot-constellations.npz"
+
+# about one constellation for this many stars, up to MAX_CONSTELLATIONS
+STARS_PER_CONSTELLATION = 50
+MAX_CONSTELLATIONS = 60
+MINI_BATCH_SIZE = 1024
+MINI_BATCH_ITERATIONS = 100
+# the most scores held at once, 16MB of float32
+MAX_SCORES = 2**22
+# topics and languages in a constellation's label
+LABEL_TERMS = 3
+# once this share of the stars were placed in the nearest constellation rather than clustered, cluster again
+RECLUSTER_SHARE = 0.25
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    The nearest centroid to each vector
+    """
+    block_rows = max(1, MAX_SCORES // len(centroids))
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + block_rows] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), block_rows)
+        ]
+        or [np.array([], dtype=np.int64)]
+    )
+
+
+def _seed_centroids(
+    vectors: np.ndarray, clusters: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Pick starting centroids from a sample of the vectors, each one likelier the further it is from those picked
+
+    This is k-means++, which spreads the centroids over the data so few end up sharing a cluster
+    """
+    sample = vectors[
+        rng.choice(len(vectors), size=min(len(vectors), 20 * clusters), replace=False)
+    ]
+    centroids = [sample[rng.integers(len(sample))]]
+    distances = 1 - sample @ centroids[0]
+    for _ in range(clusters - 1):
+        weights = np.clip(distances, 0, None).astype(np.float64) ** 2
+        if weights.sum() == 0:
+            break
+        centroids.append(sample[rng.choice(len(sample), p=weights / weights.sum())])
+        distances = np.minimum(distances, 1 - sample @ centroids[-1])
+
+    return np.array(centroids)
+
+
+def mini_batch_kmeans(
+    vectors: np.ndarray,
+    clusters: int,
+    batch_size: int = MINI_BATCH_SIZE,
+    iterations: int = MINI_BATCH_ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    The centroids of `clusters` groups of similar unit vectors
+
+    Each step assigns a random batch of vectors to their nearest centroids, then moves every centroid
+    towards its batch by a step that shrinks as it sees more vectors (Sculley's mini-batch k-means), and
+    back onto the unit sphere so vectors are compared by cosine similarity
+    """
+    rng = np.random.default_rng(seed)
+    centroids = _seed_centroids(vectors, clusters, rng)
+    seen = np.zeros(len(centroids))
+
+    for _ in range(iterations):
+        batch = vectors[
+            rng.choice(len(vectors), size=min(batch_size, len(vectors)), replace=False)
+        ]
+        assignments = _assign(batch, centroids)
+        counts = np.bincount(assignments, minlength=len(centroids))
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, batch)
+
+        seen += counts
+        moved = counts > 0
+        centroids[moved] += (
+            sums[moved] - counts[moved, np.newaxis] * centroids[moved]
+        ) / seen[moved, np.newaxis]
+        centroids = normalise(centroids)
+
+    return centroids
+
+
+def label(repos: Sequence[Dict], terms: int = LABEL_TERMS) -> str:
+    """
+    The topics and primary languages most of the repos share, most frequent first
+    """
+    counts: Counter = Counter()
+    for repo in repos:
+        counts.update(repo.get("topics") or [])
+        if language := repo.get("primaryLanguage"):
+            counts[language] += 1
+
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return " · ".join(term for term, _ in ranked[:terms])
+
+
+class Constellations:
+    """
+    The stars clustered into groups of similar stars by their vectors, each labelled by its common topics
+
+    Each repo's cluster and similarity to its centroid are kept with the content hash its vector was made
+    from. A sync keeps the clusters of the repos that didn't change, places the rest in the nearest
+    cluster, and only clusters every repo again once many have been placed that way
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        assignments: np.ndarray,
+        similarities: np.ndarray,
+        centroids: np.ndarray,
+        labels: Sequence[str],
+        content_hashes: Sequence[str],
+        placed: int = 0,
+    ):
+        self.ids = list(ids)
+        self.assignments = assignments
+        self.similarities = similarities
+        self.centroids = centroids
+        self.labels = list(labels)
+        self.content_hashes = list(content_hashes)
+        # repos placed in the nearest cluster since the repos were last clustered
+        self.placed = placed
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        content_hashes: Sequence[str],
+        repos: Dict[str, Dict],
+        previous: Optional[Constellations] = None,
+        clusters: Optional[int] = None,
+    ) -> Constellations:
+        """
+        Cluster the repos, or place the new and changed ones in the clusters of `previous`
+
+        `repos` are formatted repos by id, whose topics and primary languages label the clusters
+        """
+        vectors = normalise(np.asarray(vectors, dtype=np.float32))
+
+        assignments = np.zeros(len(ids), dtype=np.int64)
+        placed = 0
+        centroids = None
+        if (
+            previous is not None
+            and len(previous)
+            and previous.centroids.shape[1] == vectors.shape[1]
+        ):
+            previous_clusters = {
+                (repo_id, content_hash): cluster
+                for repo_id, content_hash, cluster in zip(
+                    previous.ids, previous.content_hashes, previous.assignments
+                )
+            }
+            kept = np.array(
+                [previous_clusters.get(key, -1) for key in zip(ids, content_hashes)],
+                dtype=np.int64,
+            )
+            new = np.flatnonzero(kept < 0)
+            placed = previous.placed + len(new)
+
+            if placed <= RECLUSTER_SHARE * len(ids):
+                centroids = previous.centroids
+                assignments = kept
+                if len(new):
+                    assignments[new] = _assign(vectors[new], centroids)
+            else:
+                logger.info(
+                    "Many stars changed since they were clustered, clustering again",
+                    placed=placed,
+                    repos=len(ids),
+                )
+
+        if centroids is None:
+            placed = 0
+            if len(ids):
+                clusters = clusters or min(
+                    MAX_CONSTELLATIONS,
+                    max(1, round(len(ids) / STARS_PER_CONSTELLATION)),
+                )
+                centroids = mini_batch_kmeans(vectors, min(clusters, len(ids)))
+                assignments = _assign(vectors, centroids)
+                # centroids that no repo is nearest to are dropped, so the clusters are numbered without gaps
+                used, assignments = np.unique(assignments, return_inverse=True)
+                centroids = centroids[used]
+            else:
+                centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+
+        similarities = np.einsum("ij,ij->i", vectors, centroids[assignments])
+        labels = [
+            label(
+                [
+                    repos.get(ids[position], {})
+                    for position in np.flatnonzero(assignments == cluster)
+                ]
+            )
+            for cluster in range(len(centroids))
+        ]
+
+        logger.info(
+            "Found constellations",
+            repos=len(ids),
+            constellations=len(centroids),
+            placed=placed,
+        )
+
+        return cls(
+            ids,
+            assignments.astype(np.int32),
+            similarities.astype(np.float32),
+            centroids.astype(np.float32),
+            labels,
+            content_hashes,
+            placed,
+        )
+
+    def save(self, vectorstore_path: str) -> None:
+        path = os.path.join(vectorstore_path, CONSTELLATIONS_FILENAME)
+
+        # write then rename, so `constellations` never loads a half written file
+        with open(path + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                ids=np.array(self.ids, dtype=str),
+                assignments=self.assignments,
+                similarities=self.similarities,
+                centroids=self.centroids,
+                labels=np.array(self.labels, dtype=str),
+                content_hashes=np.array(self.content_hashes, dtype=str),
+                placed=np.array(self.placed),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, vectorstore_path: str) -> Optional[Constellations]:
+        path = os.path.join(vectorstore_path, CONSTELLATIONS_FILENAME)
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"].tolist(),
+                assignments=arrays["assignments"],
+                similarities=arrays["similarities"],
+                centroids=arrays["centroids"],
+                labels=arrays["labels"].tolist(),
+                content_hashes=arrays["content_hashes"].tolist(),
+                placed=int(arrays["placed"]),
+            )
+
+    def summary(
+        self, members: int = 5, candidate_ids: Optional[Collection[str]] = None
+    ) -> List[Dict]:
+        """
+        Every cluster with its label, size and its `members` repos nearest its centroid, largest first
+
+        With `candidate_ids`, only those repos are counted and listed, and clusters without any are left out
+        """
+        positions = np.arange(len(self.ids))
+        if candidate_ids is not None:
+            positions = positions[[repo_id in candidate_ids for repo_id in self.ids]]
+
+        # most central first within each cluster
+        positions = positions[
+            np.lexsort((-self.similarities[positions], self.assignments[positions]))
+        ]
+        clusters = np.split(
+            positions,
+            np.cumsum(np.bincount(self.assignments[positions], minlength=len(self)))[
+                :-1
+            ],
+        )
+
+        return sorted(
+            (
+                {
+                    "constellation": cluster,
+                    "label": self.labels[cluster],
+                    "size": len(cluster_positions),
+                    "members": [
+                        self.ids[position]
+                        for position in cluster_positions[: members or None]
+                    ],
+                }
+                for cluster, cluster_positions in enumerate(clusters)
+                if len(cluster_positions)
+            ),
+            key=lambda constellation: -constellation["size"],
+        )
+
+
+def create_constellations_table(summary: List[Dict]) -> Table:
+    """
+    Create a rich table from the summary of the constellations
+    """
+    from rich.table import Table
+
+    table = Table(title="Constellations")
+
+    table.add_column("Constellation", justify="right")
+    table.add_column("Label")
+    table.add_column("Stars", justify="right")
+    table.add_column("Members")
+
+    for constellation in summary:
+        table.add_row(
+            str(constellation["constellation"]),
+            constellation["label"],
+            str(constellation["size"]),
+            "\n".join(constellation["members"]),
+        )
+
+    return table
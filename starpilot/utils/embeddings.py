@@ -0,0 +1,432 @@
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Dict, List, Mapping, Optional
+
+import aiohttp
+import numpy as np
+import structlog
+from langchain_core.embeddings import Embeddings
+from rich.progress import (
+    BarColumn,
+    MofNCompleteColumn,
+    Progress,
+    ProgressColumn,
+    Task,
+    TaskID,
+    TextColumn,
+    TimeElapsedColumn,
+)
+from rich.text import Text
+
+import starpilot.utils.profiling as profiling
+from starpilot.utils.tokens import TokenCounter
+
+logger = structlog.get_logger(__name__)
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# the sentence transformer chromadb ships as an ONNX model, 384 dimensions
+LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# https://platform.openai.com/docs/api-reference/embeddings/create
+MAX_ITEMS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+
+
+def pack_batches(
+    token_counts: List[int], max_items: int, max_tokens: int
+) -> List[List[int]]:
+    """
+    Pack texts, in order, into batches bounded by both the number of texts and their total tokens
+
+    Returns the indices of the texts in each batch
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    batch_tokens = 0
+
+    for index, tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(index)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """
+    Parse OpenAI's rate limit reset durations, e.g. `1s`, `6m0s` or `20ms`, into seconds
+    """
+    if not value:
+        return None
+
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def _retry_delay(headers: Mapping[str, str], attempt: int, backoff: float) -> float:
+    """
+    How long to wait after a rate limited or failed request, preferring what the API asked for
+    """
+    if (retry_after_ms := headers.get("retry-after-ms")) is not None:
+        return float(retry_after_ms) / 1000
+    if (retry_after := headers.get("retry-after")) is not None:
+        return float(retry_after)
+
+    resets = [
+        reset
+        for reset in (
+            _parse_reset(headers.get("x-ratelimit-reset-requests")),
+            _parse_reset(headers.get("x-ratelimit-reset-tokens")),
+        )
+        if reset is not None
+    ]
+    if resets:
+        return max(resets)
+
+    return backoff * 2**attempt + random.uniform(0, backoff)
+
+
+class ThroughputColumn(ProgressColumn):
+    """
+    Render documents and tokens embedded per second
+    """
+
+    def render(self, task: Task) -> Text:
+        elapsed = task.elapsed or 0
+        if not elapsed:
+            return Text("- docs/s - tokens/s", style="progress.data.speed")
+
+        return Text(
+            f"{task.completed / elapsed:.1f} docs/s "
+            f"{task.fields.get('tokens', 0) / elapsed:.0f} tokens/s",
+            style="progress.data.speed",
+        )
+
+
+def embedding_progress() -> Progress:
+    """
+    A rich progress bar that shows embedding progress and throughput
+    """
+    return Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        ThroughputColumn(),
+        TimeElapsedColumn(),
+    )
+
+
+class BatchedOpenAIEmbeddings(Embeddings):
+    """
+    Embed with the OpenAI embeddings endpoint, sending token aware batches concurrently
+
+    Batches are bounded by both the number of texts and their total tokens, up to `max_concurrency`
+    requests are in flight at once, and 429s and server errors are retried after the delay given in
+    the rate limit headers. `base_url` can point at any server that speaks the same API, and
+    `dimensions` asks the `text-embedding-3-*` models for shortened vectors.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api_key: Optional[str] = None,
+        organization: Optional[str] = None,
+        base_url: Optional[str] = None,
+        dimensions: Optional[int] = None,
+        max_concurrency: int = 4,
+        max_items: int = 256,
+        max_tokens: int = 100_000,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        token_counter: Optional[TokenCounter] = None,
+        progress: Optional[Progress] = None,
+    ):
+        self.model = model
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.organization = organization or os.environ.get("OPENAI_ORG_ID")
+        self.base_url = (
+            base_url or os.environ.get("OPENAI_BASE_URL") or OPENAI_API_BASE
+        ).rstrip("/")
+        self.dimensions = dimensions
+        self.max_concurrency = max_concurrency
+        self.max_items = min(max_items, MAX_ITEMS_PER_REQUEST)
+        self.max_tokens = min(max_tokens, MAX_TOKENS_PER_REQUEST)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.token_counter = token_counter
+        self.progress = progress
+        self.requests = 0
+        self.retries = 0
+
+        self._task: Optional[TaskID] = None
+        self._paused_until = 0.0
+
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        if self.token_counter is not None:
+            return self.token_counter.count(texts)
+        # without a tokenizer, assume the worst case of a token every few characters
+        return [len(text) // 3 + 1 for text in texts]
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if self.organization:
+            headers["OpenAI-Organization"] = self.organization
+        return headers
+
+    async def _wait_for_rate_limit(self) -> None:
+        if (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _embed_batch(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        texts: List[str],
+    ) -> List[List[float]]:
+        payload: Dict = {
+            "model": self.model,
+            "input": texts,
+            "encoding_format": "float",
+        }
+        if self.dimensions is not None:
+            payload["dimensions"] = self.dimensions
+
+        attempt = 0
+        while True:
+            async with semaphore:
+                await self._wait_for_rate_limit()
+                self.requests += 1
+                profiling.record(embedding_api_calls=1)
+                async with session.post(
+                    f"{self.base_url}/embeddings", json=payload
+                ) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        profiling.record(embedding_bytes=response.content_length or 0)
+                        headers = response.headers
+                        if headers.get("x-ratelimit-remaining-tokens") == "0" or (
+                            headers.get("x-ratelimit-remaining-requests") == "0"
+                        ):
+                            self._pause(_retry_delay(headers, attempt, self.backoff))
+                        return [
+                            item["embedding"]
+                            for item in sorted(
+                                result["data"], key=lambda item: item["index"]
+                            )
+                        ]
+
+                    if (
+                        response.status != 429 and response.status < 500
+                    ) or attempt == self.max_retries:
+                        response.raise_for_status()
+
+                    delay = _retry_delay(response.headers, attempt, self.backoff)
+
+            self.retries += 1
+            profiling.record(embedding_retries=1)
+            self._pause(delay)
+            logger.warning(
+                "Retrying embedding request",
+                status=response.status,
+                attempt=attempt + 1,
+                delay=delay,
+            )
+            attempt += 1
+
+    def _pause(self, delay: float) -> None:
+        # every concurrent request waits, not just the one that was rate limited
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        token_counts = self._count_tokens(texts)
+        batches = pack_batches(token_counts, self.max_items, self.max_tokens)
+
+        if self.progress is not None:
+            if self._task is None:
+                self._task = self.progress.add_task(
+                    "Embedding the stars...", total=0, tokens=0
+                )
+            self.progress.update(
+                self._task,
+                total=self.progress.tasks[self._task].total + len(texts),
+            )
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+
+        async with aiohttp.ClientSession(
+            headers=self._headers(), connector=connector
+        ) as session:
+
+            async def _embed(batch: List[int]) -> List[List[float]]:
+                vectors = await self._embed_batch(
+                    session, semaphore, [texts[index] for index in batch]
+                )
+                if self.progress is not None and self._task is not None:
+                    task = self.progress.tasks[self._task]
+                    self.progress.update(
+                        self._task,
+                        advance=len(batch),
+                        tokens=task.fields["tokens"]
+                        + sum(token_counts[index] for index in batch),
+                    )
+                return vectors
+
+            results = await asyncio.gather(*(_embed(batch) for batch in batches))
+
+        vectors: List[List[float]] = [[] for _ in texts]
+        for batch, batch_vectors in zip(batches, results):
+            for index, vector in zip(batch, batch_vectors):
+                vectors[index] = vector
+
+        logger.debug(
+            "Embedded documents",
+            texts=len(texts),
+            batches=len(batches),
+            requests=self.requests,
+            retries=self.retries,
+        )
+
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return asyncio.run(self.aembed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Embed on the CPU with the all-MiniLM-L6-v2 ONNX model that chromadb ships, needing no network or API key
+
+    The model is downloaded once to `~/.cache/chroma`. Texts are sorted by length so each batch is only
+    padded to its longest text, the tokenizer encodes a batch on all cores and onnxruntime runs the model
+    on `num_threads` cores.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 64,
+        num_threads: Optional[int] = None,
+        progress: Optional[Progress] = None,
+    ):
+        self.model = LOCAL_EMBEDDING_MODEL
+        self.batch_size = batch_size
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.progress = progress
+
+        self._tokenizer = None
+        self._session = None
+        self._task: Optional[TaskID] = None
+
+    def _load(self) -> None:
+        if self._session is not None:
+            return
+
+        import onnxruntime
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        from tokenizers import Tokenizer
+
+        model = ONNXMiniLM_L6_V2()
+        model._download_model_if_not_exists()
+        model_path = os.path.join(model.DOWNLOAD_PATH, model.EXTRACTED_FOLDER_NAME)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.num_threads
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(model_path, "model.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+
+        self._tokenizer = Tokenizer.from_file(
+            os.path.join(model_path, "tokenizer.json")
+        )
+        self._tokenizer.enable_truncation(max_length=256)
+        # pad to the longest text in the batch, unless the model was exported with a fixed length
+        sequence_length = self._session.get_inputs()[0].shape[1]
+        self._tokenizer.enable_padding(
+            pad_id=0,
+            pad_token="[PAD]",
+            length=sequence_length if isinstance(sequence_length, int) else None,
+        )
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encoded = self._tokenizer.encode_batch(texts)  # type: ignore
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+
+        last_hidden_state = self._session.run(  # type: ignore
+            None,
+            {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            },
+        )[0]
+
+        # mean pool over the real tokens, then normalise like sentence-transformers does
+        mask = attention_mask[:, :, np.newaxis]
+        pooled = (last_hidden_state * mask).sum(axis=1) / np.clip(
+            mask.sum(axis=1), 1e-9, None
+        )
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1e-12
+
+        return (pooled / norms).astype(np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        self._load()
+
+        if self.progress is not None:
+            if self._task is None:
+                self._task = self.progress.add_task(
+                    "Embedding the stars...", total=0, tokens=0
+                )
+            self.progress.update(
+                self._task,
+                total=self.progress.tasks[self._task].total + len(texts),
+            )
+
+        order = sorted(range(len(texts)), key=lambda index: len(texts[index]))
+        vectors: List[List[float]] = [[] for _ in texts]
+
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            for index, vector in zip(
+                batch, self._embed_batch([texts[index] for index in batch])
+            ):
+                vectors[index] = vector.tolist()
+
+            if self.progress is not None and self._task is not None:
+                self.progress.update(self._task, advance=len(batch))
+
+        logger.debug("Embedded documents locally", texts=len(texts), model=self.model)
+
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
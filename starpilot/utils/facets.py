@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import structlog
+
+if TYPE_CHECKING:
+    from langchain.chains.query_constructor.ir import FilterDirective
+
+logger = structlog.get_logger(__name__)
+
+FACET_INDEX_FILENAME = "starpilot-facets.npz"
+
+# fields with one value per repo, and fields with any number of values per repo
+SINGLE_VALUED_FIELDS = ("primaryLanguage", "owner")
+MULTI_VALUED_FIELDS = ("languages", "topics", "users")
+FACET_FIELDS = SINGLE_VALUED_FIELDS + MULTI_VALUED_FIELDS
+
+USER_FLAG_PREFIX = "user:"
+
+
+def _record_values(record: Dict, field: str) -> List[str]:
+    if field == "owner":
+        return [record.get("owner") or record["nameWithOwner"].split("/")[0]]
+    value = record.get(field)
+    if not value:
+        return []
+    return list(value) if isinstance(value, list) else [value]
+
+
+class FacetIndex:
+    """
+    Bitsets of the repos with each language, topic, owner and user, and the repos sorted by stars
+
+    Chroma stores topics and languages as space joined strings and evaluates filters row by row.
+    This index resolves a structured query's filter to the set of matching repos with a few bitwise
+    operations over packed bit rows, before any vector is scored.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        stars: np.ndarray,
+        values: Dict[str, List[str]],
+        bits: Dict[str, np.ndarray],
+    ):
+        self.ids = list(ids)
+        self.stars = stars
+        self.values = values
+        self.bits = bits
+        # values are looked up case insensitively, an LLM may write "python" for "Python"
+        self._value_rows = {
+            field: {value.lower(): row for row, value in enumerate(field_values)}
+            for field, field_values in values.items()
+        }
+        self._star_order = np.argsort(stars, kind="stable")
+        self._sorted_stars = stars[self._star_order]
+        self._all = np.packbits(np.ones(len(self.ids), dtype=bool))
+
+    @classmethod
+    def build(
+        cls, records: Iterable[Dict], users: Optional[Dict[str, List[str]]] = None
+    ) -> FacetIndex:
+        """
+        Index formatted repos, and the ids of the repos each user starred
+        """
+        records = list(records)
+        ids = [record["nameWithOwner"] for record in records]
+        positions = {repo_id: position for position, repo_id in enumerate(ids)}
+        stars = np.array(
+            [record.get("stargazerCount", 0) for record in records], dtype=np.int64
+        )
+
+        members: Dict[str, Dict[str, List[int]]] = {field: {} for field in FACET_FIELDS}
+        for position, record in enumerate(records):
+            for field in FACET_FIELDS:
+                if field == "users":
+                    continue
+                for value in _record_values(record, field):
+                    members[field].setdefault(value, []).append(position)
+        for user, repo_ids in (users or {}).items():
+            members["users"][user.lower()] = [
+                positions[repo_id] for repo_id in repo_ids if repo_id in positions
+            ]
+
+        values = {}
+        bits = {}
+        for field in FACET_FIELDS:
+            values[field] = sorted(members[field])
+            rows = np.repeat(
+                np.arange(len(values[field])),
+                [len(members[field][value]) for value in values[field]],
+            )
+            columns = np.array(
+                [
+                    position
+                    for value in values[field]
+                    for position in members[field][value]
+                ],
+                dtype=np.int64,
+            )
+            # set the bits straight into packed rows, most significant bit first as np.packbits does,
+            # a values by repos bool matrix would take gigabytes for every topic of a large corpus
+            bits[field] = np.zeros(
+                (len(values[field]), (len(ids) + 7) // 8), dtype=np.uint8
+            )
+            np.bitwise_or.at(
+                bits[field],
+                (rows, columns >> 3),
+                (0x80 >> (columns & 7)).astype(np.uint8),
+            )
+
+        index = cls(ids, stars, values, bits)
+
+        logger.info(
+            "Built facet index",
+            repos=len(ids),
+            **{field: len(values[field]) for field in FACET_FIELDS},
+        )
+
+        return index
+
+    def records(self) -> Dict[str, Dict]:
+        """
+        The facet values of each repo, as formatted repos, so the index can be rebuilt with some repos changed
+        """
+        records: Dict[str, Dict] = {
+            repo_id: {"nameWithOwner": repo_id, "stargazerCount": int(stars)}
+            for repo_id, stars in zip(self.ids, self.stars)
+        }
+        for field in FACET_FIELDS:
+            if field == "users":
+                continue
+            for value, row in zip(self.values[field], self.bits[field]):
+                for position in np.flatnonzero(np.unpackbits(row, count=len(self.ids))):
+                    record = records[self.ids[position]]
+                    if field in SINGLE_VALUED_FIELDS:
+                        record[field] = value
+                    else:
+                        record.setdefault(field, []).append(value)
+        return records
+
+    def save(self, vectorstore_path: str) -> None:
+        path = os.path.join(vectorstore_path, FACET_INDEX_FILENAME)
+
+        arrays = {"ids": np.array(self.ids, dtype=str), "stars": self.stars}
+        for field in FACET_FIELDS:
+            arrays[f"{field}_values"] = np.array(self.values[field], dtype=str)
+            arrays[f"{field}_bits"] = self.bits[field]
+
+        # write then rename, so a query never loads a half written index
+        with open(path + ".tmp", "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, vectorstore_path: str) -> Optional[FacetIndex]:
+        path = os.path.join(vectorstore_path, FACET_INDEX_FILENAME)
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"].tolist(),
+                stars=arrays["stars"],
+                values={
+                    field: arrays[f"{field}_values"].tolist() for field in FACET_FIELDS
+                },
+                bits={field: arrays[f"{field}_bits"] for field in FACET_FIELDS},
+            )
+
+    def _value_bits(self, field: str, value) -> np.ndarray:
+        if (row := self._value_rows[field].get(str(value).lower())) is None:
+            return np.zeros_like(self._all)
+        return self.bits[field][row]
+
+    def _star_bits(self, comparator: str, value) -> np.ndarray:
+        lower, upper = {
+            "eq": ("left", "right"),
+            "ne": ("left", "right"),
+            "gt": ("right", None),
+            "gte": ("left", None),
+            "lt": (None, "left"),
+            "lte": (None, "right"),
+        }[comparator]
+        start = np.searchsorted(self._sorted_stars, value, side=lower) if lower else 0
+        end = (
+            np.searchsorted(self._sorted_stars, value, side=upper)
+            if upper
+            else len(self.ids)
+        )
+
+        mask = np.zeros(len(self.ids), dtype=bool)
+        mask[self._star_order[start:end]] = True
+        bits = np.packbits(mask)
+
+        return self._all & ~bits if comparator == "ne" else bits
+
+    def _resolve(self, filter: FilterDirective) -> Optional[np.ndarray]:
+        from langchain.chains.query_constructor.ir import Comparison, Operation
+
+        if isinstance(filter, Operation):
+            arguments = [self._resolve(argument) for argument in filter.arguments]
+            if any(argument is None for argument in arguments):
+                return None
+            if filter.operator.value == "not":
+                return self._all & ~arguments[0]  # type: ignore
+            reduce = np.bitwise_and if filter.operator.value == "and" else np.bitwise_or
+            return reduce.reduce(arguments)
+
+        if not isinstance(filter, Comparison):
+            return None
+
+        attribute, comparator, value = (
+            filter.attribute,
+            filter.comparator.value,
+            filter.value,
+        )
+
+        if attribute == "stargazerCount":
+            if comparator not in ("eq", "ne", "gt", "gte", "lt", "lte"):
+                return None
+            return self._star_bits(comparator, value)
+
+        # a user's flag, e.g. eq("user:octocat", True)
+        if attribute.startswith(USER_FLAG_PREFIX):
+            attribute, wanted = "users", value
+            value = filter.attribute[len(USER_FLAG_PREFIX) :]
+            if comparator not in ("eq", "ne") or not isinstance(wanted, bool):
+                return None
+            comparator = "eq" if (comparator == "eq") == wanted else "ne"
+
+        if attribute not in FACET_FIELDS:
+            return None
+
+        # a multi valued field equals a value when it contains it
+        if comparator in ("eq", "contain", "ne"):
+            bits = self._value_bits(attribute, value)
+            return self._all & ~bits if comparator == "ne" else bits
+        if comparator in ("in", "nin"):
+            bits = np.zeros_like(self._all)
+            for item in value if isinstance(value, list) else [value]:
+                bits = bits | self._value_bits(attribute, item)
+            return self._all & ~bits if comparator == "nin" else bits
+
+        return None
+
+    def candidates(self, filter: Optional[FilterDirective]) -> Optional[List[str]]:
+        """
+        The ids of the repos a structured query's filter matches
+
+        Returns None if the filter uses an attribute or comparator the index doesn't cover, so it
+        can be left to the store instead
+        """
+        if filter is None:
+            return None
+        if (bits := self._resolve(filter)) is None:
+            return None
+
+        return [
+            self.ids[position]
+            for position in np.flatnonzero(np.unpackbits(bits, count=len(self.ids)))
+        ]
@@ -0,0 +1,205 @@
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+GENERATIONS_DIRNAME = "generations"
+CURRENT_FILENAME = "current"
+PREVIOUS_FILENAME = "previous"
+LOCK_FILENAME = "read.lock"
+
+# everything in the root that belongs to the layout, rather than to a store written before generations
+LAYOUT_NAMES = {GENERATIONS_DIRNAME, CURRENT_FILENAME, PREVIOUS_FILENAME, LOCK_FILENAME}
+
+
+def _read_pointer(root: str, filename: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, filename)) as file:
+            name = file.read().strip()
+    except FileNotFoundError:
+        return None
+
+    return os.path.join(root, GENERATIONS_DIRNAME, name) if name else None
+
+
+def _write_pointer(root: str, filename: str, generation_path: str) -> None:
+    # written then renamed, so readers see the old pointer or the new one and never half of one
+    temporary_path = os.path.join(root, f".{filename}.{os.getpid()}")
+    with open(temporary_path, "w") as file:
+        file.write(os.path.basename(generation_path))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, os.path.join(root, filename))
+
+
+def _is_layout_name(name: str) -> bool:
+    return name in LAYOUT_NAMES or name.startswith(".")
+
+
+def _has_unversioned_store(root: str) -> bool:
+    return os.path.isdir(root) and any(
+        not _is_layout_name(name) for name in os.listdir(root)
+    )
+
+
+def current_path(root: str) -> Optional[str]:
+    """
+    The directory of the store that queries should read, or None if the stars haven't been read
+
+    Stores written before generations existed live in `root` itself, and are read from there until
+    the next `read` moves them into a generation
+    """
+    if (path := _read_pointer(root, CURRENT_FILENAME)) is not None:
+        return path
+    if _has_unversioned_store(root):
+        return root
+    return None
+
+
+def previous_path(root: str) -> Optional[str]:
+    """
+    The directory of the store that was current before the last `read`, kept for `rollback`
+    """
+    return _read_pointer(root, PREVIOUS_FILENAME)
+
+
+@contextmanager
+def write_lock(root: str) -> Iterator[None]:
+    """
+    Hold the lock on a store's generations, waiting for any other `read` to finish first
+    """
+    os.makedirs(root, exist_ok=True)
+
+    try:
+        import fcntl
+    except ImportError:
+        logger.warning("File locks aren't supported here, reads must not overlap")
+        yield
+        return
+
+    with open(os.path.join(root, LOCK_FILENAME), "w") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for another read of the stars to finish", root=root)
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def create_generation(root: str, copy_from: Optional[str] = None) -> str:
+    """
+    Create the directory of a new generation, starting as a copy of `copy_from` or empty
+
+    Nothing reads it until it is published, so it can be written to freely
+    """
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(root, GENERATIONS_DIRNAME, name)
+
+    if copy_from is None:
+        os.makedirs(path)
+    else:
+        shutil.copytree(
+            copy_from,
+            path,
+            # an unversioned store in the root sits beside the layout, which isn't part of it
+            ignore=lambda directory, names: (
+                [name for name in names if _is_layout_name(name)]
+                if os.path.samefile(directory, copy_from)
+                else []
+            ),
+        )
+
+    logger.debug("Created vectorstore generation", path=path, copied_from=copy_from)
+
+    return path
+
+
+def publish(root: str, generation_path: str) -> None:
+    """
+    Make a generation the one queries read, keeping the one it replaces for `rollback`
+    """
+    previous = _read_pointer(root, CURRENT_FILENAME)
+
+    _write_pointer(root, CURRENT_FILENAME, generation_path)
+    if previous is not None:
+        _write_pointer(root, PREVIOUS_FILENAME, previous)
+
+    logger.info(
+        "Switched to new vectorstore generation",
+        current=os.path.basename(generation_path),
+        previous=os.path.basename(previous) if previous else None,
+    )
+
+
+def rollback(root: str) -> str:
+    """
+    Make the previous generation current again, returning its path
+    """
+    current = _read_pointer(root, CURRENT_FILENAME)
+    previous = previous_path(root)
+    if current is None or previous is None or not os.path.isdir(previous):
+        raise Exception("There is no previous read of the stars to roll back to")
+
+    _write_pointer(root, CURRENT_FILENAME, previous)
+    _write_pointer(root, PREVIOUS_FILENAME, current)
+
+    logger.info(
+        "Rolled back to previous vectorstore generation",
+        current=os.path.basename(previous),
+    )
+
+    return previous
+
+
+def unpublished(root: str) -> List[str]:
+    """
+    The paths of generations that were never published, like those of reads that failed, newest first
+    """
+    generations_path = os.path.join(root, GENERATIONS_DIRNAME)
+    if not os.path.isdir(generations_path):
+        return []
+
+    published = {_read_pointer(root, CURRENT_FILENAME), previous_path(root)}
+    return [
+        path
+        for name in sorted(os.listdir(generations_path), reverse=True)
+        if (path := os.path.join(generations_path, name)) not in published
+    ]
+
+
+def collect_garbage(root: str) -> None:
+    """
+    Delete every generation but the current and previous ones, and any store from before generations
+
+    Only call this while holding `write_lock`, or a generation that is still being written is deleted
+    """
+    # nothing has been published, so there is nothing to keep either
+    if _read_pointer(root, CURRENT_FILENAME) is None:
+        return
+
+    deleted = []
+    for path in unpublished(root):
+        shutil.rmtree(path, ignore_errors=True)
+        deleted.append(os.path.basename(path))
+
+    # a store from before generations was copied into the first one
+    for name in os.listdir(root):
+        if not _is_layout_name(name):
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            deleted.append(name)
+
+    if deleted:
+        logger.info("Deleted old vectorstore generations", deleted=sorted(deleted))
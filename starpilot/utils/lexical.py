@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+LEXICAL_INDEX_FILENAME = "starpilot-lexical.npz"
+
+# keeps names like scikit-learn, c++, c# and node.js whole
+TOKEN_PATTERN = re.compile(r"[a-z0-9+#]+(?:[-_.][a-z0-9+#]+)*")
+
+# how many times each field of a formatted repo counts towards its term frequencies
+FIELD_WEIGHTS = {"content": 1, "name": 2, "topics": 1, "languages": 1}
+
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase words, with compound names also split into their parts
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if (parts := re.split(r"[-_.]", token)) and len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+def repo_terms(repo: Dict) -> Counter:
+    """
+    The weighted term frequencies of a formatted repo
+    """
+    terms: Counter = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        value = repo.get(field)
+        if not value:
+            continue
+        text = " ".join(value) if isinstance(value, list) else str(value)
+        for token in tokenize(text):
+            terms[token] += weight
+    return terms
+
+
+class LexicalIndex:
+    """
+    A BM25 inverted index over the formatted repos
+
+    Postings are stored as flat arrays, one slice per term, holding the final BM25 weight of the term
+    in each repo, so answering a query is a handful of slice additions and an `argpartition`
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        vocabulary: Sequence[str],
+        indptr: np.ndarray,
+        postings: np.ndarray,
+        weights: np.ndarray,
+    ):
+        self.ids = list(ids)
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+        self._terms = {term: index for index, term in enumerate(vocabulary)}
+        self._positions: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def build(
+        cls, repos: Iterable[Dict], k1: float = 1.2, b: float = 0.75
+    ) -> LexicalIndex:
+        ids = []
+        term_frequencies = []
+        for repo in repos:
+            # repos without content aren't in the vectorstore either
+            if repo.get("content"):
+                ids.append(repo["nameWithOwner"])
+                term_frequencies.append(repo_terms(repo))
+
+        lengths = np.array(
+            [sum(terms.values()) for terms in term_frequencies], dtype=np.float32
+        )
+        average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+        postings_by_term: Dict[str, List[Tuple[int, int]]] = {}
+        for position, terms in enumerate(term_frequencies):
+            for term, frequency in terms.items():
+                postings_by_term.setdefault(term, []).append((position, frequency))
+
+        vocabulary = sorted(postings_by_term)
+        document_frequencies = np.array(
+            [len(postings_by_term[term]) for term in vocabulary], dtype=np.float32
+        )
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(document_frequencies)
+
+        term_postings = np.array(
+            [posting for term in vocabulary for posting in postings_by_term[term]],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        positions, frequencies = term_postings[:, 0], term_postings[:, 1]
+
+        idf = np.log(
+            1 + (len(ids) - document_frequencies + 0.5) / (document_frequencies + 0.5)
+        )
+        norms = k1 * (1 - b + b * lengths[positions] / max(average_length, 1e-9))
+        weights = (
+            np.repeat(idf, document_frequencies.astype(np.int64))
+            * frequencies
+            * (k1 + 1)
+            / (frequencies + norms)
+        )
+
+        index = cls(
+            ids,
+            vocabulary,
+            indptr,
+            positions.astype(np.int32),
+            weights.astype(np.float32),
+        )
+
+        logger.info(
+            "Built lexical index",
+            repos=len(ids),
+            terms=len(vocabulary),
+            postings=len(positions),
+        )
+
+        return index
+
+    def save(self, vectorstore_path: str) -> None:
+        path = os.path.join(vectorstore_path, LEXICAL_INDEX_FILENAME)
+
+        # write then rename, so a query never loads a half written index
+        with open(path + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                ids=np.array(self.ids, dtype=str),
+                vocabulary=np.array(list(self._terms), dtype=str),
+                indptr=self.indptr,
+                postings=self.postings,
+                weights=self.weights,
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, vectorstore_path: str) -> Optional[LexicalIndex]:
+        path = os.path.join(vectorstore_path, LEXICAL_INDEX_FILENAME)
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"].tolist(),
+                vocabulary=arrays["vocabulary"].tolist(),
+                indptr=arrays["indptr"],
+                postings=arrays["postings"],
+                weights=arrays["weights"],
+            )
+
+    def search(
+        self, query: str, k: int, candidate_ids: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        The `k` best matching ids for a query and their BM25 scores, best first
+
+        With `candidate_ids`, only those repos are ranked
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+
+        for term in set(tokenize(query)):
+            if (index := self._terms.get(term)) is None:
+                continue
+            start, end = self.indptr[index], self.indptr[index + 1]
+            scores[self.postings[start:end]] += self.weights[start:end]
+
+        if candidate_ids is not None:
+            if self._positions is None:
+                self._positions = {
+                    repo_id: position for position, repo_id in enumerate(self.ids)
+                }
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[
+                [
+                    position
+                    for repo_id in candidate_ids
+                    if (position := self._positions.get(repo_id)) is not None
+                ]
+            ] = True
+            scores[~mask] = 0
+
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return []
+
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [(self.ids[position], float(scores[position])) for position in top]
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[Sequence[str]], k: int = RRF_K
+) -> List[str]:
+    """
+    Merge rankings of ids, scoring each id by the sum of 1 / (k + rank) over the rankings it is in
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, repo_id in enumerate(ranking, start=1):
+            scores[repo_id] = scores.get(repo_id, 0.0) + 1 / (k + rank)
+
+    return sorted(scores, key=lambda repo_id: scores[repo_id], reverse=True)
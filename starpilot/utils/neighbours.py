@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING, Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import structlog
+
+from starpilot.utils.compact import normalise
+from starpilot.utils.sync import content_hashes
+from starpilot.utils.utils import load_stored_vectors
+
+if TYPE_CHECKING:
+    from langchain_core.vectorstores import VectorStore
+
+logger = structlog.get_logger(__name__)
+
+NEIGHBOURS_FILENAME = "starpilot-neighbours.npz"
+
+# neighbours kept for every repo, the most `neighbours` can answer from the graph alone
+GRAPH_NEIGHBOURS = 50
+# repos are compared with every other repo up to this many pairs, above it only with the repos in nearby cells
+EXACT_PAIRS = 10_000**2
+# the most scores held at once, 16MB of float32 and four times that in the positions that sort them
+MAX_SCORES = 2**22
+# how many of the cells nearest to a repo's own cell its neighbours are looked for in
+PROBE_CELLS = 8
+CELL_ITERATIONS = 3
+
+
+def _top(scores: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The columns of the `n` best scores in each row, best first, and those scores
+    """
+    n = min(n, scores.shape[1])
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(
+        top_scores, order, axis=1
+    )
+
+
+def _nearest_among(
+    vectors: np.ndarray,
+    rows: np.ndarray,
+    candidates: np.ndarray,
+    n: int,
+    neighbours: np.ndarray,
+    scores: np.ndarray,
+) -> None:
+    """
+    Fill in the `n` nearest `candidates` to each of `rows`, never counting a repo as its own neighbour
+    """
+    if len(candidates) == 0:
+        return
+
+    block_rows = max(1, MAX_SCORES // len(candidates))
+    candidate_vectors = vectors[candidates]
+
+    for start in range(0, len(rows), block_rows):
+        block = rows[start : start + block_rows]
+        block_scores = vectors[block] @ candidate_vectors.T
+        block_scores[block[:, np.newaxis] == candidates[np.newaxis, :]] = -np.inf
+
+        top, top_scores = _top(block_scores, n)
+        found = np.isfinite(top_scores)
+        neighbours[block, : top.shape[1]] = np.where(found, candidates[top], -1)
+        scores[block, : top.shape[1]] = top_scores
+
+
+def _assign(vectors: np.ndarray, centres: np.ndarray) -> np.ndarray:
+    block_rows = max(1, MAX_SCORES // len(centres))
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + block_rows] @ centres.T, axis=1)
+            for start in range(0, len(vectors), block_rows)
+        ]
+    )
+
+
+def _nearest(
+    vectors: np.ndarray,
+    rows: np.ndarray,
+    n: int,
+    neighbours: np.ndarray,
+    scores: np.ndarray,
+    seed: int = 0,
+) -> None:
+    """
+    Find the neighbours of `rows`, exactly, or in the cells near theirs when that would compare too many pairs
+
+    The cells come from a few rounds of k-means seeded with random repos, about the square root of the
+    number of repos of them, so each repo is compared with a few thousand others rather than all of them
+    """
+    if len(rows) * len(vectors) <= EXACT_PAIRS:
+        _nearest_among(vectors, rows, np.arange(len(vectors)), n, neighbours, scores)
+        return
+
+    rng = np.random.default_rng(seed)
+    cells = max(PROBE_CELLS, int(np.sqrt(len(vectors))))
+    centres = vectors[rng.choice(len(vectors), size=cells, replace=False)]
+    for _ in range(CELL_ITERATIONS):
+        assignment = _assign(vectors, centres)
+        sums = np.zeros_like(centres)
+        np.add.at(sums, assignment, vectors)
+        # a cell that lost every repo keeps its centre
+        occupied = np.bincount(assignment, minlength=cells) > 0
+        centres[occupied] = normalise(sums[occupied])
+    assignment = _assign(vectors, centres)
+
+    order = np.argsort(assignment, kind="stable")
+    members = np.split(order, np.cumsum(np.bincount(assignment, minlength=cells))[:-1])
+    nearby, _ = _top(centres @ centres.T, PROBE_CELLS)
+
+    row_cells = assignment[rows]
+    for cell in np.unique(row_cells):
+        _nearest_among(
+            vectors,
+            rows[row_cells == cell],
+            np.concatenate([members[other] for other in nearby[cell]]),
+            n,
+            neighbours,
+            scores,
+        )
+
+
+class NeighbourGraph:
+    """
+    The stars nearest to every star in the store, found at `read` time so `neighbours` only looks them up
+
+    Row i of `neighbours` holds the positions in `ids` of the repos most similar to `ids[i]`, best first,
+    padded with -1 when there are fewer. The content hash each repo's vector was made from is kept, so
+    the next read only searches again for the repos whose vectors changed or were near one that did
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        neighbours: np.ndarray,
+        scores: np.ndarray,
+        content_hashes: Sequence[str],
+    ):
+        self.ids = list(ids)
+        self.neighbours = neighbours
+        self.scores = scores
+        self.content_hashes = list(content_hashes)
+        self._positions = {repo_id: position for position, repo_id in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def width(self) -> int:
+        return self.neighbours.shape[1]
+
+    @classmethod
+    def build(
+        cls,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        content_hashes: Sequence[str],
+        n: int = GRAPH_NEIGHBOURS,
+        previous: Optional[NeighbourGraph] = None,
+    ) -> NeighbourGraph:
+        """
+        Find the `n` nearest neighbours of every repo, reusing the rows of `previous` that are still right
+
+        A repo's row is still right if neither its vector nor any of its neighbours' vectors changed. It
+        only has to be merged with the repos whose vectors are new, as none of the others can have
+        overtaken its neighbours
+        """
+        vectors = normalise(np.asarray(vectors, dtype=np.float32))
+        neighbours = np.full((len(ids), n), -1, dtype=np.int32)
+        scores = np.full((len(ids), n), -np.inf, dtype=np.float32)
+
+        previous_hashes = (
+            {}
+            if previous is None or previous.width < n
+            else dict(zip(previous.ids, previous.content_hashes))
+        )
+        changed = np.array(
+            [
+                position
+                for position, (repo_id, content_hash) in enumerate(
+                    zip(ids, content_hashes)
+                )
+                if previous_hashes.get(repo_id) != content_hash
+            ],
+            dtype=np.int64,
+        )
+        # merging every row with too many new vectors costs more than searching again
+        if len(changed) * len(ids) > EXACT_PAIRS:
+            changed = np.arange(len(ids))
+
+        kept = np.array([], dtype=np.int64)
+        if previous is not None and len(changed) < len(ids):
+            kept = cls._merge_kept_rows(
+                previous, ids, content_hashes, vectors, changed, neighbours, scores
+            )
+
+        searched = np.setdiff1d(np.arange(len(ids)), kept)
+        _nearest(vectors, searched, n, neighbours, scores)
+
+        logger.info(
+            "Built neighbour graph",
+            repos=len(ids),
+            searched=len(searched),
+            kept=len(kept),
+            exact=len(searched) * len(ids) <= EXACT_PAIRS,
+        )
+
+        return cls(ids, neighbours, scores, content_hashes)
+
+    @staticmethod
+    def _merge_kept_rows(
+        previous: NeighbourGraph,
+        ids: Sequence[str],
+        content_hashes: Sequence[str],
+        vectors: np.ndarray,
+        changed: np.ndarray,
+        neighbours: np.ndarray,
+        scores: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Carry over the rows of `previous` that are still right, merged with the changed repos
+
+        Returns the positions of the rows that were carried over
+        """
+        positions = {repo_id: position for position, repo_id in enumerate(ids)}
+        # where each of the previous graph's repos is now, or -1 if it is gone or its vector changed
+        moved = np.array(
+            [
+                (
+                    positions[repo_id]
+                    if repo_id in positions
+                    and content_hashes[positions[repo_id]] == content_hash
+                    else -1
+                )
+                for repo_id, content_hash in zip(previous.ids, previous.content_hashes)
+            ]
+            + [-1],
+            dtype=np.int64,
+        )
+
+        previous_rows = np.flatnonzero(moved[:-1] >= 0)
+        previous_rows = previous_rows[~np.isin(moved[previous_rows], changed)]
+        # -1 padding indexes the extra -1 at the end of `moved`
+        carried = moved[previous.neighbours[previous_rows, : neighbours.shape[1]]]
+        padding = previous.neighbours[previous_rows, : neighbours.shape[1]] == -1
+        still_right = np.all((carried >= 0) | padding, axis=1)
+        previous_rows, carried = previous_rows[still_right], carried[still_right]
+        rows = moved[previous_rows]
+
+        neighbours[rows] = carried
+        scores[rows] = previous.scores[previous_rows, : neighbours.shape[1]]
+
+        if len(changed) and len(rows):
+            block_rows = max(1, MAX_SCORES // (len(changed) + neighbours.shape[1]))
+            for start in range(0, len(rows), block_rows):
+                block = rows[start : start + block_rows]
+                merged = np.concatenate(
+                    [
+                        neighbours[block],
+                        np.broadcast_to(changed, (len(block), len(changed))),
+                    ],
+                    axis=1,
+                )
+                merged_scores = np.concatenate(
+                    [scores[block], vectors[block] @ vectors[changed].T], axis=1
+                )
+                top, top_scores = _top(merged_scores, neighbours.shape[1])
+                neighbours[block] = np.where(
+                    np.isfinite(top_scores),
+                    np.take_along_axis(merged, top, axis=1),
+                    -1,
+                )
+                scores[block] = top_scores
+
+        return rows
+
+    def save(self, vectorstore_path: str) -> None:
+        path = os.path.join(vectorstore_path, NEIGHBOURS_FILENAME)
+
+        # write then rename, so a query never loads a half written graph
+        with open(path + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                ids=np.array(self.ids, dtype=str),
+                neighbours=self.neighbours,
+                scores=self.scores,
+                content_hashes=np.array(self.content_hashes, dtype=str),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, vectorstore_path: str) -> Optional[NeighbourGraph]:
+        path = os.path.join(vectorstore_path, NEIGHBOURS_FILENAME)
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            return cls(
+                ids=arrays["ids"].tolist(),
+                neighbours=arrays["neighbours"],
+                scores=arrays["scores"],
+                content_hashes=arrays["content_hashes"].tolist(),
+            )
+
+    def lookup(
+        self,
+        repo_id: str,
+        k: int,
+        candidate_ids: Optional[Collection[str]] = None,
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        The `k` neighbours of a repo, optionally only those in `candidate_ids`
+
+        Returns None if the repo isn't in the graph, or its row runs out before `k` neighbours are found
+        while there could be more beyond it
+        """
+        if (position := self._positions.get(repo_id)) is None:
+            return None
+
+        matches = []
+        for column, (neighbour, score) in enumerate(
+            zip(self.neighbours[position], self.scores[position])
+        ):
+            if neighbour < 0:
+                # the row only ran out because every other repo is in it
+                return matches if column == len(self.ids) - 1 else None
+            if candidate_ids is None or self.ids[neighbour] in candidate_ids:
+                matches.append((self.ids[neighbour], float(score)))
+                if len(matches) == k:
+                    return matches
+
+        return None
+
+
+def build_neighbour_graph(
+    vectorstore: VectorStore,
+    manifest: Dict[str, Dict[str, str]],
+    previous: Optional[NeighbourGraph] = None,
+) -> NeighbourGraph:
+    """
+    Build the neighbour graph of every repo in the store from its stored vectors
+    """
+    ids, vectors = load_stored_vectors(vectorstore)
+
+    return NeighbourGraph.build(
+        ids, vectors, content_hashes(manifest, ids), previous=previous
+    )
@@ -0,0 +1,564 @@
+from __future__ import annotations
+
+import json
+import os
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import structlog
+from langchain.schema.document import Document
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+logger = structlog.get_logger(__name__)
+
+VECTORS_FILENAME = "starpilot-vectors.npy"
+DOCUMENTS_FILENAME = "starpilot-documents.json"
+JOURNAL_FILENAME = "starpilot-documents.jsonl"
+# the fewest rows the matrix file has room for once something is stored
+MIN_ROWS = 1024
+# the most distances a batch of queries holds at once, 64MB of float32
+MAX_DISTANCES = 2**24
+
+COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value is not None and value > target,
+    "$gte": lambda value, target: value is not None and value >= target,
+    "$lt": lambda value, target: value is not None and value < target,
+    "$lte": lambda value, target: value is not None and value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target,
+}
+
+
+class NumpyCollection:
+    """
+    Every vector in one contiguous `.npy` matrix, with ids, documents and metadata stored by column
+
+    Mirrors the parts of chromadb's `Collection` that starpilot uses, so syncing, the compact index
+    and the reports work the same against either store. The matrix is memory mapped when opened, so
+    opening costs nothing until a query touches the vectors.
+
+    Writes cost about as much as what they write, so a sync in batches stays linear in its size. The
+    matrix has room for more rows than are stored, doubling when it fills, and upserted vectors are
+    written into it in place. Changes to the columns are appended to a journal that is replayed on
+    opening, and folded into the columns file once it holds as many rows as the store.
+    """
+
+    def __init__(self, persist_directory: str):
+        self.persist_directory = persist_directory
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadata_columns: Dict[str, List[Any]] = {}
+        # every row of the file, including those past the stored ones kept for upserts
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._journalled = 0
+
+        documents_path = os.path.join(persist_directory, DOCUMENTS_FILENAME)
+        if os.path.exists(self._vectors_path):
+            self._matrix = np.load(self._vectors_path, mmap_mode="r")
+        # until the first time the whole store is written, its columns are all in the journal
+        if os.path.exists(documents_path):
+            with open(documents_path) as file:
+                columns = json.load(file)
+            self.ids = columns["ids"]
+            self.documents = columns["documents"]
+            self.metadata_columns = columns["metadatas"]
+
+        self._positions = {
+            repo_id: position for position, repo_id in enumerate(self.ids)
+        }
+        self._replay_journal()
+        self._squared_norms: Optional[np.ndarray] = None
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.persist_directory, VECTORS_FILENAME)
+
+    @property
+    def _journal_path(self) -> str:
+        return os.path.join(self.persist_directory, JOURNAL_FILENAME)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._matrix[: len(self.ids)]
+
+    def _replay_journal(self) -> None:
+        if not os.path.exists(self._journal_path):
+            return
+
+        with open(self._journal_path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the write was interrupted while appending this entry, whose vectors aren't counted
+                    break
+                self._apply(entry["ids"], entry.get("documents"), entry["metadatas"])
+                self._journalled += len(entry["ids"])
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _metadata(self, position: int) -> Dict:
+        # like chroma, keys a document doesn't have are left out rather than returned as None
+        return {
+            key: column[position]
+            for key, column in self.metadata_columns.items()
+            if column[position] is not None
+        }
+
+    def _matches(self, where: Dict, position: int) -> bool:
+        """
+        Evaluate a chroma `where` filter against one document's metadata
+        """
+        for key, condition in where.items():
+            if key == "$and":
+                if not all(self._matches(clause, position) for clause in condition):
+                    return False
+            elif key == "$or":
+                if not any(self._matches(clause, position) for clause in condition):
+                    return False
+            else:
+                column = self.metadata_columns.get(key)
+                value = None if column is None else column[position]
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                if not all(
+                    COMPARISONS[operator](value, target)
+                    for operator, target in condition.items()
+                ):
+                    return False
+        return True
+
+    def positions(
+        self, ids: Optional[Sequence[str]] = None, where: Optional[Dict] = None
+    ) -> np.ndarray:
+        """
+        The rows of the ids that exist and match the filter, in the order of `ids` if given
+        """
+        if ids is None:
+            candidates: Iterable[int] = range(len(self.ids))
+        else:
+            candidates = [
+                self._positions[repo_id]
+                for repo_id in ids
+                if repo_id in self._positions
+            ]
+
+        if where:
+            candidates = [
+                position for position in candidates if self._matches(where, position)
+            ]
+
+        return np.fromiter(candidates, dtype=np.int64)
+
+    def get(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        where: Optional[Dict] = None,
+        include: Sequence[str] = ("documents", "metadatas"),
+    ) -> Dict[str, Any]:
+        positions = self.positions(ids, where)
+
+        return {
+            "ids": [self.ids[position] for position in positions],
+            "embeddings": (
+                self.vectors[positions].tolist() if "embeddings" in include else None
+            ),
+            "documents": (
+                [self.documents[position] for position in positions]
+                if "documents" in include
+                else None
+            ),
+            "metadatas": (
+                [self._metadata(position) for position in positions]
+                if "metadatas" in include
+                else None
+            ),
+        }
+
+    def _set_metadata(self, position: int, metadata: Dict) -> None:
+        for key in metadata.keys() - self.metadata_columns.keys():
+            self.metadata_columns[key] = [None] * len(self.ids)
+        for key, column in self.metadata_columns.items():
+            column[position] = metadata.get(key)
+
+    def _apply(
+        self,
+        ids: Sequence[str],
+        documents: Optional[Sequence[str]],
+        metadatas: Sequence[Dict],
+    ) -> List[int]:
+        """
+        Write documents and metadata to the columns, adding rows for new ids, and return their rows
+
+        Without `documents` only the metadata of existing ids is changed, as `update` does
+        """
+        if documents is not None:
+            for repo_id in dict.fromkeys(ids):
+                if repo_id not in self._positions:
+                    self._positions[repo_id] = len(self.ids)
+                    self.ids.append(repo_id)
+                    self.documents.append("")
+                    for column in self.metadata_columns.values():
+                        column.append(None)
+
+        positions = [self._positions[repo_id] for repo_id in ids]
+        for index, (position, metadata) in enumerate(zip(positions, metadatas)):
+            if documents is not None:
+                self.documents[position] = documents[index]
+            self._set_metadata(position, metadata)
+
+        return positions
+
+    def _journal(
+        self, ids: Sequence[str], documents: Optional[Sequence[str]], metadatas
+    ) -> None:
+        """
+        Append a change to the journal, or write the whole store once the journal would outgrow it
+        """
+        self._squared_norms = None
+        self._journalled += len(ids)
+        if self._journalled > len(self.ids):
+            self.persist()
+            return
+
+        entry: Dict[str, Any] = {"ids": list(ids), "metadatas": list(metadatas)}
+        if documents is not None:
+            entry["documents"] = list(documents)
+        with open(self._journal_path, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def _reserve(self, rows: int, dimensions: int) -> None:
+        """
+        Make room in the matrix file for `rows` rows, doubling it when it is too small
+        """
+        if len(self._matrix) >= rows and self._matrix.shape[1] == dimensions:
+            if not self._matrix.flags.writeable:
+                self._matrix = np.load(self._vectors_path, mmap_mode="r+")
+            return
+
+        os.makedirs(self.persist_directory, exist_ok=True)
+        stored = np.asarray(self._matrix[: min(len(self._matrix), len(self.ids))])
+        matrix = np.lib.format.open_memmap(
+            self._vectors_path + ".tmp",
+            mode="w+",
+            dtype=np.float32,
+            shape=(max(rows, 2 * len(self._matrix), MIN_ROWS), dimensions),
+        )
+        if len(stored):
+            matrix[: len(stored)] = stored
+        matrix.flush()
+        del matrix
+        os.replace(self._vectors_path + ".tmp", self._vectors_path)
+        self._matrix = np.load(self._vectors_path, mmap_mode="r+")
+
+    def update(self, ids: Sequence[str], metadatas: Sequence[Dict]) -> None:
+        self._apply(ids, None, metadatas)
+        self._journal(ids, None, metadatas)
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        embeddings: np.ndarray,
+        documents: Sequence[str],
+        metadatas: Sequence[Dict],
+    ) -> None:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        new = len(set(ids) - self._positions.keys())
+        self._reserve(len(self.ids) + new, embeddings.shape[1])
+
+        # the vectors go in first, so a journal entry is never replayed without them
+        positions = self._apply(ids, documents, metadatas)
+        self._matrix[positions] = embeddings
+        self._matrix.flush()
+        self._journal(ids, documents, metadatas)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        drop = set(self.positions(ids).tolist())
+        if not drop:
+            return
+
+        keep = [position for position in range(len(self.ids)) if position not in drop]
+        self._matrix = np.asarray(self.vectors)[keep]
+        self.ids = [self.ids[position] for position in keep]
+        self.documents = [self.documents[position] for position in keep]
+        self.metadata_columns = {
+            key: [column[position] for position in keep]
+            for key, column in self.metadata_columns.items()
+        }
+        self._positions = {
+            repo_id: position for position, repo_id in enumerate(self.ids)
+        }
+        self.persist()
+
+    def persist(self) -> None:
+        """
+        Write the stored rows of the matrix and the columns, and start a new journal
+
+        Both are renamed into place, so readers never see half a write
+        """
+        os.makedirs(self.persist_directory, exist_ok=True)
+        documents_path = os.path.join(self.persist_directory, DOCUMENTS_FILENAME)
+
+        with open(self._vectors_path + ".tmp", "wb") as file:
+            np.save(file, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        with open(documents_path + ".tmp", "w") as file:
+            json.dump(
+                {
+                    "ids": self.ids,
+                    "documents": self.documents,
+                    "metadatas": self.metadata_columns,
+                },
+                file,
+            )
+        os.replace(self._vectors_path + ".tmp", self._vectors_path)
+        os.replace(documents_path + ".tmp", documents_path)
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+        self._matrix = np.load(self._vectors_path, mmap_mode="r")
+        self._journalled = 0
+        self._squared_norms = None
+
+    def query(
+        self, embedding: np.ndarray, n_results: int, where: Optional[Dict] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        The rows nearest to `embedding` and their squared L2 distances, the metric chroma uses by default
+        """
+        return self.query_batch(np.asarray(embedding)[np.newaxis], n_results, where)[0]
+
+    def query_batch(
+        self, embeddings: np.ndarray, n_results: int, where: Optional[Dict] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        The rows nearest to each of `embeddings`, scoring every embedding in one matrix product
+
+        Embeddings are scored in blocks, so the distances held at once stay under `MAX_DISTANCES`
+        """
+        if self._squared_norms is None:
+            self._squared_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
+        if where:
+            positions = self.positions(where=where)
+            vectors, squared_norms = (
+                self.vectors[positions],
+                self._squared_norms[positions],
+            )
+        else:
+            positions = None
+            vectors, squared_norms = self.vectors, self._squared_norms
+
+        if len(vectors) == 0:
+            return [[] for _ in embeddings]
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n_results = min(n_results, len(vectors))
+        block_size = max(1, MAX_DISTANCES // len(vectors))
+        nearest_rows: List[List[Tuple[int, float]]] = []
+
+        for start in range(0, len(embeddings), block_size):
+            block = embeddings[start : start + block_size]
+            distances = (
+                squared_norms[:, np.newaxis]
+                - 2 * (vectors @ block.T)
+                + np.einsum("ij,ij->i", block, block)
+            )
+            np.maximum(distances, 0, out=distances)
+
+            nearest = np.argpartition(distances, n_results - 1, axis=0)[:n_results]
+            nearest = np.take_along_axis(
+                nearest,
+                np.argsort(np.take_along_axis(distances, nearest, axis=0), axis=0),
+                axis=0,
+            )
+
+            for column in range(len(block)):
+                rows = nearest[:, column]
+                nearest_rows.append(
+                    [
+                        (
+                            int(positions[row] if positions is not None else row),
+                            float(distances[row, column]),
+                        )
+                        for row in rows
+                    ]
+                )
+
+        return nearest_rows
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    An exact search vectorstore over a `NumpyCollection`, for collections small enough to scan
+
+    Searches are one matrix product and an `argpartition`, and return the same documents, distances
+    and relevance scores as the chroma store would, so either can back `shoot` and `astrologer`.
+    """
+
+    def __init__(self, persist_directory: str, embedding_function: Embeddings):
+        self._embedding_function = embedding_function
+        self._collection = NumpyCollection(persist_directory)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[Dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+
+        self._collection.upsert(
+            ids=ids,
+            embeddings=np.array(
+                self._embedding_function.embed_documents(texts), dtype=np.float32
+            ),
+            documents=texts,
+            metadatas=metadatas,
+        )
+
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self._collection.delete(ids or [])
+
+    def _document(self, position: int) -> Document:
+        return Document(
+            page_content=self._collection.documents[position],
+            metadata=self._collection._metadata(position),
+        )
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict] = None
+    ) -> List[Tuple[Document, float]]:
+        return [
+            (self._document(position), distance)
+            for position, distance in self._collection.query(
+                np.asarray(embedding), k, where=filter
+            )
+        ]
+
+    def similarity_search_by_vectors(
+        self, embeddings: np.ndarray, k: int = 4, filter: Optional[Dict] = None
+    ) -> List[List[Document]]:
+        """
+        The documents nearest to each of `embeddings`, searched together in one matrix product
+        """
+        return [
+            [self._document(position) for position, _ in nearest]
+            for nearest in self._collection.query_batch(embeddings, k, where=filter)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[Dict] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self._embedding_function.embed_query(query), k, filter
+        )
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_by_vector_with_score(
+                embedding, k, filter
+            )
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[Dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(query, k, filter)
+        ]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # the same distance as chroma, so score thresholds mean the same in either store
+        return self._euclidean_relevance_score_fn
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        candidates = [
+            position
+            for position, _ in self._collection.query(
+                np.asarray(embedding), fetch_k, where=filter
+            )
+        ]
+        if not candidates:
+            return []
+
+        selected = maximal_marginal_relevance(
+            np.array(embedding, dtype=np.float32),
+            self._collection.vectors[candidates],
+            k=k,
+            lambda_mult=lambda_mult,
+        )
+
+        # in the order they were fetched, as chroma returns them
+        return [
+            self._document(position)
+            for index, position in enumerate(candidates)
+            if index in selected
+        ]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding_function.embed_query(query),
+            k,
+            fetch_k,
+            lambda_mult,
+            filter,
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[Dict]] = None,
+        ids: Optional[List[str]] = None,
+        persist_directory: str = "./vectorstore-numpy",
+        **kwargs: Any,
+    ) -> NumpyVectorStore:
+        vectorstore = cls(
+            persist_directory=persist_directory, embedding_function=embedding
+        )
+        vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
+        return vectorstore
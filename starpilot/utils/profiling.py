@@ -0,0 +1,224 @@
+import functools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+PROFILE_DIR = "./starpilot-profiles"
+
+_lock = threading.Lock()
+# spans open in any thread, so counts recorded from the GitHub fetch thread reach the stage waiting on it
+_open_spans: List["Span"] = []
+_run: Optional["Run"] = None
+
+
+def peak_rss_mb() -> float:
+    """
+    The most memory the process has held so far, in megabytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+class Span:
+    """
+    One timed stage, with counts of what it handled: items, bytes, API calls, retries
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts: Counter = Counter()
+
+    def add(self, **counts: float) -> None:
+        with _lock:
+            self.counts.update(counts)
+
+
+class Run:
+    """
+    The spans of one command, totalled by stage
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started_at = datetime.now(timezone.utc)
+        self.seconds = 0.0
+        self.failed = False
+        self.stages: Dict[str, Dict] = {}
+
+    def add(self, span: Span, seconds: float, peak_rss: float) -> None:
+        with _lock:
+            stage = self.stages.setdefault(
+                span.name, {"calls": 0, "seconds": 0.0, "counts": Counter()}
+            )
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["counts"].update(span.counts)
+            stage["peak_rss_mb"] = peak_rss
+
+    def summary(self) -> Dict:
+        try:
+            from importlib.metadata import version
+
+            starpilot_version = version("starpilot")
+        except Exception:
+            starpilot_version = None
+
+        return {
+            "command": self.command,
+            "arguments": sys.argv[1:],
+            "started_at": self.started_at.isoformat(),
+            "seconds": self.seconds,
+            "failed": self.failed,
+            "peak_rss_mb": peak_rss_mb(),
+            "starpilot_version": starpilot_version,
+            "machine": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "processor": platform.machine(),
+                "cpu_count": os.cpu_count(),
+            },
+            "stages": {
+                name: {
+                    "calls": stage["calls"],
+                    "seconds": stage["seconds"],
+                    "peak_rss_mb": stage["peak_rss_mb"],
+                    **stage["counts"],
+                }
+                for name, stage in self.stages.items()
+            },
+        }
+
+
+@contextmanager
+def span(name: str, **counts: float) -> Iterator[Span]:
+    """
+    Time a stage, logging how long it took, its counts and the peak memory once it finishes
+
+    Counts can be added to the yielded span as the stage goes, and `record` adds them to every open span
+    """
+    current = Span(name)
+    current.add(**counts)
+    with _lock:
+        _open_spans.append(current)
+
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _open_spans.remove(current)
+        peak_rss = peak_rss_mb()
+
+        logger.debug(
+            "Finished stage",
+            stage=name,
+            seconds=round(seconds, 4),
+            peak_rss_mb=round(peak_rss, 1),
+            **current.counts,
+        )
+        if _run is not None:
+            _run.add(current, seconds, peak_rss)
+
+
+def record(**counts: float) -> None:
+    """
+    Add counts, like API calls or retries, to every stage that is running, from any thread
+    """
+    with _lock:
+        for open_span in _open_spans:
+            open_span.counts.update(counts)
+
+
+@contextmanager
+def profile_run(
+    command: str, profile: bool = False, profile_dir: str = PROFILE_DIR
+) -> Iterator[Run]:
+    """
+    Total the spans of a command and log them per stage when it finishes
+
+    With `profile`, the command also runs under cProfile, and its stats (open them with `snakeviz`)
+    and a JSON summary of the run are written to `profile_dir`
+    """
+    global _run
+
+    run = Run(command)
+    _run = run
+
+    profiler = None
+    if profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield run
+    except BaseException:
+        run.failed = True
+        raise
+    finally:
+        run.seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        _run = None
+
+        for name, stage in run.stages.items():
+            logger.info(
+                "Stage timing",
+                command=command,
+                stage=name,
+                calls=stage["calls"],
+                seconds=round(stage["seconds"], 3),
+                peak_rss_mb=round(stage["peak_rss_mb"], 1),
+                **stage["counts"],
+            )
+
+        if profiler is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            name = f"{command}-{run.started_at:%Y%m%d-%H%M%S}-{os.getpid()}"
+            stats_path = os.path.join(profile_dir, f"{name}.prof")
+            summary_path = os.path.join(profile_dir, f"{name}.json")
+
+            profiler.dump_stats(stats_path)
+            with open(summary_path, "w") as file:
+                json.dump(run.summary(), file, indent=2)
+
+            logger.info(
+                "Saved profile",
+                stats=stats_path,
+                summary=summary_path,
+                view=f"snakeviz {stats_path}",
+            )
+
+
+def profiled(command: str) -> Callable:
+    """
+    Run a typer command inside `profile_run`, profiling it when it is called with `profile=True`
+
+    The command keeps its own signature, so typer still sees its `--profile` option
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_run(command, profile=kwargs.get("profile", False)):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
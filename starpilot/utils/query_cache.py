@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+import structlog
+
+from starpilot.utils.utils import CACHE_DIR
+
+logger = structlog.get_logger(__name__)
+
+RESULT_CACHE_PATH = os.path.join(CACHE_DIR, "results.sqlite3")
+PARSED_QUERY_CACHE_PATH = os.path.join(CACHE_DIR, "parsed_queries.sqlite3")
+
+
+def normalise_query(query: str) -> str:
+    """
+    Collapse differences in case and whitespace that don't change what a query asks for
+    """
+    return " ".join(query.split()).lower()
+
+
+class JsonCache:
+    """
+    A persistent, size limited, least recently used store of JSON values, in one sqlite table
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int = 10_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        start = time.perf_counter()
+
+        row = self._connection.execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self._connection.execute(
+            f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._connection.commit()
+        self.hits += 1
+
+        value = json.loads(row[0])
+
+        logger.info(
+            "Query cache",
+            cache=self.table,
+            hit=True,
+            latency_ms=round((time.perf_counter() - start) * 1000, 2),
+            hit_rate=self.hit_rate,
+        )
+
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self._connection.execute(
+            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time()),
+        )
+
+        (count,) = self._connection.execute(
+            f"SELECT COUNT(*) FROM {self.table}"
+        ).fetchone()
+        if (excess := count - self.max_entries) > 0:
+            self._connection.execute(
+                f"""
+                DELETE FROM {self.table} WHERE rowid IN (
+                    SELECT rowid FROM {self.table} ORDER BY last_used, rowid LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+
+        self._connection.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class QueryResultCache(JsonCache):
+    """
+    Query results, keyed by the store's version as well as the query
+
+    `read` gives the store a new version every time it writes to it, so a cached result is never
+    older than the store it came from
+    """
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_entries: int = 10_000):
+        super().__init__(path, "results", max_entries)
+
+    @staticmethod
+    def key(
+        vectorstore_path: str, store_version: str, command: str, payload: Dict
+    ) -> str:
+        """
+        The cache key of a query against a version of a store
+        """
+        parameters = {**payload, "query": normalise_query(payload["query"])}
+        return hashlib.sha256(
+            json.dumps(
+                [os.path.abspath(vectorstore_path), store_version, command, parameters],
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+
+class ParsedQueryCache(JsonCache):
+    """
+    Structured queries the LLM has parsed, keyed by the normalised query and the model that parsed it
+    """
+
+    def __init__(self, path: str = PARSED_QUERY_CACHE_PATH, max_entries: int = 10_000):
+        super().__init__(path, "parsed_queries", max_entries)
+
+    @staticmethod
+    def key(model: str, query: str) -> str:
+        return f"{model}:{normalise_query(query)}"
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import structlog
+from langchain.chains.query_constructor.ir import (
+    Comparator,
+    Comparison,
+    FilterDirective,
+    Operation,
+    Operator,
+    StructuredQuery,
+)
+from langchain_core.runnables import Runnable
+
+from starpilot.utils.query_cache import ParsedQueryCache
+
+logger = structlog.get_logger(__name__)
+
+# the model that parses the queries the rules can't, parses are memoised per model
+QUERY_CONSTRUCTOR_MODEL = "gpt-3.5-turbo"
+
+# words for a language's package ecosystem, e.g. "Dataframe crates"
+LANGUAGE_ALIASES = {
+    "crate": "Rust",
+    "crates": "Rust",
+    "gem": "Ruby",
+    "gems": "Ruby",
+    "npm": "JavaScript",
+    "cran": "R",
+    "pypi": "Python",
+    "golang": "Go",
+}
+
+# words that say what kind of result is wanted, rather than what it should be about
+FILLER_WORDS = {
+    "a",
+    "all",
+    "an",
+    "any",
+    "are",
+    "can",
+    "do",
+    "does",
+    "find",
+    "for",
+    "i",
+    "in",
+    "is",
+    "libraries",
+    "library",
+    "me",
+    "my",
+    "of",
+    "or",
+    "package",
+    "packages",
+    "project",
+    "projects",
+    "repo",
+    "repos",
+    "repositories",
+    "repository",
+    "show",
+    "some",
+    "suggest",
+    "that",
+    "the",
+    "to",
+    "tool",
+    "tools",
+    "use",
+    "using",
+    "what",
+    "which",
+    "with",
+    "written",
+}
+
+# words that exclude what follows them, e.g. "web frameworks not in Go"
+NEGATION_WORDS = {"not", "without", "except", "excluding", "no"}
+NEGATION = re.compile(
+    rf"\b(?:{'|'.join(sorted(NEGATION_WORDS))})\s+(?:(?:in|written in|using)\s+)?$",
+    flags=re.IGNORECASE,
+)
+
+LIST_SEPARATOR = re.compile(r"\s*,?\s*(?:or|and|nor)?\s*", flags=re.IGNORECASE)
+
+NUMBER = r"(\d[\d,]*(?:\.\d+)?k?)"
+STAR_PATTERNS = [
+    (rf"(?:at least|minimum of)\s+{NUMBER}\s+stars?", Comparator.GTE),
+    (rf"{NUMBER}\s+stars?\s+or\s+more", Comparator.GTE),
+    (rf"{NUMBER}\+\s*stars?", Comparator.GTE),
+    (rf"(?:more than|over)\s+{NUMBER}\s+stars?", Comparator.GT),
+    (rf"(?:fewer than|less than|under)\s+{NUMBER}\s+stars?", Comparator.LT),
+    (rf"{NUMBER}\s+stars?\s+or\s+(?:fewer|less)", Comparator.LTE),
+]
+
+
+def _parse_number(text: str) -> int:
+    text = text.replace(",", "")
+    if text.endswith("k"):
+        return int(float(text[:-1]) * 1000)
+    return int(float(text))
+
+
+def _word_pattern(word: str) -> str:
+    # language and topic names can contain characters like + # . and -
+    return rf"(?<![\w+#.-]){re.escape(word)}(?![\w+#-])"
+
+
+def parse_query(
+    query: str, vocabulary: Dict[str, List[str]]
+) -> Optional[StructuredQuery]:
+    """
+    Parse the common shapes of query without an LLM
+
+    Recognises languages and topics from the store's vocabulary, ecosystem words like "crates", and
+    star counts like "100 stars or more". A language right after a word like "not" or "without" is
+    excluded rather than wanted. Returns None when none of them are in the query, or it negates
+    something else, so the LLM can have a go instead.
+    """
+    text = " ".join(query.split())
+    filters: List[FilterDirective] = []
+    recognised = False
+
+    for pattern, comparator in STAR_PATTERNS:
+        if match := re.search(pattern, text, flags=re.IGNORECASE):
+            filters.append(
+                Comparison(
+                    comparator=comparator,
+                    attribute="stargazerCount",
+                    value=_parse_number(match.group(1).lower()),
+                )
+            )
+            text = text[: match.start()] + " " + text[match.end() :]
+            recognised = True
+            break
+
+    names = {language.lower(): language for language in vocabulary["languages"]}
+    names.update(
+        (alias, language)
+        for alias, language in LANGUAGE_ALIASES.items()
+        if alias not in names
+    )
+    # where each language is mentioned, found longest first so "Jupyter Notebook" is found before anything
+    # it contains, and blanked out of `masked` so nothing shorter is found inside it
+    mentions: List[Tuple[int, int, int, str]] = []
+    masked = text
+    for rank, name in enumerate(sorted(names, key=len, reverse=True)):
+        language = names[name]
+        # short names like R, C and Go are also everyday words, so they have to be written in capitals
+        if len(name) <= 2:
+            pattern, flags = _word_pattern(language), 0
+        else:
+            pattern, flags = _word_pattern(name), re.IGNORECASE
+        for match in re.finditer(pattern, masked, flags=flags):
+            mentions.append((match.start(), match.end(), rank, language))
+            masked = (
+                masked[: match.start()]
+                + " " * (match.end() - match.start())
+                + masked[match.end() :]
+            )
+
+    # read in order, as a negation carries on through a list like "not in Rust or Go"
+    wanted: Dict[str, int] = {}
+    excluded: Dict[str, int] = {}
+    kept: List[str] = []
+    negated = False
+    previous_end = 0
+    for start, end, rank, language in sorted(mentions):
+        gap = text[previous_end:start]
+        if negation := NEGATION.search(gap):
+            negated = True
+            kept.append(gap[: negation.start()])
+        elif not (negated and LIST_SEPARATOR.fullmatch(gap)):
+            negated = False
+            kept.append(gap)
+        found = excluded if negated else wanted
+        found[language] = min(found.get(language, rank), rank)
+        previous_end = end
+    text = " ".join(kept + [text[previous_end:]])
+
+    # longest name first, as they were found
+    languages = sorted(wanted, key=wanted.__getitem__)
+    if languages:
+        recognised = True
+        comparisons: List[FilterDirective] = [
+            Comparison(
+                comparator=Comparator.EQ, attribute="primaryLanguage", value=language
+            )
+            for language in languages
+        ]
+        filters.append(
+            comparisons[0]
+            if len(comparisons) == 1
+            else Operation(operator=Operator.OR, arguments=comparisons)
+        )
+
+    if excluded:
+        recognised = True
+        filters.extend(
+            Comparison(
+                comparator=Comparator.NE, attribute="primaryLanguage", value=language
+            )
+            for language in sorted(excluded, key=excluded.__getitem__)
+        )
+
+    # topics stay in the query text, they are what the repos should be about
+    for topic in vocabulary["topics"]:
+        if re.search(_word_pattern(topic), text, flags=re.IGNORECASE) or (
+            "-" in topic
+            and re.search(
+                _word_pattern(topic.replace("-", " ")), text, flags=re.IGNORECASE
+            )
+        ):
+            recognised = True
+            break
+
+    if not recognised:
+        return None
+
+    words = re.findall(r"[\w+#.-]+", text)
+    # what is negated isn't a language, so only the LLM can tell what to leave out
+    if any(word.lower() in NEGATION_WORDS for word in words):
+        return None
+
+    words = [word for word in words if word.lower().strip(".") not in FILLER_WORDS]
+    search = " ".join(words).strip(" .?!") or " ".join(query.split())
+
+    if not filters:
+        filter = None
+    elif len(filters) == 1:
+        filter = filters[0]
+    else:
+        filter = Operation(operator=Operator.AND, arguments=filters)
+
+    return StructuredQuery(query=search, filter=filter, limit=None)
+
+
+def filter_to_dict(filter: Optional[FilterDirective]) -> Optional[Dict]:
+    if filter is None:
+        return None
+    if isinstance(filter, Comparison):
+        return {
+            "comparator": filter.comparator.value,
+            "attribute": filter.attribute,
+            "value": filter.value,
+        }
+    return {
+        "operator": filter.operator.value,  # type: ignore
+        "arguments": [filter_to_dict(argument) for argument in filter.arguments],  # type: ignore
+    }
+
+
+def filter_from_dict(filter: Optional[Dict]) -> Optional[FilterDirective]:
+    if filter is None:
+        return None
+    if "comparator" in filter:
+        return Comparison(
+            comparator=Comparator(filter["comparator"]),
+            attribute=filter["attribute"],
+            value=filter["value"],
+        )
+    return Operation(
+        operator=Operator(filter["operator"]),
+        arguments=[filter_from_dict(argument) for argument in filter["arguments"]],  # type: ignore
+    )
+
+
+def construct_query(
+    query: str,
+    vocabulary: Dict[str, List[str]],
+    create_query_constructor: Callable[[], Runnable],
+    model: str,
+    cache: Optional[ParsedQueryCache] = None,
+) -> Tuple[StructuredQuery, str]:
+    """
+    Turn a query into a structured query, trying the local parser, then earlier LLM answers, then the LLM
+
+    Returns the structured query and which of the three produced it
+    """
+    if (structured_query := parse_query(query, vocabulary)) is not None:
+        return structured_query, "rules"
+
+    cache = cache if cache is not None else ParsedQueryCache()
+    key = ParsedQueryCache.key(model, query)
+
+    if (cached := cache.get(key)) is not None:
+        return (
+            StructuredQuery(
+                query=cached["query"],
+                filter=filter_from_dict(cached["filter"]),
+                limit=cached["limit"],
+            ),
+            "cache",
+        )
+
+    structured_query = create_query_constructor().invoke({"query": query})
+    cache.put(
+        key,
+        {
+            "query": structured_query.query,
+            "filter": filter_to_dict(structured_query.filter),
+            "limit": structured_query.limit,
+        },
+    )
+
+    return structured_query, "llm"
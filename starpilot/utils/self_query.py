@@ -0,0 +1,209 @@
+import os
+from typing import Dict, Optional, Tuple
+
+import structlog
+from langchain.chains.query_constructor.base import (
+    StructuredQueryOutputParser,
+    get_query_constructor_prompt,
+)
+from langchain.chains.query_constructor.ir import (
+    Comparator,
+    Comparison,
+    FilterDirective,
+    Operation,
+    Operator,
+    StructuredQuery,
+)
+from langchain.chains.query_constructor.schema import AttributeInfo
+from langchain.retrievers.self_query.chroma import ChromaTranslator
+from langchain_core.runnables import Runnable
+
+from starpilot.utils.query_parser import QUERY_CONSTRUCTOR_MODEL
+
+logger = structlog.get_logger(__name__)
+
+
+def create_query_constructor() -> Runnable:
+    """
+    Create the LLM chain that turns a natural language query into a structured query
+    """
+    # only loaded when a query needs the LLM, the rules parser and `translate_query` don't
+    from langchain_openai import ChatOpenAI
+
+    OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+    OPENAI_ORG_ID = os.environ["OPENAI_ORG_ID"]
+
+    metadata_field_info = [
+        # IDEA: create valid specific example values on data load for each users content
+        AttributeInfo(
+            name="primaryLanguage",
+            description="the main programming language of a repo. Example: 'Python'",
+            type="string",
+        ),
+        AttributeInfo(
+            name="languages",
+            description="all the programming languages of a repo, filter with contain or in. Example: ['Python', 'R', 'Rust']",
+            type="list[string]",
+        ),
+        AttributeInfo(
+            name="owner",
+            description="the user or organisation that owns a repo. Example: 'tidyverse'",
+            type="string",
+        ),
+        AttributeInfo(
+            name="name",
+            description="the name of a repository. Example: 'langchain'",
+            type="string",
+        ),
+        AttributeInfo(
+            name="topics",
+            description="the topics a repository is tagged with, filter with contain or in. Example: ['data-science', 'machine-learning', 'web-development', 'tidyverse']",
+            type="list[string]",
+        ),
+        AttributeInfo(
+            name="url",
+            description="the url of a repository on GitHub",
+            type="string",
+        ),
+        AttributeInfo(
+            name="stargazerCount",
+            description="the number of stars a repository has on GitHub",
+            type="number",
+        ),
+    ]
+
+    document_content_description = "content describing a repository on GitHub"
+
+    llm = ChatOpenAI(
+        api_key=OPENAI_API_KEY,  # type: ignore
+        organization=OPENAI_ORG_ID,
+        model=QUERY_CONSTRUCTOR_MODEL,
+    )
+
+    # https://python.langchain.com/docs/modules/data_connection/retrievers/self_query#constructing-from-scratch-with-lcel
+    # https://github.com/langchain-ai/langchain/blob/master/cookbook/self_query_hotel_search.ipynb
+
+    prompt = get_query_constructor_prompt(
+        document_content_description,
+        metadata_field_info,
+        examples=[
+            (
+                "Python machine learning repos",
+                {
+                    "query": "machine learning",
+                    "filter": 'eq("primaryLanguage", "Python")',
+                },
+            ),
+            (
+                "Dataframe crates",
+                {"query": "data frame", "filter": 'eq("primaryLanguage", "Rust")'},
+            ),
+            (
+                "Web server gems",
+                {"query": "web server", "filter": 'eq("primaryLanguage", "Ruby")'},
+            ),
+            (
+                "date parsing npm packages",
+                {
+                    "query": "date parsing",
+                    "filter": 'eq("primaryLanguage", "JavaScript")',
+                },
+            ),
+            (
+                "What R packages do time series analysis",
+                {"query": "time series", "filter": 'eq("primaryLanguage", "R")'},
+            ),
+            (
+                "draw a graph of data in Python",
+                {"query": "graph", "filter": 'eq("primaryLanguage", "Python")'},
+            ),
+            (
+                "web app with R",
+                {"query": "web app", "filter": 'eq("primaryLanguage", "R")'},
+            ),
+            (
+                "functional programming CRAN",
+                {
+                    "query": "functional programming",
+                    "filter": 'eq("primaryLanguage", "R")',
+                },
+            ),
+            (
+                "data frame packages with 100 stars or more",
+                {
+                    "query": "data frame",
+                    "filter": 'gte("stargazerCount", 100)',
+                },
+            ),
+            (
+                "repos tagged tidyverse that use C++ or Rust",
+                {
+                    "query": "tidyverse",
+                    "filter": 'and(contain("topics", "tidyverse"), in("languages", ["C++", "Rust"]))',
+                },
+            ),
+        ],
+        allowed_comparators=[
+            Comparator.EQ,
+            Comparator.NE,
+            Comparator.GT,
+            Comparator.GTE,
+            Comparator.LT,
+            Comparator.LTE,
+            # topics and languages hold several values each, they are matched by the facet index
+            Comparator.CONTAIN,
+            Comparator.IN,
+        ],
+    )
+
+    output_parser = StructuredQueryOutputParser.from_components()
+
+    query_constructor = prompt | llm | output_parser
+
+    return query_constructor
+
+
+def _store_filter(filter: Optional[FilterDirective]) -> Optional[FilterDirective]:
+    """
+    The part of a filter that a `where` filter can express, dropping the clauses it can't
+
+    `contain` and `in` are only matched by the facet index, and the stores can't evaluate them on
+    other attributes. A clause is dropped by no longer filtering on it, so an `and` keeps its other
+    arguments, while an `or` or a `not` with any clause dropped is dropped whole
+    """
+    if filter is None:
+        return None
+
+    if isinstance(filter, Comparison):
+        if filter.comparator in ChromaTranslator.allowed_comparators:
+            return filter
+    elif isinstance(filter, Operation):
+        arguments = [_store_filter(argument) for argument in filter.arguments]
+        if filter.operator is Operator.AND:
+            kept = [argument for argument in arguments if argument is not None]
+            if len(kept) > 1:
+                return Operation(operator=Operator.AND, arguments=kept)
+            return kept[0] if kept else None
+        if filter.operator is Operator.OR and all(
+            argument is not None for argument in arguments
+        ):
+            return Operation(operator=Operator.OR, arguments=arguments)
+
+    logger.warning("Searching without a filter the store can't evaluate", filter=filter)
+    return None
+
+
+def translate_query(structured_query: StructuredQuery) -> Tuple[str, Optional[Dict]]:
+    """
+    Turn a structured query into the text to search for and a Chroma `where` filter
+
+    Clauses the facet index didn't resolve and the stores can't evaluate are left out of the filter
+    """
+    new_query, search_kwargs = ChromaTranslator().visit_structured_query(
+        StructuredQuery(
+            query=structured_query.query,
+            filter=_store_filter(structured_query.filter),
+            limit=structured_query.limit,
+        )
+    )
+    return new_query, search_kwargs.get("filter")
@@ -0,0 +1,695 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+
+import structlog
+
+import starpilot.utils.generations as generations
+import starpilot.utils.profiling as profiling
+import starpilot.utils.sync as sync
+import starpilot.utils.utils as utils
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+    from langchain_core.runnables import Runnable
+
+    from starpilot.utils.compact import CompactIndex
+    from starpilot.utils.facets import FacetIndex
+    from starpilot.utils.lexical import LexicalIndex
+    from starpilot.utils.neighbours import NeighbourGraph
+    from starpilot.utils.query_cache import ParsedQueryCache
+
+logger = structlog.get_logger(__name__)
+
+# how many results from each of the vector and lexical searches are fused by a hybrid search
+HYBRID_DEPTH = 50
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_URL = os.environ.get(
+    "STARPILOT_SERVER_URL", f"http://{SERVER_HOST}:{SERVER_PORT}"
+)
+
+
+class QueryEngine:
+    """
+    Answers `shoot` and `astrologer` queries, keeping the vectorstore and clients loaded between queries
+
+    The vectorstore is reopened whenever `read` has published a new generation of it, or rewritten
+    the manifest of a store from before generations
+    """
+
+    def __init__(self, vectorstore_path: str):
+        self.vectorstore_path = vectorstore_path
+        self.store_path: Optional[str] = None
+        self._manifest_mtime: Optional[float] = None
+        self._query_constructor: Optional[Runnable] = None
+        self._parsed_query_cache: Optional[ParsedQueryCache] = None
+        self.compact_index: Optional[CompactIndex] = None
+        self.lexical_index: Optional[LexicalIndex] = None
+        self.facet_index: Optional[FacetIndex] = None
+        self.neighbour_graph: Optional[NeighbourGraph] = None
+        self._load()
+
+    def _manifest_path(self) -> str:
+        return os.path.join(str(self.store_path), sync.MANIFEST_FILENAME)
+
+    def _load(self) -> None:
+        if (store_path := generations.current_path(self.vectorstore_path)) is None:
+            raise Exception("Please load the stars before shooting")
+        self.store_path = store_path
+
+        with profiling.span("load"):
+            self.embedding_backend = utils.check_embedding_backend(store_path)
+            self.vectorstore = utils.open_vectorstore(
+                store_path, self.embedding_backend
+            )
+            # stores read with --quantisation are searched through their compact index
+            from starpilot.utils.compact import CompactIndex
+            from starpilot.utils.facets import FacetIndex
+            from starpilot.utils.lexical import LexicalIndex
+            from starpilot.utils.neighbours import NeighbourGraph
+            from starpilot.utils.vocabulary import load_vocabulary
+
+            self.compact_index = CompactIndex.load(store_path)
+            self.lexical_index = LexicalIndex.load(store_path)
+            self.facet_index = FacetIndex.load(store_path)
+            self.neighbour_graph = NeighbourGraph.load(store_path)
+            self.vocabulary = load_vocabulary(store_path)
+            self.users = sync.load_users(store_path)
+            if os.path.exists(self._manifest_path()):
+                self._manifest_mtime = os.path.getmtime(self._manifest_path())
+
+    def _refresh(self) -> None:
+        if generations.current_path(self.vectorstore_path) != self.store_path or (
+            os.path.exists(self._manifest_path())
+            and os.path.getmtime(self._manifest_path()) != self._manifest_mtime
+        ):
+            logger.info("Vectorstore changed, reloading", path=self.vectorstore_path)
+            self._load()
+
+    def _check_embedding_backend(self, embedding_backend: Optional[str]) -> None:
+        if embedding_backend is not None:
+            utils.check_embedding_backend(
+                str(self.store_path), utils.EmbeddingBackends(embedding_backend)
+            )
+
+    def shoot(
+        self,
+        query: str,
+        method: str = "similarity",
+        k: int = 3,
+        embedding_backend: Optional[str] = None,
+        rerank: int = 0,
+        user: Optional[str] = None,
+    ) -> List[Document]:
+        self._refresh()
+        self._check_embedding_backend(embedding_backend)
+        where = self._user_filter(user)
+
+        if method == "similarity":
+            return self._similarity_search(query, k, rerank, where)
+        if method == "lexical":
+            return utils.get_documents(
+                self.vectorstore,
+                [repo_id for repo_id, _ in self._lexical_search(query, k, user)],
+            )
+        if method == "hybrid":
+            return self._hybrid_search(query, k, rerank, user)
+
+        search_kwargs: Dict = {"k": k}
+        if where is not None:
+            search_kwargs["filter"] = where
+        retriever = self.vectorstore.as_retriever(
+            search_type=method, search_kwargs=search_kwargs
+        )
+        return retriever.get_relevant_documents(query)
+
+    def shoot_batch(
+        self,
+        queries: List[str],
+        method: str = "similarity",
+        k: int = 3,
+        embedding_backend: Optional[str] = None,
+        rerank: int = 0,
+        user: Optional[str] = None,
+    ) -> List[List[Document]]:
+        """
+        Answer many `shoot` queries at once, embedding them in one batch and scoring them together
+
+        Lexical searches need no embedding, and the other methods are answered one query at a time
+        """
+        self._refresh()
+        self._check_embedding_backend(embedding_backend)
+        where = self._user_filter(user)
+
+        if method == "similarity":
+            return self._similarity_search_batch(queries, k, rerank, where)
+        if method == "hybrid":
+            depth = max(k, HYBRID_DEPTH)
+            return [
+                self._fuse(query, k, depth, documents, user)
+                for query, documents in zip(
+                    queries,
+                    self._similarity_search_batch(queries, depth, rerank, where),
+                )
+            ]
+
+        return [
+            self.shoot(query, method, k, rerank=rerank, user=user) for query in queries
+        ]
+
+    def _user_filter(self, user: Optional[str]) -> Optional[Dict]:
+        """
+        The `where` filter for the repos a user starred, or None to search every user's stars
+        """
+        if user is None:
+            return None
+        if user.lower() not in self.users:
+            raise Exception(
+                f"The stars of {user} haven't been read. Run `starpilot read {user}` first"
+            )
+        return {sync.user_flag(user): True}
+
+    def _similarity_search(
+        self, query: str, k: int, rerank: int, where: Optional[Dict] = None
+    ) -> List[Document]:
+        if self.compact_index is not None:
+            from starpilot.utils.compact import search_documents
+
+            return search_documents(
+                self.vectorstore, self.compact_index, query, k, rerank, where
+            )
+
+        return self.vectorstore.similarity_search(query, k=k, filter=where)
+
+    def _similarity_search_batch(
+        self, queries: List[str], k: int, rerank: int, where: Optional[Dict] = None
+    ) -> List[List[Document]]:
+        import numpy as np
+
+        query_vectors = np.array(
+            self.vectorstore.embeddings.embed_queries(queries),  # type: ignore
+            dtype=np.float32,
+        )
+
+        if self.compact_index is not None:
+            from starpilot.utils.compact import search_documents_batch
+
+            return search_documents_batch(
+                self.vectorstore, self.compact_index, query_vectors, k, rerank, where
+            )
+
+        return utils.similarity_search_by_vectors(
+            self.vectorstore, query_vectors, k, where
+        )
+
+    def _lexical_index(self) -> LexicalIndex:
+        if self.lexical_index is None:
+            raise Exception("Please read the stars again to build the lexical index")
+        return self.lexical_index
+
+    def _lexical_search(
+        self, query: str, k: int, user: Optional[str] = None
+    ) -> List[Tuple[str, float]]:
+        return self._lexical_index().search(
+            query, k, self.users[user.lower()] if user is not None else None
+        )
+
+    def _hybrid_search(
+        self, query: str, k: int, rerank: int, user: Optional[str] = None
+    ) -> List[Document]:
+        # both rankings go deeper than k, so repos that do well in both can overtake ones that top only one
+        depth = max(k, HYBRID_DEPTH)
+        return self._fuse(
+            query,
+            k,
+            depth,
+            self._similarity_search(query, depth, rerank, self._user_filter(user)),
+            user,
+        )
+
+    def _fuse(
+        self,
+        query: str,
+        k: int,
+        depth: int,
+        similar_documents: List[Document],
+        user: Optional[str] = None,
+    ) -> List[Document]:
+        """
+        Merge the results of a similarity search `depth` deep with a lexical search as deep
+        """
+        from starpilot.utils.lexical import reciprocal_rank_fusion
+
+        documents = {
+            document.metadata["nameWithOwner"]: document
+            for document in similar_documents
+        }
+        lexical_ids = [
+            repo_id for repo_id, _ in self._lexical_search(query, depth, user)
+        ]
+
+        fused = reciprocal_rank_fusion([list(documents), lexical_ids])[:k]
+
+        for document in utils.get_documents(
+            self.vectorstore, [repo_id for repo_id in fused if repo_id not in documents]
+        ):
+            documents[document.metadata["nameWithOwner"]] = document
+
+        return [documents[repo_id] for repo_id in fused if repo_id in documents]
+
+    def astrologer(
+        self,
+        query: str,
+        k: int = 3,
+        embedding_backend: Optional[str] = None,
+        rerank: int = 0,
+        user: Optional[str] = None,
+    ) -> List[Document]:
+        # the LLM stack is only loaded when a query needs it
+        from langchain.chains.query_constructor.ir import (
+            Comparator,
+            Comparison,
+            Operation,
+            Operator,
+        )
+
+        from starpilot.utils.query_parser import (
+            QUERY_CONSTRUCTOR_MODEL,
+            construct_query,
+        )
+
+        self._refresh()
+        self._check_embedding_backend(embedding_backend)
+        self._user_filter(user)
+        if self._parsed_query_cache is None:
+            from starpilot.utils.query_cache import ParsedQueryCache
+
+            self._parsed_query_cache = ParsedQueryCache()
+
+        with profiling.span("parse") as span:
+            structured_query, parsed_by = construct_query(
+                query,
+                self.vocabulary,
+                self._get_query_constructor,
+                QUERY_CONSTRUCTOR_MODEL,
+                self._parsed_query_cache,
+            )
+            span.add(**{f"parsed_by_{parsed_by}": 1})
+
+        if user is not None:
+            user_comparison = Comparison(
+                comparator=Comparator.EQ, attribute=sync.user_flag(user), value=True
+            )
+            structured_query.filter = (
+                user_comparison
+                if structured_query.filter is None
+                else Operation(
+                    operator=Operator.AND,
+                    arguments=[structured_query.filter, user_comparison],
+                )
+            )
+
+        if (
+            self.facet_index is not None
+            and (candidate_ids := self.facet_index.candidates(structured_query.filter))
+            is not None
+        ):
+            logger.info(
+                "Constructed query",
+                parsed_by=parsed_by,
+                query=structured_query.query,
+                candidates=len(candidate_ids),
+            )
+            return self._candidate_search(
+                structured_query.query, k, rerank, candidate_ids
+            )
+
+        from starpilot.utils.self_query import translate_query
+
+        search_query, where = translate_query(structured_query)
+        logger.info(
+            "Constructed query",
+            parsed_by=parsed_by,
+            query=search_query,
+            where=where,
+        )
+
+        if self.compact_index is not None:
+            from starpilot.utils.compact import search_documents
+
+            return search_documents(
+                self.vectorstore, self.compact_index, search_query, k, rerank, where
+            )
+
+        return self.vectorstore.similarity_search(search_query, k=k, filter=where)
+
+    def _candidate_search(
+        self, query: str, k: int, rerank: int, candidate_ids: List[str]
+    ) -> List[Document]:
+        from starpilot.utils.compact import rerank as score_candidates
+        from starpilot.utils.compact import search_documents
+
+        if not candidate_ids:
+            return []
+
+        if self.compact_index is not None:
+            return search_documents(
+                self.vectorstore,
+                self.compact_index,
+                query,
+                k,
+                rerank,
+                candidate_ids=candidate_ids,
+            )
+
+        # only the candidates' vectors are scored, rather than the store filtering every row
+        query_vector = self.vectorstore.embeddings.embed_query(query)  # type: ignore
+        matches = score_candidates(self.vectorstore, query_vector, candidate_ids, k)
+        return utils.get_documents(
+            self.vectorstore, [repo_id for repo_id, _ in matches]
+        )
+
+    def neighbours(
+        self, repo: str, k: int = 3, user: Optional[str] = None
+    ) -> List[Document]:
+        """
+        The stars most similar to one in the store, compared by their stored vectors so nothing is embedded
+
+        They are read from the neighbour graph built by `read`, or found by searching with the repo's
+        stored vector when the graph can't answer, e.g. because it was built before graphs existed
+        """
+        self._refresh()
+        where = self._user_filter(user)
+        repo_id = self._stored_repo_id(repo)
+
+        matches = (
+            None
+            if self.neighbour_graph is None
+            else self.neighbour_graph.lookup(
+                repo_id, k, None if user is None else set(self.users[user.lower()])
+            )
+        )
+        if matches is not None:
+            return utils.get_documents(
+                self.vectorstore, [neighbour for neighbour, _ in matches]
+            )
+
+        import numpy as np
+
+        stored = self.vectorstore._collection.get(ids=[repo_id], include=["embeddings"])
+        # the repo is its own nearest match, unless the filter leaves it out
+        (documents,) = utils.similarity_search_by_vectors(
+            self.vectorstore,
+            np.array(stored["embeddings"], dtype=np.float32),
+            k + 1,
+            where,
+        )
+        return [
+            document
+            for document in documents
+            if document.metadata["nameWithOwner"] != repo_id
+        ][:k]
+
+    def _stored_repo_id(self, repo: str) -> str:
+        """
+        The id a repo is stored under, matching `owner/name` without regard to case as GitHub does
+        """
+        if self.vectorstore._collection.get(ids=[repo], include=[])["ids"]:
+            return repo
+
+        stored_ids = (
+            self.neighbour_graph.ids
+            if self.neighbour_graph is not None
+            else self.vectorstore._collection.get(include=[])["ids"]
+        )
+        for repo_id in stored_ids:
+            if repo_id.lower() == repo.lower():
+                return repo_id
+
+        raise Exception(
+            f"{repo} isn't one of the stars that have been read, try `starpilot shoot` instead"
+        )
+
+    def _get_query_constructor(self) -> Runnable:
+        from starpilot.utils.self_query import create_query_constructor
+
+        if self._query_constructor is None:
+            self._query_constructor = create_query_constructor()
+        return self._query_constructor
+
+
+class ServedDocument(NamedTuple):
+    """
+    A search result returned by the server, shaped like a langchain `Document` without importing langchain
+    """
+
+    page_content: str
+    metadata: Dict
+
+
+def _document_to_dict(document: Document) -> Dict:
+    return {"page_content": document.page_content, "metadata": document.metadata}
+
+
+def create_request_handler(engine: QueryEngine) -> type:
+    """
+    Create an HTTP request handler that answers queries with `engine`
+    """
+
+    class QueryRequestHandler(BaseHTTPRequestHandler):
+        def _respond(self, status: int, body: Dict) -> None:
+            encoded = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self._respond(
+                    200, {"vectorstore_path": os.path.abspath(engine.vectorstore_path)}
+                )
+            else:
+                self._respond(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            # a server started elsewhere is serving some other user's stars
+            if payload.pop("vectorstore_path", None) != os.path.abspath(
+                engine.vectorstore_path
+            ):
+                self._respond(409, {"error": "Server is serving a different store"})
+                return
+
+            try:
+                if self.path == "/shoot":
+                    documents = engine.shoot(**payload)
+                elif self.path == "/astrologer":
+                    documents = engine.astrologer(**payload)
+                elif self.path == "/neighbours":
+                    documents = engine.neighbours(**payload)
+                else:
+                    self._respond(404, {"error": f"Unknown path {self.path}"})
+                    return
+            except Exception as exception:
+                logger.exception("Query failed", path=self.path)
+                self._respond(500, {"error": str(exception)})
+                return
+
+            self._respond(200, {"documents": [_document_to_dict(d) for d in documents]})
+
+        def log_message(self, format: str, *args) -> None:
+            logger.debug("Request", message=format % args)
+
+    return QueryRequestHandler
+
+
+def serve(
+    vectorstore_path: str, host: str = SERVER_HOST, port: int = SERVER_PORT
+) -> None:
+    """
+    Load the vectorstore once and answer queries over HTTP until interrupted
+    """
+    engine = QueryEngine(vectorstore_path)
+    # queries are answered one at a time, the embedding and sqlite clients are not thread safe
+    httpd = HTTPServer((host, port), create_request_handler(engine))
+
+    logger.info("Serving queries", url=f"http://{host}:{port}", path=vectorstore_path)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def _read_json(response) -> Optional[Dict]:
+    """
+    The JSON object a response holds, or None if its body is something else, like an HTML error page
+    """
+    try:
+        body = json.load(response)
+    except ValueError:
+        return None
+
+    return body if isinstance(body, dict) else None
+
+
+def query_server(
+    command: str,
+    payload: Dict,
+    vectorstore_path: str,
+    server_url: str = SERVER_URL,
+    timeout: float = 120,
+) -> Optional[List[ServedDocument]]:
+    """
+    Send a query to a running `starpilot serve`, returning None if there isn't one for this store
+    """
+    request = urllib.request.Request(
+        f"{server_url}/{command}",
+        data=json.dumps(
+            {**payload, "vectorstore_path": os.path.abspath(vectorstore_path)}
+        ).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = _read_json(response)
+    except urllib.error.HTTPError as error:
+        if error.code == 409:
+            return None
+        if (body := _read_json(error)) is not None and "error" in body:
+            raise Exception(body["error"]) from error
+        # something other than starpilot is listening, so the query is answered as if nothing was
+        logger.warning(
+            "The server didn't answer like starpilot serve, answering in this process",
+            url=server_url,
+            status=error.code,
+            reason=error.reason,
+        )
+        return None
+    except urllib.error.URLError as error:
+        if isinstance(error.reason, ConnectionRefusedError):
+            return None
+        raise
+
+    if body is None or "documents" not in body:
+        logger.warning(
+            "The server didn't answer like starpilot serve, answering in this process",
+            url=server_url,
+        )
+        return None
+
+    logger.debug("Answered by server", url=server_url, command=command)
+
+    return [
+        ServedDocument(
+            page_content=document["page_content"], metadata=document["metadata"]
+        )
+        for document in body["documents"]
+    ]
+
+
+def answer_query(
+    command: str,
+    payload: Dict,
+    vectorstore_path: str,
+    cache_results: bool = False,
+    local: bool = False,
+) -> List[ServedDocument]:
+    """
+    Answer a query from the result cache, a running `starpilot serve`, or by loading the store here
+
+    With `cache_results`, answers are cached against the store's version, so repeats of a query
+    skip the embedding call and the search until `read` next writes to the store. With `local`, the
+    query is always answered here, e.g. so a profile sees the work
+    """
+    from starpilot.utils.query_cache import QueryResultCache
+
+    start = time.perf_counter()
+
+    cache = key = None
+    if (
+        cache_results
+        and not local
+        and (store_path := generations.current_path(vectorstore_path))
+        and (
+            store_version := (sync.load_store_info(store_path) or {}).get(
+                "store_version"
+            )
+        )
+    ):
+        cache = QueryResultCache()
+        key = cache.key(vectorstore_path, store_version, command, payload)
+        with profiling.span("cache"):
+            cached = cache.get(key)
+        if cached is not None:
+            return [ServedDocument(**document) for document in cached]
+
+    results = None
+    if not local:
+        with profiling.span("server"):
+            results = query_server(command, payload, vectorstore_path)
+
+    if results is None:
+        engine = QueryEngine(vectorstore_path)
+        with profiling.span("search"):
+            results = [
+                ServedDocument(**_document_to_dict(document))
+                for document in getattr(engine, command)(**payload)
+            ]
+
+    if cache is not None and key is not None:
+        cache.put(key, [_document_to_dict(document) for document in results])
+
+    logger.info(
+        "Answered query",
+        command=command,
+        cached=False,
+        latency_ms=round((time.perf_counter() - start) * 1000, 2),
+        hit_rate=cache.hit_rate if cache is not None else None,
+    )
+
+    return results
+
+
+def answer_batch(
+    queries: List[str], payload: Dict, vectorstore_path: str
+) -> List[Dict]:
+    """
+    Answer many `shoot` queries here with one load of the store, returning each query with its documents
+
+    The queries are embedded in one batch and scored together, rather than each paying for a process,
+    an embedding call and a search of its own
+    """
+    start = time.perf_counter()
+
+    engine = QueryEngine(vectorstore_path)
+    with profiling.span("search", queries=len(queries)):
+        results = engine.shoot_batch(queries, **payload)
+
+    seconds = time.perf_counter() - start
+    logger.info(
+        "Answered queries",
+        queries=len(queries),
+        seconds=round(seconds, 3),
+        queries_per_minute=round(len(queries) / seconds * 60) if seconds else None,
+    )
+
+    return [
+        {"query": query, "documents": [_document_to_dict(d) for d in documents]}
+        for query, documents in zip(queries, results)
+    ]
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import structlog
+
+import starpilot.utils.profiling as profiling
+from starpilot.utils.utils import TopKRepos, create_document, format_repo
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+    from langchain_community.vectorstores import Chroma
+
+logger = structlog.get_logger(__name__)
+
+MANIFEST_FILENAME = "starpilot-manifest.json"
+STORE_INFO_FILENAME = "starpilot-store.json"
+USERS_FILENAME = "starpilot-users.json"
+
+
+class ManifestDiff(NamedTuple):
+    """
+    The changes needed to bring a vectorstore in line with a fresh set of documents
+    """
+
+    added: List[Document]
+    updated_content: List[Document]
+    updated_metadata: List[Document]
+    deleted: List[str]
+
+
+def document_id(document: Document) -> str:
+    """
+    The id of a document in the vectorstore, which is the `nameWithOwner` of the repo
+    """
+    return document.metadata["nameWithOwner"]
+
+
+def hash_metadata(metadata: Dict) -> str:
+    return hashlib.sha256(
+        json.dumps(metadata, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def hash_document(document: Document) -> Dict[str, str]:
+    """
+    Hash the content and the metadata of a document separately
+
+    A change in content needs a new embedding, a change in metadata (e.g. the star count) does not
+    """
+    return {
+        "content": hashlib.sha256(document.page_content.encode("utf-8")).hexdigest(),
+        "metadata": hash_metadata(document.metadata),
+    }
+
+
+def user_flag(user: str) -> str:
+    """
+    The boolean metadata key that marks the repos a user starred
+
+    GitHub logins are case insensitive, so the key is always lowercase
+    """
+    return f"user:{user.lower()}"
+
+
+def content_hashes(
+    manifest: Dict[str, Dict[str, str]], ids: Iterable[str]
+) -> List[str]:
+    """
+    The content hash each repo's vector was embedded from, so indexes built from the vectors can tell
+    which of them changed
+    """
+    return [manifest.get(repo_id, {}).get("content", "") for repo_id in ids]
+
+
+def load_manifest(vectorstore_path: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Load the per repo hashes saved next to the vectorstore, if there are any
+    """
+    manifest_path = os.path.join(vectorstore_path, MANIFEST_FILENAME)
+
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def save_manifest(vectorstore_path: str, manifest: Dict[str, Dict[str, str]]) -> None:
+    """
+    Save the per repo hashes next to the vectorstore
+    """
+    manifest_path = os.path.join(vectorstore_path, MANIFEST_FILENAME)
+
+    # write then rename, so an interrupted run never leaves a truncated manifest
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def load_store_info(vectorstore_path: str) -> Optional[Dict]:
+    """
+    Load how the vectorstore was built, e.g. which embedding backend made its vectors
+    """
+    info_path = os.path.join(vectorstore_path, STORE_INFO_FILENAME)
+
+    if not os.path.exists(info_path):
+        return None
+
+    with open(info_path) as file:
+        return json.load(file)
+
+
+def save_store_info(vectorstore_path: str, info: Dict) -> None:
+    """
+    Save how the vectorstore was built next to it
+    """
+    os.makedirs(vectorstore_path, exist_ok=True)
+    info_path = os.path.join(vectorstore_path, STORE_INFO_FILENAME)
+
+    with open(info_path + ".tmp", "w") as file:
+        json.dump(info, file)
+    os.replace(info_path + ".tmp", info_path)
+
+
+def load_users(vectorstore_path: str) -> Dict[str, List[str]]:
+    """
+    Load the ids of the repos each user starred, for every user read into the vectorstore
+    """
+    users_path = os.path.join(vectorstore_path, USERS_FILENAME)
+
+    if not os.path.exists(users_path):
+        return {}
+
+    with open(users_path) as file:
+        return json.load(file)
+
+
+def save_users(vectorstore_path: str, users: Dict[str, List[str]]) -> None:
+    """
+    Save the ids of the repos each user starred next to the vectorstore
+    """
+    users_path = os.path.join(vectorstore_path, USERS_FILENAME)
+
+    with open(users_path + ".tmp", "w") as file:
+        json.dump(users, file)
+    os.replace(users_path + ".tmp", users_path)
+
+
+def diff_manifest(
+    manifest: Dict[str, Dict[str, str]], documents: List[Document]
+) -> ManifestDiff:
+    """
+    Compare the manifest of the existing vectorstore to a fresh set of documents
+    """
+    diff = ManifestDiff(added=[], updated_content=[], updated_metadata=[], deleted=[])
+
+    seen = set()
+    for document in documents:
+        repo_id = document_id(document)
+        seen.add(repo_id)
+
+        if (previous := manifest.get(repo_id)) is None:
+            diff.added.append(document)
+            continue
+
+        current = hash_document(document)
+        if current["content"] != previous["content"]:
+            diff.updated_content.append(document)
+        elif current["metadata"] != previous["metadata"]:
+            diff.updated_metadata.append(document)
+
+    diff.deleted.extend(repo_id for repo_id in manifest if repo_id not in seen)
+
+    return diff
+
+
+def apply_diff(vectorstore: Chroma, diff: ManifestDiff) -> None:
+    """
+    Write the changes in a diff to the vectorstore, only embedding the documents whose content changed
+    """
+    logger.info(
+        "Syncing vectorstore",
+        added=len(diff.added),
+        updated_content=len(diff.updated_content),
+        updated_metadata=len(diff.updated_metadata),
+        deleted=len(diff.deleted),
+    )
+
+    if diff.deleted:
+        vectorstore.delete(ids=diff.deleted)
+
+    # `add_documents` upserts, so new and changed content are embedded in the same call
+    if to_embed := diff.added + diff.updated_content:
+        vectorstore.add_documents(
+            documents=to_embed, ids=[document_id(document) for document in to_embed]
+        )
+
+    # metadata only changes are written without calling the embedding function
+    if diff.updated_metadata:
+        vectorstore._collection.update(
+            ids=[document_id(document) for document in diff.updated_metadata],
+            metadatas=[document.metadata for document in diff.updated_metadata],
+        )
+
+
+def stream_into_vectorstore(
+    vectorstore: Chroma,
+    pages: Iterable[List[Dict]],
+    manifest: Dict[str, Dict[str, str]],
+    k: Optional[int],
+    batch_size: int = 500,
+    on_batch: Optional[Callable[[Dict[str, Dict[str, str]]], None]] = None,
+    user: Optional[str] = None,
+    other_users: Optional[Dict[str, List[str]]] = None,
+    carry_over: Optional[Callable[[], Iterable[Dict]]] = None,
+) -> Tuple[Dict[str, Dict[str, str]], List[Dict]]:
+    """
+    Format, embed and upsert pages of starred repos as they arrive, keeping only the top k by stars
+
+    Each batch is persisted as soon as it is written, so results are queryable before the sync finishes.
+    Repos that fall out of the top k later in the stream are deleted at the end. `on_batch` is called
+    with the manifest of everything in the vectorstore after each batch, so it can be saved and an
+    interrupted sync still knows what to clean up.
+
+    With a `user`, every repo is flagged with the `user_flag` of each user who starred it. Repos in
+    `other_users` (the ids each other user starred) are shared: they are never embedded twice, and
+    when `user` no longer stars one its flag is removed instead of the repo being deleted.
+
+    When the pages stop at stars an earlier sync already read, `carry_over` is called once they run
+    out, and returns the repos read before that are still starred. They compete for the top k with
+    the new ones, but are already stored so they are never embedded or written again.
+
+    Returns the manifest describing the vectorstore after the sync, and the kept formatted repos
+    """
+    top_k = TopKRepos(k)
+    pending: Dict[str, Document] = {}
+    stored = dict(manifest)
+
+    starred_by: Dict[str, List[str]] = {}
+    for other_user, repo_ids in (other_users or {}).items():
+        for repo_id in repo_ids:
+            starred_by.setdefault(repo_id, []).append(other_user)
+
+    def _create_document(formatted_repo: Dict) -> Document:
+        document = create_document(formatted_repo)
+        if user is not None:
+            for starring_user in starred_by.get(document_id(document), []) + [user]:
+                document.metadata[user_flag(starring_user)] = True
+        return document
+
+    def _flush() -> None:
+        if pending:
+            diff = diff_manifest(stored, list(pending.values()))
+            # anything missing from this batch may still be in a later one, so deletes wait for the end
+            with profiling.span("store", documents=len(pending)):
+                apply_diff(vectorstore, diff._replace(deleted=[]))
+            stored.update(
+                (repo_id, hash_document(document))
+                for repo_id, document in pending.items()
+            )
+            pending.clear()
+            if on_batch is not None:
+                on_batch(stored)
+
+    fetched = set()
+    for page in pages:
+        with profiling.span("format", repos=len(page)):
+            for repo in page:
+                formatted_repo = format_repo(repo)
+                fetched.add(formatted_repo["nameWithOwner"])
+
+                if (evicted := top_k.push(formatted_repo)) is not None:
+                    pending.pop(evicted["nameWithOwner"], None)
+
+                if evicted is not formatted_repo:
+                    if (document := _create_document(formatted_repo)).page_content:
+                        pending[document_id(document)] = document
+
+        if len(pending) >= batch_size:
+            _flush()
+
+    if carry_over is not None:
+        carried = 0
+        for repo in carry_over():
+            # a repo that was unstarred and starred again has just been fetched
+            if repo["nameWithOwner"] in fetched:
+                continue
+            carried += 1
+            if (evicted := top_k.push(repo)) is not None:
+                pending.pop(evicted["nameWithOwner"], None)
+        logger.info("Kept repos read by earlier syncs", repos=carried)
+
+    _flush()
+
+    kept_repos = top_k.sorted()
+    kept_documents = [
+        document
+        for document in map(_create_document, kept_repos)
+        if document.page_content
+    ]
+    kept_ids = {document_id(document) for document in kept_documents}
+
+    new_manifest = {
+        document_id(document): hash_document(document) for document in kept_documents
+    }
+    # other users' repos are kept as they are, whether or not this user starred them
+    new_manifest.update(
+        (repo_id, stored[repo_id])
+        for repo_id in starred_by
+        if repo_id not in kept_ids and repo_id in stored
+    )
+
+    stale = set(stored) - kept_ids
+    if user is not None and (unstarred := sorted(stale & set(starred_by))):
+        stored_metadatas = vectorstore._collection.get(
+            ids=unstarred, include=["metadatas"]
+        )
+        unflagged_ids, metadatas = [], []
+        for repo_id, metadata in zip(
+            stored_metadatas["ids"], stored_metadatas["metadatas"]
+        ):
+            if not metadata.get(user_flag(user)):
+                continue
+            # chroma merges updated metadata into what it has and can't delete a key, so the flag is cleared
+            metadata = {**metadata, user_flag(user): False}
+            unflagged_ids.append(repo_id)
+            metadatas.append(metadata)
+            new_manifest[repo_id] = {
+                **stored[repo_id],
+                "metadata": hash_metadata(metadata),
+            }
+
+        if unflagged_ids:
+            logger.info(
+                "Unflagging repos the user no longer stars",
+                unflagged=len(unflagged_ids),
+            )
+            with profiling.span("prune", unflagged=len(unflagged_ids)):
+                vectorstore._collection.update(ids=unflagged_ids, metadatas=metadatas)
+
+    if stale := sorted(stale - set(starred_by)):
+        logger.info("Deleting stale repos from vectorstore", deleted=len(stale))
+        with profiling.span("prune", deleted=len(stale)):
+            vectorstore.delete(ids=stale)
+
+    return new_manifest, kept_repos
@@ -0,0 +1,172 @@
+import functools
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+import structlog
+import tiktoken
+
+import starpilot.utils.profiling as profiling
+from starpilot.utils.cache import CACHE_DIR, hash_text
+
+logger = structlog.get_logger(__name__)
+
+TOKEN_CACHE_PATH = os.path.join(CACHE_DIR, "tokens.sqlite3")
+
+# https://openai.com/pricing
+PRICE_PER_MILLION_TOKENS = {
+    "text-embedding-3-large": 0.13,
+    "text-embedding-3-small": 0.02,
+    "text-embedding-ada-002": 0.10,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Load the tokenizer for a model once per process
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning("No tokenizer known for model, using cl100k_base", model=model)
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """
+    Count the tokens a model will bill for, encoding in batches and caching counts by content hash
+
+    With a `cache_path` the counts persist across runs, so unchanged repos are never re-tokenised
+    """
+
+    def __init__(
+        self,
+        model: str,
+        cache_path: Optional[str] = TOKEN_CACHE_PATH,
+        num_threads: int = 8,
+    ):
+        self.model = model
+        self.num_threads = num_threads
+        self.total_tokens = 0
+        self.total_texts = 0
+
+        self._counts: Dict[str, int] = {}
+        self._connection = None
+        if cache_path is not None:
+            if os.path.dirname(cache_path):
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            self._connection = sqlite3.connect(cache_path)
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS token_counts (
+                    encoding TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (encoding, content_hash)
+                )
+                """
+            )
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        return get_encoding(self.model)
+
+    @property
+    def price_per_million_tokens(self) -> float:
+        return PRICE_PER_MILLION_TOKENS.get(self.model, 0.0)
+
+    def cost(self, tokens: int) -> float:
+        """
+        The cost in dollars of embedding a number of tokens
+        """
+        return tokens * self.price_per_million_tokens / 1e6
+
+    def _load(self, content_hashes: List[str]) -> None:
+        if self._connection is None:
+            return
+
+        wanted = [
+            content_hash
+            for content_hash in dict.fromkeys(content_hashes)
+            if content_hash not in self._counts
+        ]
+        for start in range(0, len(wanted), 500):
+            chunk = wanted[start : start + 500]
+            rows = self._connection.execute(
+                f"""
+                SELECT content_hash, tokens FROM token_counts
+                WHERE encoding = ? AND content_hash IN ({",".join("?" * len(chunk))})
+                """,
+                [self.encoding.name, *chunk],
+            )
+            self._counts.update(rows)
+
+    def _save(self, counts: Dict[str, int]) -> None:
+        self._counts.update(counts)
+
+        if self._connection is not None:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)",
+                [
+                    (self.encoding.name, content_hash, tokens)
+                    for content_hash, tokens in counts.items()
+                ],
+            )
+            self._connection.commit()
+
+    def count(self, texts: List[str]) -> List[int]:
+        """
+        Count the tokens in each text, only encoding texts that have not been counted before
+        """
+        with profiling.span("tokenise", texts=len(texts)) as span:
+            content_hashes = [hash_text(text) for text in texts]
+            self._load(content_hashes)
+
+            missing = {
+                content_hash: text
+                for content_hash, text in zip(content_hashes, texts)
+                if content_hash not in self._counts
+            }
+
+            if missing:
+                encoded = self.encoding.encode_ordinary_batch(
+                    list(missing.values()), num_threads=self.num_threads
+                )
+                self._save(
+                    {
+                        content_hash: len(tokens)
+                        for content_hash, tokens in zip(missing.keys(), encoded)
+                    }
+                )
+            span.add(tokenised=len(missing))
+
+        counts = [self._counts[content_hash] for content_hash in content_hashes]
+
+        self.total_tokens += sum(counts)
+        self.total_texts += len(counts)
+
+        # called for every batch, so `log_total` is the one summary at info level
+        logger.debug(
+            "Token lengths",
+            model=self.model,
+            texts=len(counts),
+            tokenised=len(missing),
+            tokens=sum(counts),
+            cost=self.cost(sum(counts)),
+        )
+
+        return counts
+
+    def log_total(self) -> None:
+        """
+        Log the tokens and cost of everything counted so far
+        """
+        logger.info(
+            "Token totals",
+            model=self.model,
+            texts=self.total_texts,
+            total_tokens=self.total_tokens,
+            mean_tokens=self.total_tokens / self.total_texts if self.total_texts else 0,
+            total_cost=self.cost(self.total_tokens),
+        )
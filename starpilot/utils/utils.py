@@ -1,27 +1,44 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
 import json
 import os
-import shutil
+import queue
+import random
+import threading
+import time
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
-import tiktoken
 import structlog
-from gql import Client, gql
-from gql.transport.aiohttp import AIOHTTPTransport
-from graphql_query import (
-    Argument,
-    Field,
-    Operation,
-    Query,
-)
-from langchain.schema.document import Document
-from langchain.vectorstores.utils import filter_complex_metadata
-from langchain_community.document_loaders import JSONLoader
-from langchain_community.vectorstores import Chroma
-from langchain_openai.embeddings import OpenAIEmbeddings
-from rich.progress import track
-from rich.table import Table
 
+import starpilot.utils.profiling as profiling
+
+# heavy dependencies are imported where they are used, so commands that don't need them start quickly
+if TYPE_CHECKING:
+    import numpy as np
+    from gql.transport.aiohttp import AIOHTTPTransport
+    from graphql_query import Operation
+    from langchain.schema.document import Document
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.vectorstores import VectorStore
+    from rich.progress import Progress
+    from rich.table import Table
+
+    from starpilot.utils.cache import CachedEmbeddings
+    from starpilot.utils.tokens import TokenCounter
 
 try:
     from icecream import ic
@@ -30,163 +47,435 @@ except ImportError:  # Graceful fallback if IceCream isn't installed.
 
 logger = structlog.get_logger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-3-large"
 
-def get_user_starred_repos(username: str, github_api_key: str) -> List:
-    """
-    Get the starred repos for a user using github GraphQL API
-    """
-
-    after_cursor = ""
-    all_results = []
-
-    def _get_page_of_user_starred_repos(
-        user: str,
-        github_api_key: str,
-        after_cursor: str = "",
-    ) -> Tuple[List[Dict], Optional[str]]:
-        """
-        Get a page of the starred repos for a user using github GraphQL API
-        """
+# can point at a stand in for GitHub, e.g. the benchmarks' GraphQL stub
+GITHUB_GRAPHQL_URL = os.environ.get(
+    "STARPILOT_GITHUB_URL", "https://api.github.com/graphql"
+)
 
-        logger.debug("Creating GraphQL query", after_cursor=after_cursor)
+REPO_CONTENTS_PATH = "./repo_content.jsonl"
 
-        headers = {
-            "Authorization": f"Bearer {github_api_key}",
-        }
+# caches shared by every user and vectorstore
+CACHE_DIR = "./starpilot-cache"
 
-        transport = AIOHTTPTransport(
-            url="https://api.github.com/graphql", headers=headers
-        )
 
-        client = Client(transport=transport, fetch_schema_from_transport=True)
+def _construct_user_starred_repos_operation() -> Operation:
+    """
+    Generate a GraphQL operation to get a page of the starred repos for a user, newest stars first
 
-        def _construct_user_starred_repos_query(
-            username: str, after: str = ""
-        ) -> Query:
-            """
-            Generate a GraphQL query to get the starred repos for a user
-            """
-            user_starred_repos_query = Query(
-                name="user",
-                arguments=[Argument(name="login", value=f'"{username}"')],
+    The login and cursor are variables, so the same document is reused for every page
+    """
+    from graphql_query import Argument, Field, Operation, Query, Variable
+
+    login = Variable(name="login", type="String!")
+    after = Variable(name="after", type="String")
+
+    user_starred_repos_query = Query(
+        name="user",
+        arguments=[Argument(name="login", value=login)],
+        fields=[
+            "login",
+            "name",
+            Field(
+                name="starredRepositories",
+                arguments=[
+                    Argument(name="first", value=100),  # 100 is the max accepted
+                    Argument(name="after", value=after),
+                    # newest first, so a sync can stop once it reaches stars it has already read
+                    Argument(
+                        name="orderBy",
+                        value=[
+                            Argument(name="field", value="STARRED_AT"),
+                            Argument(name="direction", value="DESC"),
+                        ],
+                    ),
+                ],
                 fields=[
-                    "login",
-                    "name",
+                    "totalCount",
+                    Field(name="pageInfo", fields=["hasNextPage", "endCursor"]),
                     Field(
-                        name="starredRepositories",
-                        arguments=[
-                            Argument(
-                                name="first", value=100
-                            ),  # 100 is the max accepted
-                            Argument(name="after", value=f'"{after}"'),
-                        ],
+                        name="edges",
                         fields=[
+                            "cursor",
+                            "starredAt",
                             Field(
-                                name="edges",
+                                name="node",
                                 fields=[
-                                    "cursor",
+                                    "name",
+                                    "nameWithOwner",
+                                    Field(
+                                        name="owner",
+                                        fields=["login"],
+                                    ),
+                                    "url",
+                                    "homepageUrl",
+                                    "description",
                                     Field(
-                                        name="node",
+                                        name="repositoryTopics",
+                                        arguments=[Argument(name="first", value=20)],
                                         fields=[
-                                            "name",
-                                            "nameWithOwner",
                                             Field(
-                                                name="owner",
-                                                fields=["login"],
-                                            ),
-                                            "url",
-                                            "homepageUrl",
-                                            "description",
-                                            Field(
-                                                name="repositoryTopics",
-                                                arguments=[
-                                                    Argument(name="first", value=20)
-                                                ],
+                                                name="nodes",
                                                 fields=[
                                                     Field(
-                                                        name="nodes",
-                                                        fields=[
-                                                            Field(
-                                                                name="topic",
-                                                                fields=["name"],
-                                                            )
-                                                        ],
+                                                        name="topic",
+                                                        fields=["name"],
                                                     )
                                                 ],
-                                            ),
-                                            "stargazerCount",
-                                            Field(
-                                                name="primaryLanguage",
-                                                fields=["name"],
-                                            ),
-                                            Field(
-                                                name="languages",
-                                                arguments=[
-                                                    Argument(name="first", value=20)
-                                                ],
-                                                fields=[
-                                                    Field(name="nodes", fields=["name"])
-                                                ],
-                                            ),
+                                            )
                                         ],
                                     ),
+                                    "stargazerCount",
+                                    Field(
+                                        name="primaryLanguage",
+                                        fields=["name"],
+                                    ),
+                                    Field(
+                                        name="languages",
+                                        arguments=[Argument(name="first", value=20)],
+                                        fields=[Field(name="nodes", fields=["name"])],
+                                    ),
                                 ],
                             ),
                         ],
                     ),
                 ],
-            )
+            ),
+        ],
+    )
 
-            return user_starred_repos_query
+    return Operation(
+        type="query",
+        name="UserStarredRepos",
+        variables=[login, after],
+        queries=[user_starred_repos_query],
+    )
 
-        user_starred_repos_query = _construct_user_starred_repos_query(
-            user, after_cursor
-        )
 
-        operation = Operation(
-            type="query",
-            name="UserStarredRepos",
-            queries=[user_starred_repos_query],
+def _retry_delay(
+    headers: Optional[Mapping[str, str]], attempt: int, backoff: float
+) -> float:
+    """
+    How long to wait before retrying a request, preferring what GitHub asked for in the response headers
+    """
+    headers = headers or {}
+
+    if (retry_after := headers.get("Retry-After")) is not None:
+        return float(retry_after)
+
+    if headers.get("X-RateLimit-Remaining") == "0" and (
+        reset := headers.get("X-RateLimit-Reset")
+    ):
+        return max(float(reset) - time.time(), 0.0)
+
+    return backoff * 2**attempt + random.uniform(0, backoff)
+
+
+async def _execute_with_retries(
+    session,
+    transport: AIOHTTPTransport,
+    document,
+    variable_values: Dict,
+    max_retries: int,
+    backoff: float,
+) -> Dict:
+    """
+    Execute a GraphQL request, retrying with backoff on timeouts, server errors and rate limits
+    """
+    from aiohttp import ClientError
+    from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+    attempt = 0
+    while True:
+        profiling.record(github_api_calls=1)
+        try:
+            result = await session.execute(document, variable_values=variable_values)
+        except TransportQueryError as exception:
+            rate_limited = any(
+                error.get("type") == "RATE_LIMITED" for error in exception.errors or []
+            )
+            if not rate_limited or attempt == max_retries:
+                raise
+            error = exception
+        except (TransportServerError, asyncio.TimeoutError, ClientError) as exception:
+            if attempt == max_retries:
+                raise
+            error = exception
+        else:
+            # rate limit docs: https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
+            headers = transport.response_headers or {}
+            if headers.get("X-RateLimit-Remaining") == "0":
+                delay = _retry_delay(headers, attempt, backoff)
+                logger.warning(
+                    "GitHub rate limit reached, waiting for reset", delay=delay
+                )
+                await asyncio.sleep(delay)
+            return result
+
+        profiling.record(github_retries=1)
+        delay = _retry_delay(transport.response_headers, attempt, backoff)
+        logger.warning(
+            "Retrying GitHub GraphQL request",
+            attempt=attempt + 1,
+            delay=delay,
+            error=str(error),
         )
+        await asyncio.sleep(delay)
+        attempt += 1
 
-        # this call is sorta flaky, and has failed with timeout errors without ovveriding the timeout default
-        # rate limit docs: https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
-        result = client.execute(gql(operation.render()))
 
-        edges = result["user"]["starredRepositories"]["edges"]
+class StarredReposFetch:
+    """
+    Where a fetch of starred repos stops, and what it learned on the way
 
-        def _get_next_cursor(edges: List[Dict]) -> Optional[str]:
-            """
-            Get the cursor for the next page of results
-            """
-            if edges:
-                return edges[-1]["cursor"]
-            else:
-                return None
+    Stars arrive newest first. Given the newest `starredAt` and the `totalCount` from the last sync,
+    the fetch stops at the first star it has already read, as long as the stars it found account for
+    the change in `totalCount`. If they don't, something was unstarred, and every star is walked so
+    the unstarred repos can be found. `complete` says whether every star was walked
+    """
 
-        next_cursor = _get_next_cursor(edges)
+    def __init__(self, since: Optional[str] = None, known_total: Optional[int] = None):
+        self.since = since
+        self.known_total = known_total
+        self.complete = since is None or known_total is None
+        self.total_count: Optional[int] = None
+        self.newest_starred_at: Optional[str] = None
+        self.new_stars = 0
+        # the cursor of the next page to fetch, None once the fetch has stopped
+        self.after_cursor: Optional[str] = None
+
+    def state(self) -> Dict:
+        """
+        Everything the fetch has learned so far, for `from_state` to carry on from
+        """
+        return {
+            "since": self.since,
+            "known_total": self.known_total,
+            "complete": self.complete,
+            "total_count": self.total_count,
+            "newest_starred_at": self.newest_starred_at,
+            "new_stars": self.new_stars,
+            "after_cursor": self.after_cursor,
+        }
 
-        repos: List[Dict] = [edge["node"] for edge in edges]
+    @classmethod
+    def from_state(cls, state: Dict) -> "StarredReposFetch":
+        """
+        A fetch that carries on from a saved `state`, starting at its `after_cursor`
+        """
+        fetch = cls(since=state["since"], known_total=state["known_total"])
+        fetch.complete = state["complete"]
+        fetch.total_count = state["total_count"]
+        fetch.newest_starred_at = state["newest_starred_at"]
+        fetch.new_stars = state["new_stars"]
+        fetch.after_cursor = state["after_cursor"]
+        return fetch
+
+    def page(
+        self, repos: List[Dict], total_count: int, after_cursor: Optional[str]
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Take in a page, returning the repos in it to use and the cursor of the next page to fetch
+        """
+        repos, self.after_cursor = self._page(repos, total_count, after_cursor)
+        return repos, self.after_cursor
 
-        return repos, next_cursor
+    def _page(
+        self, repos: List[Dict], total_count: int, after_cursor: Optional[str]
+    ) -> Tuple[List[Dict], Optional[str]]:
+        self.total_count = total_count
+        if self.newest_starred_at is None and repos:
+            self.newest_starred_at = repos[0]["starredAt"]
+
+        if self.complete:
+            return repos, after_cursor
+
+        new_repos = [repo for repo in repos if repo["starredAt"] > self.since]
+        self.new_stars += len(new_repos)
+        if len(new_repos) == len(repos) and after_cursor is not None:
+            return new_repos, after_cursor
+
+        if self.known_total + self.new_stars == total_count:
+            logger.info(
+                "Reached stars that were already read",
+                new_stars=self.new_stars,
+                total_count=total_count,
+            )
+            return new_repos, None
 
-    while True:
-        print(f"Fetching page of starred repos for {username}")
-        result, after_cursor = _get_page_of_user_starred_repos(
-            user=username, github_api_key=github_api_key, after_cursor=after_cursor
+        logger.info(
+            "Star count changed by more than the new stars, reading every star",
+            new_stars=self.new_stars,
+            known_total=self.known_total,
+            total_count=total_count,
         )
+        # the pages before this one held only new stars, so everything is still walked once
+        self.complete = True
+        return repos, after_cursor
+
+
+async def aiter_user_starred_repos(
+    username: str,
+    github_api_key: str,
+    url: str = GITHUB_GRAPHQL_URL,
+    max_retries: int = 5,
+    backoff: float = 1.0,
+    fetch: Optional[StarredReposFetch] = None,
+    after: Optional[str] = None,
+    on_page: Optional[Callable[[List[Dict]], None]] = None,
+) -> AsyncIterator[List[Dict]]:
+    """
+    Yield pages of the starred repos for a user using github GraphQL API, newest stars first
+
+    One session is used for every page, and the request for the next page is sent as soon as the
+    cursor for it arrives, so it downloads while the current page is being processed. With a
+    `fetch`, paging stops as soon as it reaches stars that were already read. Paging starts after
+    the `after` cursor, and `on_page` is called with each page as soon as it arrives, before it is
+    yielded
+    """
+
+    from gql import Client, gql
+    from gql.transport.aiohttp import AIOHTTPTransport
 
-        all_results.append(result)
+    headers = {
+        "Authorization": f"Bearer {github_api_key}",
+    }
+
+    transport = AIOHTTPTransport(url=url, headers=headers)
+
+    # the query is fixed, so there is no need to download GitHub's whole schema to validate it
+    # this call is sorta flaky, and has failed with timeout errors without ovveriding the timeout default
+    client = Client(
+        transport=transport, fetch_schema_from_transport=False, execute_timeout=60
+    )
 
-        if after_cursor is None:
-            print("No more pages of results")
-            break
+    document = gql(_construct_user_starred_repos_operation().render())
 
-    all_results = [item for sublist in all_results for item in sublist]
+    async with client as session:
 
-    logger.info("User starred repos", user=username, number_of_repos=len(all_results))
+        async def _get_page_of_user_starred_repos(
+            after_cursor: Optional[str],
+        ) -> Tuple[List[Dict], Optional[str], int]:
+            """
+            Get a page of the starred repos, the cursor for the next page if there is one, and the total stars
+            """
+            logger.debug("Requesting page of starred repos", after_cursor=after_cursor)
+
+            result = await _execute_with_retries(
+                session,
+                transport,
+                document,
+                {"login": username, "after": after_cursor},
+                max_retries=max_retries,
+                backoff=backoff,
+            )
 
-    return all_results
+            starred_repositories = result["user"]["starredRepositories"]
+            page_info = starred_repositories["pageInfo"]
+
+            # when a repo was starred belongs to the edge, it is kept with the repo
+            repos: List[Dict] = [
+                {**edge["node"], "starredAt": edge["starredAt"]}
+                for edge in starred_repositories["edges"]
+            ]
+
+            return (
+                repos,
+                page_info["endCursor"] if page_info["hasNextPage"] else None,
+                starred_repositories["totalCount"],
+            )
+
+        page = asyncio.ensure_future(_get_page_of_user_starred_repos(after))
+        try:
+            while True:
+                repos, after_cursor, total_count = await page
+                if fetch is not None:
+                    repos, after_cursor = fetch.page(repos, total_count, after_cursor)
+                if on_page is not None:
+                    on_page(repos)
+
+                if after_cursor is not None:
+                    page = asyncio.ensure_future(
+                        _get_page_of_user_starred_repos(after_cursor)
+                    )
+
+                yield repos
+
+                if after_cursor is None:
+                    break
+        finally:
+            page.cancel()
+
+
+def iter_user_starred_repos(
+    username: str,
+    github_api_key: str,
+    prefetch: int = 2,
+    url: str = GITHUB_GRAPHQL_URL,
+    fetch: Optional[StarredReposFetch] = None,
+    after: Optional[str] = None,
+    on_page: Optional[Callable[[List[Dict]], None]] = None,
+) -> Iterator[List[Dict]]:
+    """
+    Yield pages of the starred repos for a user, fetched in a background thread
+
+    At most `prefetch` pages wait in memory, and the next pages keep downloading while the caller
+    works on the current one. `fetch` is filled in, and `on_page` called, by the background thread,
+    so only read the fetch once the pages run out
+    """
+    pages: queue.Queue = queue.Queue(maxsize=prefetch)
+    finished = object()
+    stop = threading.Event()
+
+    def _put(item) -> None:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch_pages() -> None:
+        async def _run() -> None:
+            loop = asyncio.get_running_loop()
+            async for repos in aiter_user_starred_repos(
+                username,
+                github_api_key,
+                url=url,
+                fetch=fetch,
+                after=after,
+                on_page=on_page,
+            ):
+                # hand the page over without blocking the event loop, so the next request stays in flight
+                await loop.run_in_executor(None, _put, repos)
+                if stop.is_set():
+                    return
+
+        try:
+            asyncio.run(_run())
+        except BaseException as exception:
+            _put(exception)
+        else:
+            _put(finished)
+
+    thread = threading.Thread(target=_fetch_pages, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            # time spent here is time spent waiting on GitHub
+            with profiling.span("fetch") as span:
+                page = pages.get()
+                if isinstance(page, list):
+                    span.add(repos=len(page))
+            if page is finished:
+                break
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        stop.set()
 
 
 def format_repo(repo: Dict) -> Dict:
@@ -201,6 +490,7 @@ def format_repo(repo: Dict) -> Dict:
         "homepageUrl": repo["homepageUrl"],
         "description": repo["description"],
         "stargazerCount": repo["stargazerCount"],
+        "starredAt": repo.get("starredAt"),
         "primaryLanguage": (
             repo["primaryLanguage"]["name"] if repo["primaryLanguage"] else None
         ),
@@ -241,100 +531,135 @@ def format_repo(repo: Dict) -> Dict:
     return formatted_repo
 
 
+class TopKRepos:
+    """
+    The k most starred repos seen so far, kept in a bounded min heap so repos can be streamed through it
+    """
+
+    def __init__(self, k: Optional[int]):
+        self.k = k
+        self._heap: List[Tuple[int, str, Dict]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, repo: Dict) -> Optional[Dict]:
+        """
+        Offer a formatted repo, returning whichever repo no longer makes the cut, if any
+        """
+        item = (repo["stargazerCount"], repo["nameWithOwner"], repo)
+
+        if self.k is None or len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+            return None
+
+        if not self._heap or item[:2] <= self._heap[0][:2]:
+            return repo
+
+        return heapq.heappushpop(self._heap, item)[2]
+
+    def sorted(self) -> List[Dict]:
+        """
+        The kept repos, most starred first
+        """
+        return [repo for _, _, repo in sorted(self._heap, reverse=True)]
+
+
 def save_repo_contents_to_disk(
-    repo_contents: List[Dict], repo_contents_dir: str = "./repo_content"
+    repo_contents: Iterable[Dict],
+    repo_contents_path: str = REPO_CONTENTS_PATH,
+    append: bool = False,
 ) -> None:
     """
-    Save the repo contents to disk
+    Save the repo contents to disk as JSON Lines, one repo per line
     """
-    if not os.path.exists(repo_contents_dir):
-        os.makedirs(repo_contents_dir)
-    else:
-        shutil.rmtree(repo_contents_dir)
-        os.makedirs(repo_contents_dir)
+    if append:
+        with open(repo_contents_path, "a") as file:
+            for repo in repo_contents:
+                file.write(json.dumps(repo) + "\n")
+        return
+
+    # write then rename, so a failed write never leaves half a snapshot behind
+    with open(repo_contents_path + ".tmp", "w") as file:
+        for repo in repo_contents:
+            file.write(json.dumps(repo) + "\n")
+    os.replace(repo_contents_path + ".tmp", repo_contents_path)
+
+
+def load_repo_contents_from_disk(
+    repo_contents_path: str = REPO_CONTENTS_PATH,
+) -> Iterator[Dict]:
+    """
+    Stream the repo contents back from a JSON Lines snapshot
+    """
+    with open(repo_contents_path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
 
-    for repo in track(repo_contents, description="Mapping the stars..."):
-        repo_name = repo["name"]
-        try:
-            repo_write_path = os.path.join(repo_contents_dir, repo_name + ".json")
-            with open(repo_write_path, "w") as file:
-                json.dump(repo, file)
-        except Exception as exception:
-            raise Exception(f"Failed to write repo {repo_name} to disk") from exception
 
+def _metadata_func(record: dict, metadata: dict) -> dict:
+    """
+    Map a formatted repo onto the metadata stored with its document
+    """
+    metadata["url"] = record.get("url")
+    metadata["name"] = record.get("name")
+    metadata["nameWithOwner"] = record["nameWithOwner"]
+    metadata["stargazerCount"] = record["stargazerCount"]
+    if (primary_language := record.get("primaryLanguage")) is not None:
+        metadata["primaryLanguage"] = primary_language
+    if (description := record.get("description")) is not None:
+        metadata["description"] = description
+    if (topics := record.get("topics")) is not None:
+        metadata["topics"] = " ".join(topics)
+    if (languages := record.get("languages")) is not None:
+        metadata["languages"] = " ".join(languages)
+
+    # if any of the fields are not one of (str, bool, int, float) log a warning
+    for key, value in metadata.items():
+        if not isinstance(value, (str, bool, int, float)):
+            logger.warning(
+                "Metadata value is not one of (str, bool, int, float)",
+                key=key,
+                value=value,
+                type=type(value),
+                repo=record.get("name"),
+            )
 
-def prepare_documents(
-    repo_contents_dir: str = "./repo_content",
-) -> List[Document]:
+    return metadata
+
+
+def create_document(repo: Dict) -> Document:
     """
-    Prepare the documents for ingestion into the vectorstore
-    """
-
-    file_paths = []
-    for file in os.listdir(repo_contents_dir):
-        file_paths.append(os.path.join(repo_contents_dir, file))
-
-    def _metadata_func(record: dict, metadata: dict) -> dict:
-        metadata["url"] = record.get("url")
-        metadata["name"] = record.get("name")
-        metadata["stargazerCount"] = record["stargazerCount"]
-        if (primary_language := record.get("primaryLanguage")) is not None:
-            metadata["primaryLanguage"] = primary_language
-        if (description := record.get("description")) is not None:
-            metadata["description"] = description
-        if (topics := record.get("topics")) is not None:
-            metadata["topics"] = " ".join(topics)
-        if (languages := record.get("languages")) is not None:
-            metadata["languages"] = " ".join(languages)
-
-        # if any of the fields are not one of (str, bool, int, float) log a warning
-        for key, value in metadata.items():
-            if not isinstance(value, (str, bool, int, float)):
-                logger.warning(
-                    "Metadata value is not one of (str, bool, int, float)",
-                    key=key,
-                    value=value,
-                    type=type(value),
-                    repo=record.get("name"),
-                )
+    Create a document for the vectorstore from a formatted repo
+    """
+    from langchain.schema.document import Document
 
-        return metadata
-
-    documents = []
-    for file_path in track(file_paths, description="Loading documents..."):
-        logger.debug("Loading document", file=file_path)
-        loader = JSONLoader(
-            file_path,
-            jq_schema=".",
-            content_key="content",
-            metadata_func=_metadata_func,
-            text_content=False,
-        )
-        if (loaded_document := loader.load())[0].page_content != "":
-            documents.extend(loaded_document)
+    return Document(
+        page_content=repo.get("content", ""),
+        metadata=_metadata_func(repo, {}),
+    )
 
-    def _num_tokens_from_string(string: str, encoding_name: str) -> int:
-        """Returns the number of tokens in a text string."""
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
 
-    # calculate the sum total tokens for the content of each document
+def prepare_documents(
+    repo_contents: Iterable[Dict],
+    token_counter: Optional[TokenCounter] = None,
+) -> List[Document]:
+    """
+    Prepare the documents for ingestion into the vectorstore from formatted repos
 
-    token_lengths = []
-    for document in documents:
-        token_lengths.append(
-            _num_tokens_from_string(document.page_content, "cl100k_base")
-        )
+    Their tokens are counted with `token_counter` if given, only the OpenAI backend needs them
+    """
+    from langchain.vectorstores.utils import filter_complex_metadata
 
-    price_per_million_tokens = 0.13
+    documents = [
+        document
+        for document in map(create_document, repo_contents)
+        if document.page_content != ""
+    ]
 
-    logger.info(
-        "Token lengths",
-        total_tokens=sum(token_lengths),
-        mean_tokens=sum(token_lengths) / len(token_lengths),
-        total_cost=sum(token_lengths) * price_per_million_tokens / 1e6,
-    )
+    if token_counter is not None:
+        token_counter.count([document.page_content for document in documents])
 
     documents = filter_complex_metadata(documents)
 
@@ -349,33 +674,268 @@ class SearchMethods(Enum):
     similarity = "similarity"
     similarity_score_threshold = "similarity_score_threshold"
     mmr = "mmr"
+    # answered from the BM25 index, without embedding the query
+    lexical = "lexical"
+    # similarity and lexical results merged by reciprocal rank fusion
+    hybrid = "hybrid"
+
+
+class EmbeddingBackends(Enum):
+    """
+    Enum for the different embedding backends
+    """
+
+    openai = "openai"
+    local = "local"
+
+
+class StoreBackends(Enum):
+    """
+    Enum for the different vectorstores
+    """
+
+    chroma = "chroma"
+    numpy = "numpy"
+
+
+class Quantisations(Enum):
+    """
+    Enum for how compactly vectors are stored for searching
+    """
+
+    none = "none"
+    float16 = "float16"
+    int8 = "int8"
+
+
+def embedding_model(backend: EmbeddingBackends) -> str:
+    """
+    The model a backend embeds with
+    """
+    from starpilot.utils.embeddings import LOCAL_EMBEDDING_MODEL
+
+    return {
+        EmbeddingBackends.openai: EMBEDDING_MODEL,
+        EmbeddingBackends.local: LOCAL_EMBEDDING_MODEL,
+    }[backend]
+
+
+def create_embedding_function(
+    backend: EmbeddingBackends = EmbeddingBackends.openai,
+    dimensions: Optional[int] = None,
+    max_concurrency: int = 4,
+    token_counter: Optional[TokenCounter] = None,
+    progress: Optional[Progress] = None,
+) -> CachedEmbeddings:
+    """
+    Create the embedding function for a backend, backed by the on disk embedding cache
+
+    `dimensions` shortens the vectors the OpenAI models return
+    """
+    from starpilot.utils.cache import CachedEmbeddings
+    from starpilot.utils.embeddings import BatchedOpenAIEmbeddings, LocalEmbeddings
+
+    if backend is EmbeddingBackends.local:
+        underlying = LocalEmbeddings(progress=progress)
+    else:
+        underlying = BatchedOpenAIEmbeddings(
+            model=EMBEDDING_MODEL,
+            dimensions=dimensions,
+            max_concurrency=max_concurrency,
+            token_counter=token_counter,
+            progress=progress,
+        )
+
+    model = embedding_model(backend)
+    if dimensions is not None:
+        # shortened vectors are cached separately from the full length ones
+        model = f"{model}:{dimensions}"
+
+    return CachedEmbeddings(underlying=underlying, model=model)
+
+
+def check_embedding_backend(
+    vectorstore_path: str, backend: Optional[EmbeddingBackends] = None
+) -> EmbeddingBackends:
+    """
+    Find the embedding backend the vectorstore was built with, raising if it isn't `backend`
+
+    Query vectors from one backend are meaningless against documents embedded by another
+    """
+    from starpilot.utils.sync import load_store_info
 
+    # stores built before backends were recorded were all embedded with OpenAI
+    info = load_store_info(vectorstore_path) or {}
+    stored = EmbeddingBackends(
+        info.get("embedding_backend", EmbeddingBackends.openai.value)
+    )
+
+    if backend is not None and backend is not stored:
+        raise Exception(
+            f"The stars were embedded with the {stored.value} backend, not {backend.value}. "
+            f"Run `starpilot read --embedding-backend {backend.value}` to re-embed them"
+        )
+
+    return stored
 
-def create_retriever(
+
+def create_vectorstore(
     vectorstore_path: str,
-    k: int,
-    method: SearchMethods = SearchMethods.similarity,
-):
+    store_backend: StoreBackends,
+    embedding_function: Embeddings,
+) -> VectorStore:
     """
-    Create a retriever from a vectorstore
+    Open or create a persisted vectorstore of either kind
     """
+    if store_backend is StoreBackends.numpy:
+        from starpilot.utils.numpy_store import NumpyVectorStore
+
+        return NumpyVectorStore(
+            persist_directory=vectorstore_path, embedding_function=embedding_function
+        )
+
+    from langchain_community.vectorstores import Chroma
+
     return Chroma(
-        persist_directory=vectorstore_path,
-        embedding_function=OpenAIEmbeddings(
-            model="text-embedding-3-large"
-        ),  # type:ignore  # Tried to find a way to suppress the model card from being printed, failed: https://github.com/langchain-ai/langchain/discussions/13663 # type: ignore
-    ).as_retriever(
-        search_type=method,
-        search_kwargs={
-            "k": k,
-        },
+        persist_directory=vectorstore_path, embedding_function=embedding_function
+    )
+
+
+def open_vectorstore(
+    vectorstore_path: str, backend: Optional[EmbeddingBackends] = None
+) -> VectorStore:
+    """
+    Open a persisted vectorstore for querying with the store and embedding backend it was built with
+    """
+    from starpilot.utils.sync import load_store_info
+
+    info = load_store_info(vectorstore_path) or {}
+
+    return create_vectorstore(
+        vectorstore_path,
+        StoreBackends(info.get("store_backend", StoreBackends.chroma.value)),
+        create_embedding_function(
+            backend=check_embedding_backend(vectorstore_path, backend),
+            dimensions=info.get("dimensions"),
+        ),
+    )
+
+
+def similarity_search_by_vectors(
+    vectorstore: VectorStore, vectors: np.ndarray, k: int, where: Optional[Dict] = None
+) -> List[List[Document]]:
+    """
+    The `k` documents nearest to each of `vectors`, searched in one call to either kind of store
+    """
+    from langchain.schema.document import Document
+
+    from starpilot.utils.numpy_store import NumpyVectorStore
+
+    if len(vectors) == 0:
+        return []
+
+    if isinstance(vectorstore, NumpyVectorStore):
+        return vectorstore.similarity_search_by_vectors(vectors, k, filter=where)
+
+    results = vectorstore._collection.query(  # type: ignore
+        query_embeddings=vectors.tolist(),
+        n_results=k,
+        where=where or None,
+        include=["documents", "metadatas"],
     )
 
+    return [
+        [
+            Document(page_content=content, metadata=metadata)
+            for content, metadata in zip(contents, metadatas)
+        ]
+        for contents, metadatas in zip(results["documents"], results["metadatas"])
+    ]
+
+
+def load_stored_vectors(
+    vectorstore: VectorStore, page_floats: int = 2**21
+) -> Tuple[List[str], np.ndarray]:
+    """
+    The id and vector of every repo in the store, as one float32 matrix
+
+    Chroma is read in pages of about `page_floats` numbers, so the vectors are never all held as lists
+    of Python floats, and there are few pages for it to skip through
+    """
+    import numpy as np
+
+    from starpilot.utils.numpy_store import NumpyVectorStore
+
+    collection = vectorstore._collection  # type: ignore
+    if isinstance(vectorstore, NumpyVectorStore):
+        return list(collection.ids), np.asarray(collection.vectors, dtype=np.float32)
+
+    first = collection.get(include=["embeddings"], limit=1)
+    if not first["ids"]:
+        return [], np.zeros((0, 0), dtype=np.float32)
+    page_size = max(1, page_floats // len(first["embeddings"][0]))
+
+    ids: List[str] = []
+    blocks = []
+    for offset in range(0, collection.count(), page_size):
+        page = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+        ids.extend(page["ids"])
+        blocks.append(np.array(page["embeddings"], dtype=np.float32))
+
+    return ids, np.concatenate(blocks)
+
+
+def get_documents(vectorstore: VectorStore, ids: List[str]) -> List[Document]:
+    """
+    Fetch documents from the store by id, in the order of `ids`, skipping any it doesn't have
+    """
+    from langchain.schema.document import Document
+
+    if not ids:
+        return []
+
+    stored = vectorstore._collection.get(  # type: ignore
+        ids=ids, include=["documents", "metadatas"]
+    )
+    documents = {
+        repo_id: Document(page_content=content, metadata=metadata)
+        for repo_id, content, metadata in zip(
+            stored["ids"], stored["documents"], stored["metadatas"]
+        )
+    }
+
+    return [documents[repo_id] for repo_id in ids if repo_id in documents]
+
+
+def load_stored_repos(vectorstore: VectorStore) -> List[Dict]:
+    """
+    Every repo in the store, as formatted repos rebuilt from the documents and their metadata
+
+    A store can hold several users' stars, so indexes over the whole store are built from this
+    rather than from the repos of the user just read. Like `format_repo`, empty fields are left out,
+    so `create_document` turns each repo back into the document it came from
+    """
+    stored = vectorstore._collection.get(include=["documents", "metadatas"])  # type: ignore
+
+    repos = []
+    for content, metadata in zip(stored["documents"], stored["metadatas"]):
+        repo = {**metadata, "content": content}
+        for field in ("topics", "languages"):
+            if metadata.get(field):
+                repo[field] = metadata[field].split()
+            else:
+                repo.pop(field, None)
+        repos.append(repo)
+
+    return repos
+
 
 def create_results_table(response: List[Document]) -> Table:
     """
     Create a rich table from the response
     """
+    from rich.table import Table
+
     table = Table(title="Source Documents")
 
     table.add_column("Repo")
@@ -0,0 +1,39 @@
+import json
+import os
+from typing import Dict, Iterable, List
+
+VOCABULARY_FILENAME = "starpilot-vocabulary.json"
+
+
+def build_vocabulary(repos: Iterable[Dict]) -> Dict[str, List[str]]:
+    """
+    Collect the languages and topics of the formatted repos, for recognising them in queries
+
+    Only primary languages are collected, as they are what language filters match against
+    """
+    languages = set()
+    topics = set()
+    for repo in repos:
+        if primary_language := repo.get("primaryLanguage"):
+            languages.add(primary_language)
+        topics.update(repo.get("topics", []))
+
+    return {"languages": sorted(languages), "topics": sorted(topics)}
+
+
+def save_vocabulary(vectorstore_path: str, vocabulary: Dict[str, List[str]]) -> None:
+    path = os.path.join(vectorstore_path, VOCABULARY_FILENAME)
+
+    with open(path + ".tmp", "w") as file:
+        json.dump(vocabulary, file)
+    os.replace(path + ".tmp", path)
+
+
+def load_vocabulary(vectorstore_path: str) -> Dict[str, List[str]]:
+    path = os.path.join(vectorstore_path, VOCABULARY_FILENAME)
+
+    if not os.path.exists(path):
+        return {"languages": [], "topics": []}
+
+    with open(path) as file:
+        return json.load(file)
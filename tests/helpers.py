@@ -0,0 +1,37 @@
+from typing import List
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    """
+    Fake embeddings that record which texts were embedded
+    """
+
+    embedded: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.embedded.append(text)
+        return super().embed_query(text)
+
+
+def make_repo(name: str, stars: int, description: str = "") -> dict:
+    """
+    A starred repo as the GitHub API returns it
+    """
+    return {
+        "name": name,
+        "nameWithOwner": f"owner/{name}",
+        "owner": {"login": "owner"},
+        "url": f"https://github.com/owner/{name}",
+        "homepageUrl": None,
+        "description": description or None,
+        "repositoryTopics": {"nodes": []},
+        "stargazerCount": stars,
+        "primaryLanguage": None,
+        "languages": {"nodes": []},
+    }
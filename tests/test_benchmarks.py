@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.run import compare
+from benchmarks.stubs import corpus_login, start_stubs
+from starpilot.utils.embeddings import BatchedOpenAIEmbeddings
+from starpilot.utils.utils import format_repo, iter_user_starred_repos
+
+
+@pytest.fixture(scope="module")
+def stub_url():
+    base_url, stop = start_stubs()
+    yield base_url
+    stop()
+
+
+def test_corpus_is_deterministic():
+    assert generate_corpus(50) == generate_corpus(50)
+    assert generate_corpus(50) != generate_corpus(50, seed=1)
+
+
+def test_github_stub_pages_through_the_corpus(stub_url):
+    pages = list(
+        iter_user_starred_repos(corpus_login(250), "token", url=f"{stub_url}/graphql")
+    )
+
+    assert [len(page) for page in pages] == [100, 100, 50]
+    repos = [format_repo(repo) for page in pages for repo in page]
+    assert [repo["nameWithOwner"] for repo in repos] == [
+        node["nameWithOwner"] for node in generate_corpus(250)
+    ]
+
+
+def test_embedding_stub_returns_normalised_vectors(stub_url):
+    embeddings = BatchedOpenAIEmbeddings(
+        model="text-embedding-3-large",
+        api_key="token",
+        base_url=f"{stub_url}/v1",
+        dimensions=32,
+    )
+
+    vectors = np.array(
+        embeddings.embed_documents(
+            ["fast web server", "fast web server", "plot library"]
+        )
+    )
+
+    assert vectors.shape == (3, 32)
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1)
+    assert vectors[0] @ vectors[1] == pytest.approx(1)
+    assert vectors[0] @ vectors[2] < 0.9
+
+
+def test_compare_flags_only_large_regressions():
+    def result(seconds, rss):
+        return {
+            "peak_rss_mb": rss,
+            "stages": {
+                "embed": {"seconds": seconds},
+                "tokenise": {"skipped": "no tiktoken encoding"},
+            },
+        }
+
+    baseline = {"1000": result(1.0, 100)}
+
+    assert compare({"1000": result(1.2, 110)}, baseline, tolerance=0.25) == []
+
+    regressions = compare({"1000": result(1.5, 200)}, baseline, tolerance=0.25)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("1000 repos embed")
+
+
+def test_compare_reports_what_the_baseline_is_missing():
+    baseline = {"1000": {"peak_rss_mb": 100, "stages": {"embed": {"seconds": 1.0}}}}
+    result = {
+        "peak_rss_mb": 100,
+        "stages": {
+            "embed": {"seconds": 1.0},
+            "neighbours": {"seconds": 0.1},
+            "tokenise": {"skipped": "no tiktoken encoding"},
+        },
+    }
+
+    assert compare({"1000": result, "10000": result}, baseline, tolerance=0.25) == [
+        "1000 repos neighbours: not in the baseline",
+        "10000 repos: not in the baseline",
+    ]
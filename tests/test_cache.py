@@ -0,0 +1,70 @@
+import pytest
+
+from helpers import CountingEmbeddings
+from starpilot.utils.cache import CachedEmbeddings, EmbeddingCache, hash_text
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(path=str(tmp_path / "embeddings.sqlite3"), max_entries=3)
+
+
+def test_cached_embeddings_reuse_vectors(cache):
+    underlying = CountingEmbeddings(size=4, embedded=[])
+    embeddings = CachedEmbeddings(underlying=underlying, model="fake", cache=cache)
+
+    first = embeddings.embed_documents(["pytest", "polars"])
+    second = embeddings.embed_documents(["polars", "pytest", "tibble"])
+
+    assert underlying.embedded == ["pytest", "polars", "tibble"]
+    assert second[0] == pytest.approx(first[1])
+    assert second[1] == pytest.approx(first[0])
+    assert cache.hits == 2
+    assert cache.misses == 3
+
+    embeddings.embed_query("pytest")
+    assert underlying.embedded == ["pytest", "polars", "tibble"]
+
+
+def test_cache_is_keyed_by_model(cache):
+    underlying = CountingEmbeddings(size=4, embedded=[])
+
+    CachedEmbeddings(underlying, model="small", cache=cache).embed_query("pytest")
+    CachedEmbeddings(underlying, model="large", cache=cache).embed_query("pytest")
+
+    assert underlying.embedded == ["pytest", "pytest"]
+
+
+def test_cache_evicts_least_recently_used(cache):
+    cache.put("fake", {hash_text(text): [1.0] for text in ["a", "b", "c"]})
+    cache.get("fake", [hash_text("a")])
+    cache.put("fake", {hash_text("d"): [1.0]})
+
+    found = cache.get("fake", [hash_text(text) for text in ["a", "b", "c", "d"]])
+
+    assert hash_text("b") not in found
+    assert len(found) == 3
+
+
+def test_query_embeddings_are_cached_by_the_text_embedded(cache):
+    underlying = CountingEmbeddings(size=4, embedded=[])
+    embeddings = CachedEmbeddings(underlying=underlying, model="fake", cache=cache)
+
+    embeddings.embed_query("React hooks")
+    embeddings.embed_query("react hooks")
+    embeddings.embed_queries(["React hooks", "react hooks", "react hooks"])
+
+    # each spelling gets its own vector, never the one cached for another spelling
+    assert underlying.embedded == ["React hooks", "react hooks"]
+
+
+def test_embed_queries_only_embeds_misses_in_one_call(cache):
+    underlying = CountingEmbeddings(size=4, embedded=[])
+    embeddings = CachedEmbeddings(underlying=underlying, model="fake", cache=cache)
+
+    single = embeddings.embed_query("polars")
+    batch = embeddings.embed_queries(["polars", "pytest", "pytest"])
+
+    assert underlying.embedded == ["polars", "pytest"]
+    assert batch[0] == pytest.approx(single)
+    assert batch[1] == pytest.approx(batch[2])
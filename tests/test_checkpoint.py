@@ -0,0 +1,91 @@
+import starpilot.utils.generations as generations
+from helpers import CountingEmbeddings, make_repo
+from starpilot.utils.checkpoint import ReadCheckpoint, find_resumable
+from starpilot.utils.numpy_store import NumpyVectorStore
+from starpilot.utils.sync import load_manifest, save_manifest, stream_into_vectorstore
+
+
+SETTINGS = {"user": "fakeuser", "k": None, "copied_from": None}
+
+
+def test_checkpoint_keeps_pages_and_fetch_state(tmp_path):
+    path = str(tmp_path)
+    checkpoint = ReadCheckpoint.create(path, SETTINGS)
+    checkpoint.add_page([make_repo("a", 1)], {"after_cursor": "a"})
+    checkpoint.add_page([make_repo("b", 2)], {"after_cursor": "b"})
+
+    # the read was killed while appending a page
+    with open(checkpoint.path, "a") as file:
+        file.write('{"repos": [{"na')
+
+    loaded = ReadCheckpoint.load(path)
+
+    assert loaded.settings == SETTINGS
+    assert [[repo["name"] for repo in page] for page in loaded.pages] == [["a"], ["b"]]
+    assert loaded.fetch_state == {"after_cursor": "b"}
+
+    # the half written page is dropped, so the next page is appended after a whole one
+    loaded.add_page([make_repo("c", 3)], {"after_cursor": None})
+    assert len(ReadCheckpoint.load(path).pages) == 3
+
+    loaded.remove()
+    assert ReadCheckpoint.load(path) is None
+
+
+def test_find_resumable_only_matches_the_same_read(tmp_path):
+    root = str(tmp_path)
+    published = generations.create_generation(root)
+    ReadCheckpoint.create(published, SETTINGS)
+    generations.publish(root, published)
+
+    assert find_resumable(root, SETTINGS) is None
+
+    interrupted = generations.create_generation(root)
+    ReadCheckpoint.create(interrupted, SETTINGS)
+
+    assert find_resumable(root, SETTINGS).generation_path == interrupted
+    assert find_resumable(root, {**SETTINGS, "k": 10}) is None
+
+
+def test_resumed_read_only_embeds_what_the_interrupted_read_missed(tmp_path):
+    path = str(tmp_path)
+    pages = [
+        [make_repo("a", 1), make_repo("b", 2)],
+        [make_repo("c", 3), make_repo("d", 4)],
+        [make_repo("e", 5), make_repo("f", 6)],
+    ]
+    checkpoint = ReadCheckpoint.create(path, SETTINGS)
+
+    def interrupted_pages():
+        for number, page in enumerate(pages):
+            checkpoint.add_page(page, {"after_cursor": str(number)})
+            yield page
+        # the third page arrived, but the read died before it was embedded
+        raise KeyboardInterrupt
+
+    embeddings = CountingEmbeddings(size=8, embedded=[])
+    try:
+        stream_into_vectorstore(
+            NumpyVectorStore(path, embeddings),
+            interrupted_pages(),
+            manifest={},
+            k=None,
+            batch_size=4,
+            on_batch=lambda stored: save_manifest(path, stored),
+        )
+    except KeyboardInterrupt:
+        pass
+    assert len(embeddings.embedded) == 4
+
+    embeddings.embedded.clear()
+    resumed = ReadCheckpoint.load(path)
+    manifest, kept = stream_into_vectorstore(
+        NumpyVectorStore(path, embeddings),
+        iter(resumed.pages),
+        manifest=load_manifest(path),
+        k=None,
+    )
+
+    assert embeddings.embedded == ["e", "f"]
+    assert sorted(manifest) == [f"owner/{name}" for name in "abcdef"]
+    assert [repo["name"] for repo in kept] == list("fedcba")
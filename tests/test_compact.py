@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+from langchain.schema.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import Chroma
+
+import starpilot.utils.compact as compact
+from starpilot.utils.compact import (
+    CompactIndex,
+    build_compact_index,
+    normalise,
+    quantise,
+    recall_report,
+    search_documents,
+    search_documents_batch,
+)
+from starpilot.utils.utils import Quantisations
+
+
+@pytest.fixture
+def vectors():
+    return normalise(np.random.default_rng(0).normal(size=(500, 64)))
+
+
+@pytest.mark.parametrize("quantisation", list(Quantisations))
+def test_quantise_round_trip(vectors, quantisation):
+    codes, scales = quantise(vectors, quantisation)
+
+    assert np.allclose(
+        codes.astype(np.float32) * scales[:, np.newaxis], vectors, atol=0.01
+    )
+
+
+def test_int8_is_a_quarter_of_the_size(vectors):
+    full = CompactIndex.build([str(i) for i in range(500)], vectors, Quantisations.none)
+    int8 = CompactIndex.build([str(i) for i in range(500)], vectors, Quantisations.int8)
+
+    assert int8.codes.nbytes == full.codes.nbytes // 4
+
+
+def test_compact_index_search(vectors, tmp_path):
+    ids = [f"owner/repo-{i}" for i in range(len(vectors))]
+    CompactIndex.build(ids, vectors, Quantisations.int8).save(str(tmp_path))
+    index = CompactIndex.load(str(tmp_path))
+
+    matches = index.search(vectors[7], k=3)
+
+    assert matches[0][0] == "owner/repo-7"
+    assert matches[0][1] == pytest.approx(1, abs=0.01)
+    assert len(matches) == 3
+
+    filtered = index.search(vectors[7], k=3, candidate_ids=["owner/repo-1", "gone"])
+
+    assert [repo_id for repo_id, _ in filtered] == ["owner/repo-1"]
+
+
+def test_compact_index_search_batch(vectors, monkeypatch):
+    ids = [f"owner/repo-{i}" for i in range(len(vectors))]
+    index = CompactIndex.build(ids, vectors, Quantisations.int8)
+    # a few queries per block, so the blocks are stitched back together
+    monkeypatch.setattr(compact, "MAX_SCORES", 3 * len(vectors))
+
+    queries = vectors[:10] + 0.1
+
+    for candidate_ids in [None, ids[::2]]:
+        batch = index.search_batch(queries, k=5, candidate_ids=candidate_ids)
+        single = [
+            index.search(query, k=5, candidate_ids=candidate_ids) for query in queries
+        ]
+
+        assert [[repo_id for repo_id, _ in matches] for matches in batch] == [
+            [repo_id for repo_id, _ in matches] for matches in single
+        ]
+        assert [[score for _, score in matches] for matches in batch] == [
+            pytest.approx([score for _, score in matches], rel=1e-5)
+            for matches in single
+        ]
+
+
+def test_compact_index_load_missing(tmp_path):
+    assert CompactIndex.load(str(tmp_path)) is None
+
+
+def test_recall_report(vectors):
+    report = recall_report(
+        vectors,
+        dimensions=[None, 16],
+        quantisations=[Quantisations.none, Quantisations.int8],
+        k=5,
+        sample=50,
+    )
+
+    assert [(row["dimensions"], row["quantisation"]) for row in report] == [
+        (64, "none"),
+        (64, "int8"),
+        (16, "none"),
+        (16, "int8"),
+    ]
+    assert report[0]["recall@5"] == 1
+    assert report[1]["recall@5"] > 0.9
+    assert report[1]["scored_bytes_per_vector"] < report[0]["scored_bytes_per_vector"]
+
+
+def test_recall_report_of_an_empty_store():
+    with pytest.raises(Exception, match="no stored vectors"):
+        recall_report(
+            np.zeros((0, 0)), dimensions=[None], quantisations=list(Quantisations)
+        )
+
+
+def test_search_documents_prefilters_and_reranks(tmp_path):
+    vectorstore = Chroma(
+        persist_directory=str(tmp_path),
+        embedding_function=DeterministicFakeEmbedding(size=32),
+    )
+    texts = {
+        "owner/pytest": ("pytest testing python", "Python"),
+        "owner/polars": ("polars dataframes rust", "Rust"),
+        "owner/tibble": ("tibble data frame r", "R"),
+    }
+    vectorstore.add_documents(
+        [
+            Document(
+                page_content=content,
+                metadata={"nameWithOwner": repo_id, "primaryLanguage": language},
+            )
+            for repo_id, (content, language) in texts.items()
+        ],
+        ids=list(texts),
+    )
+    index = build_compact_index(vectorstore, Quantisations.int8)
+
+    results = search_documents(
+        vectorstore, index, "polars dataframes rust", k=1, rerank_candidates=3
+    )
+
+    assert [document.metadata["nameWithOwner"] for document in results] == [
+        "owner/polars"
+    ]
+    assert results[0].page_content == "polars dataframes rust"
+
+    filtered = search_documents(
+        vectorstore,
+        index,
+        "polars dataframes rust",
+        k=3,
+        where={"primaryLanguage": {"$eq": "R"}},
+    )
+
+    assert [document.metadata["nameWithOwner"] for document in filtered] == [
+        "owner/tibble"
+    ]
+
+
+def test_search_documents_batch_matches_search_documents(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=32)
+    vectorstore = Chroma(persist_directory=str(tmp_path), embedding_function=embeddings)
+    names = [f"repo-{number}" for number in range(20)]
+    vectorstore.add_documents(
+        [
+            Document(
+                page_content=f"{name} content",
+                metadata={"nameWithOwner": f"owner/{name}", "even": number % 2 == 0},
+            )
+            for number, name in enumerate(names)
+        ],
+        ids=[f"owner/{name}" for name in names],
+    )
+    index = build_compact_index(vectorstore, Quantisations.int8)
+    queries = ["repo-3 content", "repo-12 content", "nothing like it"]
+
+    for where in [None, {"even": True}]:
+        batch = search_documents_batch(
+            vectorstore,
+            index,
+            np.array([embeddings.embed_query(query) for query in queries]),
+            k=4,
+            rerank_candidates=8,
+            where=where,
+        )
+
+        assert batch == [
+            search_documents(
+                vectorstore, index, query, k=4, rerank_candidates=8, where=where
+            )
+            for query in queries
+        ]
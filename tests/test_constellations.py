@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+from starpilot.utils.compact import normalise
+from starpilot.utils.constellations import (
+    Constellations,
+    create_constellations_table,
+    label,
+    mini_batch_kmeans,
+)
+
+THEMES = [
+    {"topics": ["dataframe", "statistics"], "primaryLanguage": "R"},
+    {"topics": ["web", "http"], "primaryLanguage": "Go"},
+    {"topics": ["cli", "terminal"], "primaryLanguage": "Rust"},
+    {"topics": ["llm", "embeddings"], "primaryLanguage": "Python"},
+]
+
+
+def themed_stars(rng, per_theme: int, start: int = 0):
+    """
+    Stars in tight groups around one direction per theme, described by that theme's topics
+    """
+    directions = np.random.default_rng(0).normal(size=(len(THEMES), 32))
+    ids, vectors, repos = [], [], {}
+    for theme, direction in enumerate(directions):
+        for number in range(start, start + per_theme):
+            repo_id = f"owner/theme-{theme}-{number}"
+            ids.append(repo_id)
+            vectors.append(direction + rng.normal(scale=0.2, size=32))
+            repos[repo_id] = {"nameWithOwner": repo_id, **THEMES[theme]}
+    return ids, np.array(vectors), repos
+
+
+def theme_of(repo_id: str) -> int:
+    return int(repo_id.split("-")[1])
+
+
+def test_mini_batch_kmeans_finds_separate_groups():
+    ids, vectors, _ = themed_stars(np.random.default_rng(1), 100)
+    vectors = normalise(vectors)
+
+    centroids = mini_batch_kmeans(vectors, 4, batch_size=64)
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+
+    # every theme lands in a cluster of its own
+    clusters = {
+        theme: set(assignments[[theme_of(repo_id) == theme for repo_id in ids]])
+        for theme in range(4)
+    }
+    assert all(len(found) == 1 for found in clusters.values())
+    assert len(set.union(*clusters.values())) == 4
+    assert np.allclose(np.linalg.norm(centroids, axis=1), 1)
+
+
+def test_label_uses_the_most_frequent_topics_and_languages():
+    repos = [
+        {"topics": ["web", "http"], "primaryLanguage": "Go"},
+        {"topics": ["web"], "primaryLanguage": "Go"},
+        {"topics": ["web", "async"]},
+        {},
+    ]
+
+    assert label(repos) == "web · Go · async"
+    assert label([{}]) == ""
+
+
+def test_build_labels_each_constellation(tmp_path):
+    ids, vectors, repos = themed_stars(np.random.default_rng(2), 30)
+
+    Constellations.build(ids, vectors, ids, repos, clusters=4).save(str(tmp_path))
+    constellations = Constellations.load(str(tmp_path))
+
+    summary = constellations.summary(members=3)
+    assert sorted(constellation["label"] for constellation in summary) == sorted(
+        f"{theme['primaryLanguage']} · {' · '.join(sorted(theme['topics']))}"
+        for theme in THEMES
+    )
+    assert [constellation["size"] for constellation in summary] == [30] * 4
+    for constellation in summary:
+        members = constellation["members"]
+        assert len(members) == 3
+        assert len({theme_of(repo_id) for repo_id in members}) == 1
+        # the most typical stars come first
+        similarities = [
+            constellations.similarities[constellations.ids.index(repo_id)]
+            for repo_id in members
+        ]
+        assert similarities == sorted(similarities, reverse=True)
+
+    assert Constellations.load(str(tmp_path / "missing")) is None
+
+
+def test_summary_of_one_users_stars():
+    ids, vectors, repos = themed_stars(np.random.default_rng(3), 10)
+    constellations = Constellations.build(ids, vectors, ids, repos, clusters=4)
+
+    summary = constellations.summary(
+        members=0, candidate_ids={repo_id for repo_id in ids if theme_of(repo_id) < 2}
+    )
+
+    assert len(summary) == 2
+    assert all(len(constellation["members"]) == 10 for constellation in summary)
+    assert "Constellations" == create_constellations_table(summary).title
+
+
+def test_sync_places_new_stars_in_the_nearest_constellation():
+    rng = np.random.default_rng(4)
+    ids, vectors, repos = themed_stars(rng, 30)
+    previous = Constellations.build(ids, vectors, ids, repos, clusters=4)
+
+    new_ids, new_vectors, new_repos = themed_stars(rng, 2, start=30)
+    # one star is unstarred, and one gets a new description
+    ids, vectors = ids[1:] + new_ids, np.concatenate([vectors[1:], new_vectors])
+    hashes = list(ids)
+    hashes[0] = "changed"
+
+    constellations = Constellations.build(
+        ids, vectors, hashes, {**repos, **new_repos}, previous=previous
+    )
+
+    assert np.array_equal(constellations.centroids, previous.centroids)
+    assert constellations.placed == len(new_ids) + 1
+    cluster_of_theme = {
+        theme_of(repo_id): cluster
+        for repo_id, cluster in zip(previous.ids, previous.assignments)
+    }
+    assert all(
+        cluster == cluster_of_theme[theme_of(repo_id)]
+        for repo_id, cluster in zip(constellations.ids, constellations.assignments)
+    )
+
+
+@pytest.mark.parametrize("changed", [10, 40])
+def test_sync_clusters_again_once_many_stars_were_placed(changed):
+    ids, vectors, repos = themed_stars(np.random.default_rng(5), 25)
+    previous = Constellations.build(ids, vectors, ids, repos, clusters=4)
+
+    hashes = [f"changed-{repo_id}" for repo_id in ids[:changed]] + ids[changed:]
+    constellations = Constellations.build(
+        ids, vectors, hashes, repos, previous=previous
+    )
+
+    # 10 of 100 stars are placed, but 40 is more than a quarter of them
+    assert constellations.placed == (10 if changed == 10 else 0)
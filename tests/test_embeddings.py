@@ -0,0 +1,149 @@
+import asyncio
+
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from starpilot.utils.embeddings import (
+    BatchedOpenAIEmbeddings,
+    LocalEmbeddings,
+    pack_batches,
+)
+
+
+def test_pack_batches_bounds_items_and_tokens():
+    assert pack_batches([1, 1, 1, 1, 1], max_items=2, max_tokens=100) == [
+        [0, 1],
+        [2, 3],
+        [4],
+    ]
+    assert pack_batches([5, 5, 5, 20], max_items=10, max_tokens=10) == [
+        [0, 1],
+        [2],
+        [3],
+    ]
+
+
+def fake_vector(text: str) -> list:
+    return [float(len(text)), float(sum(map(ord, text)) % 97)]
+
+
+def test_batched_embeddings_against_stub_server():
+    requests = []
+    in_flight = {"now": 0, "max": 0}
+
+    async def embeddings(request: web.Request) -> web.Response:
+        payload = await request.json()
+        requests.append(payload["input"])
+
+        assert request.headers["Authorization"] == "Bearer fake-key"
+        assert payload["model"] == "fake-model"
+
+        # rate limit the very first request
+        if len(requests) == 1:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached"}},
+                status=429,
+                headers={"retry-after-ms": "10"},
+            )
+
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+
+        data = [
+            {"object": "embedding", "index": index, "embedding": fake_vector(text)}
+            for index, text in enumerate(payload["input"])
+        ]
+        # answer out of order, the client should put them back
+        return web.json_response({"object": "list", "data": data[::-1]})
+
+    texts = [f"repo number {number}" for number in range(10)]
+
+    async def _run():
+        app = web.Application()
+        app.router.add_post("/v1/embeddings", embeddings)
+
+        async with TestServer(app) as server:
+            client = BatchedOpenAIEmbeddings(
+                model="fake-model",
+                api_key="fake-key",
+                base_url=str(server.make_url("/v1")),
+                max_concurrency=2,
+                max_items=3,
+            )
+            return client, await client.aembed_documents(texts)
+
+    client, vectors = asyncio.run(_run())
+
+    assert vectors == [fake_vector(text) for text in texts]
+    assert client.retries == 1
+    # 4 batches of at most 3, plus the rate limited retry
+    assert len(requests) == 5
+    assert in_flight["max"] == 2
+
+
+class FakeEncoding:
+    def __init__(self, ids: list, attention_mask: list):
+        self.ids = ids
+        self.attention_mask = attention_mask
+
+
+class FakeTokenizer:
+    """
+    One token per word, padded to the longest text in the batch
+    """
+
+    def encode_batch(self, texts: list) -> list:
+        lengths = [len(text.split()) for text in texts]
+        longest = max(lengths)
+        return [
+            FakeEncoding(
+                ids=[1] * length + [0] * (longest - length),
+                attention_mask=[1] * length + [0] * (longest - length),
+            )
+            for length in lengths
+        ]
+
+
+class FakeSession:
+    """
+    Every real token of a text embeds to [1, number of words], padding embeds to garbage
+    """
+
+    def __init__(self):
+        self.shapes = []
+
+    def run(self, outputs, inputs: dict) -> list:
+        attention_mask = inputs["attention_mask"]
+        self.shapes.append(attention_mask.shape)
+        lengths = attention_mask.sum(axis=1, keepdims=True)
+        hidden = np.where(
+            attention_mask[:, :, np.newaxis] == 1,
+            np.stack(
+                [
+                    np.ones_like(attention_mask),
+                    np.broadcast_to(lengths, attention_mask.shape),
+                ],
+                axis=-1,
+            ),
+            100,
+        )
+        return [hidden.astype(np.float32)]
+
+
+def test_local_embeddings_pool_batches_of_similar_length():
+    texts = ["a b c d", "a", "a b c d e f", "a b", "a b c"]
+
+    embeddings = LocalEmbeddings(batch_size=2)
+    embeddings._tokenizer = FakeTokenizer()
+    embeddings._session = session = FakeSession()
+
+    vectors = embeddings.embed_documents(texts)
+
+    for text, vector in zip(texts, vectors):
+        expected = np.array([1, len(text.split())], dtype=np.float32)
+        assert np.allclose(vector, expected / np.linalg.norm(expected))
+    # sorted by length, so each batch is only padded to its own longest text
+    assert session.shapes == [(2, 2), (2, 4), (1, 6)]
@@ -0,0 +1,196 @@
+import time
+
+import numpy as np
+import pytest
+from langchain.chains.query_constructor.ir import (
+    Comparator,
+    Comparison,
+    Operation,
+    Operator,
+)
+from langchain.schema.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from starpilot.utils.facets import FacetIndex
+from starpilot.utils.numpy_store import NumpyVectorStore
+from starpilot.utils.query_cache import ParsedQueryCache
+from starpilot.utils.vocabulary import build_vocabulary, save_vocabulary
+from starpilot.utils.server import QueryEngine
+from starpilot.utils.sync import save_store_info, save_users
+
+LANGUAGES = ["Python", "Rust", "R", "Jupyter Notebook", "C++"]
+TOPICS = ["cli", "dataframe", "machine-learning", "tidyverse", "web"]
+
+
+def make_records(number: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "nameWithOwner": f"owner-{position % 7}/repo-{position}",
+            "stargazerCount": int(rng.integers(0, 1000)),
+            "primaryLanguage": LANGUAGES[position % len(LANGUAGES)],
+            "languages": sorted(
+                set(rng.choice(LANGUAGES, size=int(rng.integers(1, 4))))
+            ),
+            "topics": sorted(set(rng.choice(TOPICS, size=int(rng.integers(0, 3))))),
+        }
+        for position in range(number)
+    ]
+
+
+def matches(record, filter):
+    if isinstance(filter, Operation):
+        results = [matches(record, argument) for argument in filter.arguments]
+        return all(results) if filter.operator is Operator.AND else any(results)
+
+    value = record.get(filter.attribute, [])
+    if filter.attribute == "owner":
+        value = record["nameWithOwner"].split("/")[0]
+    values = value if isinstance(value, list) else [value]
+    return {
+        Comparator.EQ: lambda: filter.value in values,
+        Comparator.CONTAIN: lambda: filter.value in values,
+        Comparator.NE: lambda: filter.value not in values,
+        Comparator.IN: lambda: bool(set(filter.value) & set(values)),
+        Comparator.NIN: lambda: not set(filter.value) & set(values),
+        Comparator.GT: lambda: value > filter.value,
+        Comparator.GTE: lambda: value >= filter.value,
+        Comparator.LT: lambda: value < filter.value,
+        Comparator.LTE: lambda: value <= filter.value,
+    }[filter.comparator]()
+
+
+FILTERS = [
+    Comparison(comparator=Comparator.EQ, attribute="primaryLanguage", value="Rust"),
+    Comparison(comparator=Comparator.CONTAIN, attribute="topics", value="cli"),
+    Comparison(comparator=Comparator.EQ, attribute="topics", value="dataframe"),
+    Comparison(
+        comparator=Comparator.IN,
+        attribute="languages",
+        value=["Jupyter Notebook", "C++"],
+    ),
+    Comparison(comparator=Comparator.NIN, attribute="topics", value=["web", "cli"]),
+    Comparison(comparator=Comparator.NE, attribute="owner", value="owner-3"),
+    Operation(
+        operator=Operator.AND,
+        arguments=[
+            Comparison(
+                comparator=Comparator.GTE, attribute="stargazerCount", value=500
+            ),
+            Comparison(comparator=Comparator.LT, attribute="stargazerCount", value=750),
+            Operation(
+                operator=Operator.OR,
+                arguments=[
+                    Comparison(
+                        comparator=Comparator.CONTAIN,
+                        attribute="languages",
+                        value="Python",
+                    ),
+                    Comparison(
+                        comparator=Comparator.EQ, attribute="owner", value="owner-1"
+                    ),
+                ],
+            ),
+        ],
+    ),
+]
+
+
+@pytest.mark.parametrize("filter", FILTERS)
+def test_candidates_match_a_scan(filter):
+    records = make_records(500)
+    index = FacetIndex.build(records)
+
+    assert index.candidates(filter) == [
+        record["nameWithOwner"] for record in records if matches(record, filter)
+    ]
+
+
+def test_candidates_of_users_and_unsupported_filters():
+    records = make_records(20)
+    index = FacetIndex.build(
+        records, users={"Alice": ["owner-1/repo-1", "owner-2/repo-2", "gone/repo"]}
+    )
+
+    alice = Comparison(comparator=Comparator.EQ, attribute="user:alice", value=True)
+    not_alice = Comparison(
+        comparator=Comparator.EQ, attribute="user:alice", value=False
+    )
+
+    assert index.candidates(alice) == ["owner-1/repo-1", "owner-2/repo-2"]
+    assert len(index.candidates(not_alice)) == 18
+    assert index.candidates(
+        Comparison(comparator=Comparator.EQ, attribute="primaryLanguage", value="r")
+    ) == [record["nameWithOwner"] for record in records[2::5]]
+    assert (
+        index.candidates(
+            Comparison(comparator=Comparator.LIKE, attribute="name", value="repo")
+        )
+        is None
+    )
+    assert index.candidates(None) is None
+
+
+def test_facet_index_round_trip(tmp_path):
+    records = make_records(50)
+    FacetIndex.build(records, users={"alice": ["owner-1/repo-1"]}).save(str(tmp_path))
+    index = FacetIndex.load(str(tmp_path))
+
+    assert index.records() == {
+        record["nameWithOwner"]: {
+            **{key: value for key, value in record.items() if value != []},
+            "owner": record["nameWithOwner"].split("/")[0],
+        }
+        for record in records
+    }
+    assert index.candidates(
+        Comparison(comparator=Comparator.EQ, attribute="user:alice", value=True)
+    ) == ["owner-1/repo-1"]
+    assert FacetIndex.load(str(tmp_path / "missing")) is None
+
+
+def test_candidates_are_fast():
+    index = FacetIndex.build(make_records(10_000))
+
+    start = time.perf_counter()
+    for _ in range(100):
+        index.candidates(FILTERS[-1])
+
+    assert (time.perf_counter() - start) / 100 < 0.005
+
+
+def test_astrologer_searches_facet_candidates(tmp_path):
+    path = str(tmp_path / "store")
+    embeddings = DeterministicFakeEmbedding(size=16)
+    records = make_records(30)
+    documents = [
+        Document(
+            page_content=" ".join(record["topics"]) or "repo",
+            metadata={
+                "nameWithOwner": record["nameWithOwner"],
+                "primaryLanguage": record["primaryLanguage"],
+                "stargazerCount": record["stargazerCount"],
+            },
+        )
+        for record in records
+    ]
+    NumpyVectorStore(path, embeddings).add_documents(
+        documents, ids=[record["nameWithOwner"] for record in records]
+    )
+    users = {"alice": [record["nameWithOwner"] for record in records[:10]]}
+    save_store_info(path, {"store_backend": "numpy"})
+    save_users(path, users)
+    save_vocabulary(path, build_vocabulary(records))
+    FacetIndex.build(records, users).save(path)
+
+    engine = QueryEngine(path)
+    engine.vectorstore._embedding_function = embeddings
+    engine._parsed_query_cache = ParsedQueryCache(str(tmp_path / "parsed.sqlite3"))
+
+    results = engine.astrologer("Rust dataframe", k=10, user="alice")
+
+    # only alice's Rust repos are scored
+    assert sorted(document.metadata["nameWithOwner"] for document in results) == [
+        "owner-1/repo-1",
+        "owner-6/repo-6",
+    ]
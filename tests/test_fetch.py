@@ -0,0 +1,197 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from starpilot.utils.utils import StarredReposFetch, aiter_user_starred_repos
+
+
+def make_node(name: str) -> dict:
+    return {
+        "name": name,
+        "nameWithOwner": f"fakeuser/{name}",
+        "owner": {"login": "fakeuser"},
+        "url": f"https://github.com/fakeuser/{name}",
+        "homepageUrl": None,
+        "description": None,
+        "repositoryTopics": {"nodes": []},
+        "stargazerCount": 1,
+        "primaryLanguage": None,
+        "languages": {"nodes": []},
+    }
+
+
+def starred_at(name: str) -> str:
+    # "a" was starred last, and pages come newest first
+    return f"2024-01-{30 - (ord(name) - ord('a')):02d}T00:00:00Z"
+
+
+def make_page(names, end_cursor, has_next_page, total_count=5) -> dict:
+    return {
+        "data": {
+            "user": {
+                "login": "fakeuser",
+                "name": "Fake User",
+                "starredRepositories": {
+                    "totalCount": total_count,
+                    "pageInfo": {
+                        "hasNextPage": has_next_page,
+                        "endCursor": end_cursor,
+                    },
+                    "edges": [
+                        {
+                            "cursor": name,
+                            "starredAt": starred_at(name),
+                            "node": make_node(name),
+                        }
+                        for name in names
+                    ],
+                },
+            }
+        }
+    }
+
+
+def test_aiter_user_starred_repos_pages_and_retries():
+    pages = {
+        None: make_page(["a", "b"], "b", True),
+        "b": make_page(["c", "d"], "d", True),
+        "d": make_page(["e"], "e", False),
+    }
+    requests = []
+    failures = {"b": 1}
+
+    async def graphql(request: web.Request) -> web.Response:
+        payload = await request.json()
+        after = payload["variables"]["after"]
+        requests.append(after)
+
+        assert request.headers["Authorization"] == "Bearer fake-key"
+        assert payload["variables"]["login"] == "fakeuser"
+
+        if failures.get(after, 0):
+            failures[after] -= 1
+            return web.Response(status=502)
+
+        return web.json_response(
+            pages[after], headers={"X-RateLimit-Remaining": "4999"}
+        )
+
+    async def _run():
+        app = web.Application()
+        app.router.add_post("/graphql", graphql)
+
+        async with TestServer(app) as server:
+            return [
+                page
+                async for page in aiter_user_starred_repos(
+                    "fakeuser",
+                    "fake-key",
+                    url=str(server.make_url("/graphql")),
+                    backoff=0.01,
+                )
+            ]
+
+    result = asyncio.run(_run())
+
+    assert [[repo["name"] for repo in page] for page in result] == [
+        ["a", "b"],
+        ["c", "d"],
+        ["e"],
+    ]
+    # no schema introspection, one retry for the failed page, and no empty trailing page
+    assert requests == [None, "b", "b", "d"]
+
+
+def fetch_pages(pages, fetch, **kwargs):
+    requests = []
+
+    async def graphql(request: web.Request) -> web.Response:
+        after = (await request.json())["variables"]["after"]
+        requests.append(after)
+        return web.json_response(pages[after])
+
+    async def _run():
+        app = web.Application()
+        app.router.add_post("/graphql", graphql)
+
+        async with TestServer(app) as server:
+            return [
+                [repo["name"] for repo in page]
+                async for page in aiter_user_starred_repos(
+                    "fakeuser",
+                    "fake-key",
+                    url=str(server.make_url("/graphql")),
+                    fetch=fetch,
+                    **kwargs,
+                )
+            ]
+
+    return asyncio.run(_run()), requests
+
+
+def make_pages(total_count=5):
+    return {
+        None: make_page(["a", "b"], "b", True, total_count),
+        "b": make_page(["c", "d"], "d", True, total_count),
+        "d": make_page(["e"], "e", False, total_count),
+    }
+
+
+def test_fetch_stops_at_stars_already_read():
+    # c, d and e were read last time, a and b have been starred since
+    fetch = StarredReposFetch(since=starred_at("c"), known_total=3)
+
+    result, requests = fetch_pages(make_pages(), fetch)
+
+    assert result == [["a", "b"], []]
+    assert requests == [None, "b"]
+    assert not fetch.complete
+    assert fetch.new_stars == 2
+    assert fetch.newest_starred_at == starred_at("a")
+    assert fetch.total_count == 5
+
+
+def test_fetch_without_new_stars_costs_one_request():
+    fetch = StarredReposFetch(since=starred_at("a"), known_total=5)
+
+    result, requests = fetch_pages(make_pages(), fetch)
+
+    assert result == [[]]
+    assert requests == [None]
+    assert fetch.newest_starred_at == starred_at("a")
+
+
+def test_fetch_reads_every_star_when_counts_disagree():
+    # one of the three stars read last time has been unstarred, and a and b starred
+    fetch = StarredReposFetch(since=starred_at("c"), known_total=4)
+
+    result, requests = fetch_pages(make_pages(total_count=5), fetch)
+
+    assert result == [["a", "b"], ["c", "d"], ["e"]]
+    assert requests == [None, "b", "d"]
+    assert fetch.complete
+
+
+def test_fetch_without_a_previous_read_is_complete():
+    fetch = StarredReposFetch()
+
+    result, _ = fetch_pages(make_pages(), fetch)
+
+    assert result == [["a", "b"], ["c", "d"], ["e"]]
+    assert fetch.complete
+    assert fetch.newest_starred_at == starred_at("a")
+
+
+def test_fetch_resumes_from_a_saved_state():
+    fetch = StarredReposFetch()
+    states = []
+    fetch_pages(make_pages(), fetch, on_page=lambda repos: states.append(fetch.state()))
+
+    # the read was interrupted after the first page
+    resumed = StarredReposFetch.from_state(states[0])
+    result, requests = fetch_pages(make_pages(), resumed, after=resumed.after_cursor)
+
+    assert result == [["c", "d"], ["e"]]
+    assert requests == ["b", "d"]
+    assert resumed.state() == fetch.state()
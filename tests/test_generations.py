@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+import starpilot.utils.generations as generations
+from starpilot.utils.lexical import LexicalIndex
+from starpilot.utils.numpy_store import NumpyVectorStore
+from starpilot.utils.server import QueryEngine
+from starpilot.utils.sync import save_manifest, save_store_info
+from starpilot.utils.utils import create_document
+
+
+def write_store(path: str, names) -> None:
+    repos = [
+        {"name": name, "nameWithOwner": f"owner/{name}", "stargazerCount": 1}
+        for name in names
+    ]
+    for repo in repos:
+        repo["content"] = f"{repo['name']} tidyverse"
+    documents = [create_document(repo) for repo in repos]
+    NumpyVectorStore(path, DeterministicFakeEmbedding(size=8)).add_documents(
+        documents, ids=[repo["nameWithOwner"] for repo in repos]
+    )
+    save_store_info(path, {"store_backend": "numpy"})
+    save_manifest(path, {repo["nameWithOwner"]: {} for repo in repos})
+    LexicalIndex.build(repos).save(path)
+
+
+def test_current_path_before_any_read(tmp_path):
+    root = str(tmp_path / "store")
+
+    assert generations.current_path(root) is None
+
+    # a lock left by a read that failed isn't a store
+    with generations.write_lock(root):
+        pass
+    assert generations.current_path(root) is None
+
+
+def test_store_from_before_generations_is_read_in_place_then_moved(tmp_path):
+    root = str(tmp_path)
+    write_store(root, ["dplyr"])
+
+    assert generations.current_path(root) == root
+
+    with generations.write_lock(root):
+        path = generations.create_generation(root, copy_from=root)
+        generations.publish(root, path)
+        generations.collect_garbage(root)
+
+    assert generations.current_path(root) == path
+    assert sorted(os.listdir(root)) == ["current", "generations", "read.lock"]
+    assert "starpilot-manifest.json" in os.listdir(path)
+
+
+def test_publish_keeps_the_previous_generation(tmp_path):
+    root = str(tmp_path)
+    paths = []
+    for _ in range(3):
+        with generations.write_lock(root):
+            current = generations.current_path(root)
+            path = generations.create_generation(root, copy_from=current)
+            paths.append(path)
+            generations.publish(root, path)
+            generations.collect_garbage(root)
+
+    assert generations.current_path(root) == paths[2]
+    assert generations.previous_path(root) == paths[1]
+    assert sorted(os.listdir(os.path.join(root, "generations"))) == sorted(
+        os.path.basename(path) for path in paths[1:]
+    )
+
+    assert generations.rollback(root) == paths[1]
+    assert generations.current_path(root) == paths[1]
+    assert generations.previous_path(root) == paths[2]
+
+
+def test_rollback_without_a_previous_generation(tmp_path):
+    with pytest.raises(Exception, match="no previous read"):
+        generations.rollback(str(tmp_path))
+
+
+def test_collect_garbage_removes_unpublished_generations(tmp_path):
+    root = str(tmp_path)
+    published = generations.create_generation(root)
+    generations.publish(root, published)
+    # a read that failed before publishing
+    abandoned = generations.create_generation(root)
+
+    generations.collect_garbage(root)
+
+    assert os.path.isdir(published)
+    assert not os.path.exists(abandoned)
+
+
+def test_write_lock_waits_for_the_other_read(tmp_path):
+    root = str(tmp_path)
+    events = []
+
+    def second_read():
+        with generations.write_lock(root):
+            events.append("second")
+
+    with generations.write_lock(root):
+        thread = threading.Thread(target=second_read)
+        thread.start()
+        time.sleep(0.2)
+        events.append("first")
+    thread.join()
+
+    assert events == ["first", "second"]
+
+
+def test_query_engine_switches_to_published_generations(tmp_path):
+    root = str(tmp_path)
+    first = generations.create_generation(root)
+    write_store(first, ["dplyr"])
+    generations.publish(root, first)
+
+    engine = QueryEngine(root)
+    assert engine.store_path == first
+    assert [
+        document.metadata["name"]
+        for document in engine.shoot("tidyverse", method="lexical")
+    ] == ["dplyr"]
+
+    # queries keep reading the first generation while the second is built
+    second = generations.create_generation(root)
+    write_store(second, ["tidyr"])
+    assert engine.shoot("tidyverse", method="lexical")[0].metadata["name"] == "dplyr"
+
+    generations.publish(root, second)
+
+    assert [
+        document.metadata["name"]
+        for document in engine.shoot("tidyverse", method="lexical")
+    ] == ["tidyr"]
+    assert engine.store_path == second
@@ -0,0 +1,167 @@
+import time
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from starpilot.utils.lexical import LexicalIndex, reciprocal_rank_fusion, tokenize
+from starpilot.utils.numpy_store import NumpyVectorStore
+from starpilot.utils.server import QueryEngine
+from starpilot.utils.sync import save_store_info, save_users, user_flag
+from starpilot.utils.utils import create_document, load_stored_repos
+
+
+def make_repo(name: str, description: str, topics=(), languages=()) -> dict:
+    return {
+        "name": name,
+        "nameWithOwner": f"owner/{name}",
+        "stargazerCount": 1,
+        "topics": list(topics),
+        "languages": list(languages),
+        "content": " ".join(filter(None, [name, description, " ".join(topics)])),
+    }
+
+
+@pytest.fixture
+def repos():
+    return [
+        make_repo(
+            "polars",
+            "Dataframes powered by a multithreaded query engine",
+            ["dataframe"],
+            ["Rust", "Python"],
+        ),
+        make_repo(
+            "pandas",
+            "Flexible and powerful data analysis library",
+            ["dataframe", "data-analysis"],
+            ["Python"],
+        ),
+        make_repo(
+            "dplyr", "A grammar of data manipulation", ["tidyverse"], ["R", "C++"]
+        ),
+        make_repo(
+            "scikit-learn",
+            "Machine learning in Python",
+            ["machine-learning"],
+            ["Python"],
+        ),
+        {"name": "empty", "nameWithOwner": "owner/empty", "stargazerCount": 1},
+    ]
+
+
+def test_tokenize():
+    assert tokenize("Scikit-learn: ML in C++ & C#") == [
+        "scikit-learn",
+        "scikit",
+        "learn",
+        "ml",
+        "in",
+        "c++",
+        "c#",
+    ]
+
+
+def test_lexical_search(repos, tmp_path):
+    LexicalIndex.build(repos).save(str(tmp_path))
+    index = LexicalIndex.load(str(tmp_path))
+
+    assert [repo_id for repo_id, _ in index.search("polars", 3)] == ["owner/polars"]
+    assert [repo_id for repo_id, _ in index.search("tidyverse", 3)] == ["owner/dplyr"]
+    assert [repo_id for repo_id, _ in index.search("learn", 3)] == [
+        "owner/scikit-learn"
+    ]
+    assert {repo_id for repo_id, _ in index.search("dataframe", 3)} == {
+        "owner/polars",
+        "owner/pandas",
+    }
+    assert index.search("haskell", 3) == []
+    assert "owner/empty" not in index.ids
+
+
+def test_lexical_search_is_fast():
+    repos = [
+        make_repo(
+            f"repo-{number}",
+            f"tool number {number} for task {number % 97}",
+            [f"topic-{number % 31}"],
+            ["Python"],
+        )
+        for number in range(10_000)
+    ]
+    index = LexicalIndex.build(repos)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        index.search("tool for task 42 topic-7", 10)
+
+    assert (time.perf_counter() - start) / 10 < 0.05
+
+
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "d"]]) == [
+        "b",
+        "c",
+        "a",
+        "d",
+    ]
+
+
+def test_query_engine_lexical_and_hybrid(repos, tmp_path):
+    path = str(tmp_path)
+    embeddings = DeterministicFakeEmbedding(size=16)
+    documents = [create_document(repo) for repo in repos if repo.get("content")]
+    NumpyVectorStore(path, embeddings).add_documents(
+        documents, ids=[document.metadata["nameWithOwner"] for document in documents]
+    )
+    save_store_info(path, {"store_backend": "numpy"})
+    LexicalIndex.build(repos).save(path)
+
+    engine = QueryEngine(path)
+    engine.vectorstore._embedding_function = embeddings
+
+    lexical = engine.shoot("tidyverse", method="lexical", k=3)
+
+    assert [document.metadata["nameWithOwner"] for document in lexical] == [
+        "owner/dplyr"
+    ]
+    assert lexical[0].page_content == "dplyr A grammar of data manipulation tidyverse"
+
+    hybrid = engine.shoot("tidyverse", method="hybrid", k=2)
+
+    # the only lexical match is fused into the top results even if its vector is far away
+    assert len(hybrid) == 2
+    assert "owner/dplyr" in [document.metadata["nameWithOwner"] for document in hybrid]
+
+
+def test_query_engine_filters_by_user(repos, tmp_path):
+    path = str(tmp_path)
+    embeddings = DeterministicFakeEmbedding(size=16)
+    documents = [create_document(repo) for repo in repos if repo.get("content")]
+    for document in documents:
+        document.metadata[user_flag("Alice")] = document.metadata["name"] != "dplyr"
+    NumpyVectorStore(path, embeddings).add_documents(
+        documents, ids=[document.metadata["nameWithOwner"] for document in documents]
+    )
+    save_store_info(path, {"store_backend": "numpy"})
+    save_users(path, {"alice": ["owner/polars", "owner/pandas", "owner/scikit-learn"]})
+    LexicalIndex.build(repos).save(path)
+
+    engine = QueryEngine(path)
+    engine.vectorstore._embedding_function = embeddings
+
+    for method in ["similarity", "lexical", "hybrid", "mmr"]:
+        results = engine.shoot("tidyverse data", method=method, k=4, user="alice")
+
+        assert results
+        assert "owner/dplyr" not in [
+            document.metadata["nameWithOwner"] for document in results
+        ]
+
+    assert len(engine.shoot("tidyverse data", k=4)) == 4
+
+    with pytest.raises(Exception, match="starpilot read bob"):
+        engine.shoot("tidyverse", user="bob")
+
+    # the index can be rebuilt from the store alone, which holds every user's repos
+    stored = LexicalIndex.build(load_stored_repos(engine.vectorstore))
+    assert stored.search("tidyverse", 3) == engine.lexical_index.search("tidyverse", 3)
@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores.utils import filter_complex_metadata
+
+import starpilot.utils.neighbours as neighbours
+from starpilot.utils.compact import normalise
+from starpilot.utils.neighbours import NeighbourGraph, build_neighbour_graph
+from starpilot.utils.server import QueryEngine
+from starpilot.utils.sync import hash_document, save_store_info, save_users, user_flag
+from starpilot.utils.utils import StoreBackends, create_document, create_vectorstore
+
+
+def clustered(rng, size: int, dimensions: int = 32, clusters: int = 20) -> np.ndarray:
+    centres = rng.normal(size=(clusters, dimensions))
+    return centres[rng.integers(0, clusters, size)] + rng.normal(
+        scale=0.7, size=(size, dimensions)
+    )
+
+
+def brute_force(vectors: np.ndarray, n: int) -> np.ndarray:
+    vectors = normalise(vectors.astype(np.float32))
+    scores = vectors @ vectors.T
+    np.fill_diagonal(scores, -np.inf)
+    return np.argsort(-scores, axis=1)[:, :n]
+
+
+@pytest.fixture
+def vectors():
+    return clustered(np.random.default_rng(0), 600)
+
+
+def test_build_matches_brute_force(vectors):
+    ids = [f"owner/repo-{number}" for number in range(len(vectors))]
+
+    graph = NeighbourGraph.build(ids, vectors, ids, n=10)
+
+    assert (graph.neighbours == brute_force(vectors, 10)).all()
+    assert (np.diff(graph.scores, axis=1) <= 0).all()
+
+
+def test_build_pads_small_stores():
+    graph = NeighbourGraph.build(["a", "b", "c"], np.eye(3, 4), ["a", "b", "c"], n=5)
+
+    assert graph.neighbours.shape == (3, 5)
+    assert (graph.neighbours[:, 2:] == -1).all()
+    assert sorted(graph.neighbours[0, :2]) == [1, 2]
+
+
+def test_approximate_build_finds_most_neighbours(vectors, monkeypatch):
+    monkeypatch.setattr(neighbours, "EXACT_PAIRS", 0)
+    ids = [str(number) for number in range(len(vectors))]
+
+    graph = NeighbourGraph.build(ids, vectors, ids, n=10)
+
+    truth = brute_force(vectors, 10)
+    recall = np.mean(
+        [
+            len(set(found) & set(true)) / 10
+            for found, true in zip(graph.neighbours, truth)
+        ]
+    )
+    assert recall > 0.9
+
+
+def test_build_from_previous_matches_a_full_build(vectors):
+    rng = np.random.default_rng(1)
+    ids = [f"owner/repo-{number}" for number in range(len(vectors))]
+    previous = NeighbourGraph.build(ids, vectors, ids, n=10)
+
+    # some repos are unstarred, some get new descriptions and some are newly starred
+    new_vectors = np.concatenate([vectors[50:], clustered(rng, 40)])
+    new_ids = ids[50:] + [f"owner/new-{number}" for number in range(40)]
+    new_hashes = list(new_ids)
+    for position in range(0, 300, 30):
+        new_vectors[position] = clustered(rng, 1)[0]
+        new_hashes[position] = "changed"
+
+    graph = NeighbourGraph.build(
+        new_ids, new_vectors, new_hashes, n=10, previous=previous
+    )
+
+    assert (graph.neighbours == brute_force(new_vectors, 10)).all()
+    assert graph.content_hashes == new_hashes
+
+
+def test_lookup_after_save_and_load(vectors, tmp_path):
+    ids = [f"owner/repo-{number}" for number in range(len(vectors))]
+    NeighbourGraph.build(ids, vectors, ids, n=10).save(str(tmp_path))
+
+    graph = NeighbourGraph.load(str(tmp_path))
+    truth = [ids[position] for position in brute_force(vectors, 10)[7]]
+
+    assert [repo_id for repo_id, _ in graph.lookup(ids[7], 3)] == truth[:3]
+    assert [repo_id for repo_id, _ in graph.lookup(ids[7], 2, set(truth[5:]))] == truth[
+        5:7
+    ]
+    # the row runs out before finding enough of the candidates
+    assert graph.lookup(ids[7], 3, set(truth[8:])) is None
+    assert graph.lookup(ids[7], 11) is None
+    assert graph.lookup("owner/missing", 3) is None
+    assert NeighbourGraph.load(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.parametrize("store_backend", [StoreBackends.numpy, StoreBackends.chroma])
+def test_query_engine_neighbours(tmp_path, store_backend):
+    path = str(tmp_path / "store")
+    repos = [
+        {
+            "name": f"repo-{number}",
+            "nameWithOwner": f"owner/repo-{number}",
+            "stargazerCount": number,
+            "content": f"repo-{number} testing",
+        }
+        for number in range(30)
+    ]
+    documents = filter_complex_metadata([create_document(repo) for repo in repos])
+    for document in documents:
+        document.metadata[user_flag("alice")] = document.metadata["stargazerCount"] < 20
+
+    vectorstore = create_vectorstore(
+        path, store_backend, DeterministicFakeEmbedding(size=16)
+    )
+    # stored vectors are unit length, like OpenAI's, so distances and cosine similarities agree
+    vectorstore._collection.upsert(
+        ids=[repo["nameWithOwner"] for repo in repos],
+        embeddings=normalise(clustered(np.random.default_rng(2), 30, 16)).tolist(),
+        documents=[document.page_content for document in documents],
+        metadatas=[document.metadata for document in documents],
+    )
+    save_store_info(path, {"store_backend": store_backend.value})
+    save_users(path, {"alice": [repo["nameWithOwner"] for repo in repos[:20]]})
+    build_neighbour_graph(
+        vectorstore,
+        {
+            document.metadata["nameWithOwner"]: hash_document(document)
+            for document in documents
+        },
+    ).save(path)
+
+    engine = QueryEngine(path)
+
+    def _neighbours(repo, **options):
+        return [
+            document.metadata["nameWithOwner"]
+            for document in engine.neighbours(repo, **options)
+        ]
+
+    from_graph = _neighbours("OWNER/Repo-3", k=4)
+    alice_from_graph = _neighbours("owner/repo-25", k=4, user="alice")
+    assert "owner/repo-3" not in from_graph
+    assert all(int(repo_id.split("-")[1]) < 20 for repo_id in alice_from_graph)
+
+    # without a graph, the repo's stored vector is searched with instead
+    engine.neighbour_graph = None
+    assert _neighbours("owner/repo-3", k=4) == from_graph
+    assert _neighbours("owner/repo-25", k=4, user="alice") == alice_from_graph
+
+    with pytest.raises(Exception, match="isn't one of the stars"):
+        engine.neighbours("owner/missing")
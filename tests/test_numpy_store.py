@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+from langchain.schema.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import Chroma
+
+from starpilot.utils.numpy_store import NumpyVectorStore
+import starpilot.utils.numpy_store as numpy_store
+from starpilot.utils.sync import apply_diff, diff_manifest, hash_document
+from starpilot.utils.utils import similarity_search_by_vectors
+
+WORDS = "python rust r data frames testing web async cli parser plot stats".split()
+
+
+@pytest.fixture(scope="module")
+def documents():
+    rng = np.random.default_rng(0)
+    return [
+        Document(
+            page_content=" ".join(rng.choice(WORDS, size=5)),
+            metadata={
+                "nameWithOwner": f"owner/repo-{number}",
+                "primaryLanguage": ["Python", "Rust", "R"][number % 3],
+                "stargazerCount": int(rng.integers(0, 1000)),
+            },
+        )
+        for number in range(60)
+    ]
+
+
+@pytest.fixture(scope="module")
+def stores(tmp_path_factory, documents):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    ids = [document.metadata["nameWithOwner"] for document in documents]
+
+    chroma = Chroma(
+        persist_directory=str(tmp_path_factory.mktemp("chroma")),
+        embedding_function=embeddings,
+    )
+    chroma.add_documents(documents, ids=ids)
+
+    path = str(tmp_path_factory.mktemp("numpy"))
+    NumpyVectorStore(path, embeddings).add_documents(documents, ids=ids)
+
+    # reopened, so the searches run against the memory mapped matrix
+    return chroma, NumpyVectorStore(path, embeddings)
+
+
+def names(documents):
+    return [document.metadata["nameWithOwner"] for document in documents]
+
+
+@pytest.mark.parametrize(
+    "where",
+    [
+        None,
+        {"primaryLanguage": "Rust"},
+        {
+            "$and": [
+                {"stargazerCount": {"$gte": 300}},
+                {"primaryLanguage": {"$in": ["Python", "R"]}},
+            ]
+        },
+    ],
+)
+def test_similarity_matches_chroma(stores, where):
+    chroma, numpy_store = stores
+
+    expected = chroma.similarity_search_with_score(
+        "rust data frames", k=8, filter=where
+    )
+    results = numpy_store.similarity_search_with_score(
+        "rust data frames", k=8, filter=where
+    )
+
+    assert names(document for document, _ in results) == names(
+        document for document, _ in expected
+    )
+    assert [score for _, score in results] == pytest.approx(
+        [score for _, score in expected], rel=1e-4
+    )
+    assert [document for document, _ in results] == [
+        document for document, _ in expected
+    ]
+
+
+@pytest.mark.parametrize("where", [None, {"primaryLanguage": "Rust"}])
+def test_batch_similarity_matches_single_queries(stores, where, monkeypatch):
+    chroma, numpy_store_ = stores
+    # two queries per block, so the blocks are stitched back together
+    monkeypatch.setattr(numpy_store, "MAX_DISTANCES", 2 * 60)
+
+    queries = ["rust data frames", "async web parser", "python testing", "plot"]
+    vectors = np.array(
+        [numpy_store_.embeddings.embed_query(query) for query in queries]
+    )
+
+    for store in stores:
+        assert [
+            names(documents)
+            for documents in similarity_search_by_vectors(store, vectors, 6, where)
+        ] == [
+            names(store.similarity_search(query, k=6, filter=where))
+            for query in queries
+        ]
+
+
+@pytest.mark.parametrize(
+    "search_type, search_kwargs",
+    [
+        ("similarity_score_threshold", {"k": 10, "score_threshold": -11.5}),
+        ("mmr", {"k": 4, "fetch_k": 12}),
+    ],
+)
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_retrievers_match_chroma(stores, search_type, search_kwargs):
+    chroma, numpy_store = stores
+
+    expected = chroma.as_retriever(
+        search_type=search_type, search_kwargs=search_kwargs
+    ).get_relevant_documents("async web parser")
+    results = numpy_store.as_retriever(
+        search_type=search_type, search_kwargs=search_kwargs
+    ).get_relevant_documents("async web parser")
+
+    assert names(results) == names(expected)
+    assert results
+
+
+def test_numpy_store_syncs(tmp_path, documents):
+    store = NumpyVectorStore(str(tmp_path), DeterministicFakeEmbedding(size=16))
+    apply_diff(store, diff_manifest({}, documents[:3]))
+
+    changed = Document(
+        page_content=documents[1].page_content,
+        metadata={**documents[1].metadata, "stargazerCount": 5000},
+    )
+    manifest = {
+        document.metadata["nameWithOwner"]: hash_document(document)
+        for document in documents[:3]
+    }
+    apply_diff(store, diff_manifest(manifest, [documents[0], changed]))
+
+    reopened = NumpyVectorStore(str(tmp_path), DeterministicFakeEmbedding(size=16))
+    stored = reopened._collection.get(include=["metadatas"])
+
+    assert stored["ids"] == ["owner/repo-0", "owner/repo-1"]
+    assert stored["metadatas"][1]["stargazerCount"] == 5000
+
+
+def test_batches_are_journalled_rather_than_rewriting_the_store(tmp_path):
+    rng = np.random.default_rng(1)
+    collection = numpy_store.NumpyCollection(str(tmp_path))
+    vectors = rng.normal(size=(30, 4)).astype(np.float32)
+    ids = [f"owner/repo-{number}" for number in range(30)]
+
+    collection.upsert(ids[:20], vectors[:20], ids[:20], [{"stars": 1}] * 20)
+    for start in (20, 25):
+        collection.upsert(
+            ids[start : start + 5],
+            vectors[start : start + 5],
+            ids[start : start + 5],
+            [{"stars": 2}] * 5,
+        )
+
+    # the batches were appended, and the matrix file has room for more
+    assert not (tmp_path / numpy_store.DOCUMENTS_FILENAME).exists()
+    assert len(np.load(tmp_path / numpy_store.VECTORS_FILENAME)) == 1024
+    # an entry the write was interrupted in the middle of is ignored
+    with open(tmp_path / numpy_store.JOURNAL_FILENAME, "a") as file:
+        file.write('{"ids": ["owner/half')
+
+    reopened = numpy_store.NumpyCollection(str(tmp_path))
+    assert reopened.ids == ids
+    assert np.array_equal(reopened.vectors, vectors)
+    assert [reopened._metadata(position)["stars"] for position in (0, 29)] == [1, 2]
+
+    # once the journal holds more rows than the store, the store is written whole
+    reopened.update(ids[:2], [{"stars": 3}] * 2)
+    assert not (tmp_path / numpy_store.JOURNAL_FILENAME).exists()
+    rewritten = numpy_store.NumpyCollection(str(tmp_path))
+    assert np.array_equal(rewritten.vectors, vectors)
+    assert rewritten._metadata(0)["stars"] == 3
@@ -0,0 +1,99 @@
+import inspect
+import json
+import pstats
+import threading
+
+import typer
+
+import starpilot.utils.profiling as profiling
+from benchmarks.stubs import corpus_login, start_stubs
+from starpilot.utils.utils import iter_user_starred_repos
+
+
+def test_spans_are_totalled_by_stage():
+    with profiling.profile_run("test") as run:
+        for _ in range(3):
+            with profiling.span("format", repos=10) as span:
+                span.add(bytes=100)
+        with profiling.span("index"):
+            pass
+
+    assert run.stages["format"]["calls"] == 3
+    assert run.stages["format"]["counts"] == {"repos": 30, "bytes": 300}
+    assert run.stages["index"]["calls"] == 1
+    assert run.stages["format"]["seconds"] >= 0
+
+
+def test_record_reaches_spans_open_in_other_threads():
+    with profiling.profile_run("test") as run:
+        with profiling.span("outer"):
+            with profiling.span("inner"):
+                thread = threading.Thread(
+                    target=lambda: profiling.record(github_api_calls=2)
+                )
+                thread.start()
+                thread.join()
+            profiling.record(github_retries=1)
+
+    # outside a span nothing is recorded
+    profiling.record(github_api_calls=5)
+
+    assert run.stages["inner"]["counts"] == {"github_api_calls": 2}
+    assert run.stages["outer"]["counts"] == {"github_api_calls": 2, "github_retries": 1}
+
+
+def test_profile_writes_stats_and_summary(tmp_path):
+    with profiling.profile_run("test", profile=True, profile_dir=str(tmp_path)):
+        with profiling.span("embed", texts=4):
+            sum(range(1000))
+
+    (stats_path,) = tmp_path.glob("test-*.prof")
+    (summary_path,) = tmp_path.glob("test-*.json")
+
+    assert pstats.Stats(str(stats_path)).total_calls > 0
+    summary = json.loads(summary_path.read_text())
+    assert summary["command"] == "test"
+    assert summary["failed"] is False
+    assert summary["stages"]["embed"]["texts"] == 4
+    assert summary["stages"]["embed"]["calls"] == 1
+    assert summary["machine"]["cpu_count"] > 0
+
+
+def test_failed_runs_are_still_summarised(tmp_path):
+    try:
+        with profiling.profile_run("test", profile=True, profile_dir=str(tmp_path)):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+
+    (summary_path,) = tmp_path.glob("test-*.json")
+    assert json.loads(summary_path.read_text())["failed"] is True
+
+
+def test_profiled_keeps_the_command_signature():
+    @profiling.profiled("hello")
+    def hello(name: str, profile: bool = typer.Option(False)) -> str:
+        with profiling.span("greet"):
+            return f"hello {name}"
+
+    assert list(inspect.signature(hello).parameters) == ["name", "profile"]
+    assert hello(name="world", profile=False) == "hello world"
+
+
+def test_fetch_counts_github_pages_and_calls():
+    base_url, stop = start_stubs()
+    try:
+        with profiling.profile_run("test") as run:
+            with profiling.span("read"):
+                pages = list(
+                    iter_user_starred_repos(
+                        corpus_login(250), "token", url=f"{base_url}/graphql"
+                    )
+                )
+    finally:
+        stop()
+
+    assert len(pages) == 3
+    assert run.stages["fetch"]["counts"]["repos"] == 250
+    # requests for the next page are made while this thread is busy elsewhere too
+    assert run.stages["read"]["counts"]["github_api_calls"] == 3
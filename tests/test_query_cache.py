@@ -0,0 +1,66 @@
+import pytest
+
+import starpilot.utils.server as server
+from starpilot.utils.query_cache import QueryResultCache
+from starpilot.utils.sync import save_store_info
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return QueryResultCache(path=str(tmp_path / "results.sqlite3"), max_entries=2)
+
+
+def test_result_cache_key():
+    key = QueryResultCache.key(
+        "store", "v1", "shoot", {"query": "Polars  DataFrames", "k": 3}
+    )
+
+    assert key == QueryResultCache.key(
+        "./store", "v1", "shoot", {"k": 3, "query": "polars dataframes"}
+    )
+    assert key != QueryResultCache.key(
+        "store", "v2", "shoot", {"query": "polars dataframes", "k": 3}
+    )
+    assert key != QueryResultCache.key(
+        "store", "v1", "shoot", {"query": "polars dataframes", "k": 4}
+    )
+
+
+def test_result_cache_evicts_least_recently_used(cache):
+    for key in ["a", "b"]:
+        cache.put(key, [{"page_content": key, "metadata": {}}])
+    cache.get("a")
+    cache.put("c", [])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [{"page_content": "a", "metadata": {}}]
+    assert cache.get("c") == []
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+def test_answer_query_caches_per_store_version(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queries = []
+
+    def fake_query_server(command, payload, vectorstore_path):
+        queries.append(payload["query"])
+        return [server.ServedDocument(page_content=payload["query"], metadata={"k": 1})]
+
+    monkeypatch.setattr(server, "query_server", fake_query_server)
+    save_store_info("store", {"store_version": "v1"})
+
+    first = server.answer_query(
+        "shoot", {"query": "polars"}, "store", cache_results=True
+    )
+    second = server.answer_query(
+        "shoot", {"query": " Polars "}, "store", cache_results=True
+    )
+
+    assert queries == ["polars"]
+    assert second == first
+
+    save_store_info("store", {"store_version": "v2"})
+    server.answer_query("shoot", {"query": "polars"}, "store", cache_results=True)
+
+    assert queries == ["polars", "polars"]
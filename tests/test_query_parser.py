@@ -0,0 +1,304 @@
+import pytest
+from langchain.chains.query_constructor.ir import (
+    Comparator,
+    Comparison,
+    Operation,
+    Operator,
+    StructuredQuery,
+)
+from langchain.schema.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.runnables import RunnableLambda
+
+from starpilot.utils.numpy_store import NumpyVectorStore
+
+from starpilot.utils.query_cache import ParsedQueryCache
+from starpilot.utils.query_parser import (
+    construct_query,
+    filter_from_dict,
+    filter_to_dict,
+    parse_query,
+)
+from starpilot.utils.self_query import translate_query
+from starpilot.utils.server import QueryEngine
+from starpilot.utils.sync import save_store_info
+from starpilot.utils.vocabulary import (
+    build_vocabulary,
+    load_vocabulary,
+    save_vocabulary,
+)
+
+
+@pytest.fixture
+def vocabulary():
+    return build_vocabulary(
+        [
+            {
+                "primaryLanguage": "Python",
+                "languages": ["Python", "Jupyter Notebook"],
+                "topics": ["machine-learning", "dataframe"],
+            },
+            {"primaryLanguage": "R", "languages": ["R", "C++"], "topics": []},
+            {"primaryLanguage": "Go", "languages": ["Go"], "topics": ["cli"]},
+            {"primaryLanguage": None, "languages": ["Haskell"], "topics": []},
+        ]
+    )
+
+
+def language(name):
+    return Comparison(comparator=Comparator.EQ, attribute="primaryLanguage", value=name)
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (
+            "Python machine learning repos",
+            StructuredQuery(
+                query="machine learning", filter=language("Python"), limit=None
+            ),
+        ),
+        (
+            "Dataframe crates",
+            StructuredQuery(query="Dataframe", filter=language("Rust"), limit=None),
+        ),
+        (
+            "What R packages do time series analysis",
+            StructuredQuery(
+                query="time series analysis", filter=language("R"), limit=None
+            ),
+        ),
+        (
+            "dataframe packages with 1,000 stars or more",
+            StructuredQuery(
+                query="dataframe",
+                filter=Comparison(
+                    comparator=Comparator.GTE, attribute="stargazerCount", value=1000
+                ),
+                limit=None,
+            ),
+        ),
+        (
+            "cli tools in Go or Python with over 1.5k stars",
+            StructuredQuery(
+                query="cli",
+                filter=Operation(
+                    operator=Operator.AND,
+                    arguments=[
+                        Comparison(
+                            comparator=Comparator.GT,
+                            attribute="stargazerCount",
+                            value=1500,
+                        ),
+                        Operation(
+                            operator=Operator.OR,
+                            arguments=[language("Python"), language("Go")],
+                        ),
+                    ],
+                ),
+                limit=None,
+            ),
+        ),
+    ],
+)
+def test_parse_query(vocabulary, query, expected):
+    assert parse_query(query, vocabulary) == expected
+
+
+def not_language(name):
+    return Comparison(comparator=Comparator.NE, attribute="primaryLanguage", value=name)
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (
+            "python not Go",
+            Operation(
+                operator=Operator.AND,
+                arguments=[language("Python"), not_language("Go")],
+            ),
+        ),
+        ("dataframe repos without Go", not_language("Go")),
+        # a negation carries on through a list of languages
+        (
+            "machine learning not written in R or Go",
+            Operation(
+                operator=Operator.AND,
+                arguments=[not_language("Go"), not_language("R")],
+            ),
+        ),
+        (
+            "dataframe crates except Python, R",
+            Operation(
+                operator=Operator.AND,
+                arguments=[
+                    language("Rust"),
+                    not_language("Python"),
+                    not_language("R"),
+                ],
+            ),
+        ),
+    ],
+)
+def test_parse_query_excludes_negated_languages(vocabulary, query, expected):
+    assert parse_query(query, vocabulary).filter == expected
+
+
+def test_parse_query_leaves_other_negations_to_the_llm(vocabulary):
+    assert parse_query("cli tools not for windows", vocabulary) is None
+    assert (
+        parse_query("Python dataframe libraries with no dependencies", vocabulary)
+        is None
+    )
+
+
+def test_parse_query_leaves_unrecognised_queries(vocabulary):
+    # "go" and "r" are everyday words unless they are capitalised
+    assert (
+        parse_query("where do i go for a good static site generator", vocabulary)
+        is None
+    )
+
+
+def test_vocabulary_round_trip(vocabulary, tmp_path):
+    assert load_vocabulary(str(tmp_path)) == {"languages": [], "topics": []}
+
+    save_vocabulary(str(tmp_path), vocabulary)
+
+    assert load_vocabulary(str(tmp_path)) == vocabulary
+    assert vocabulary["languages"] == ["Go", "Python", "R"]
+
+
+def test_construct_query_memoises_the_llm(vocabulary, tmp_path):
+    structured_query = StructuredQuery(
+        query="static site",
+        filter=Operation(
+            operator=Operator.OR,
+            arguments=[
+                language("Haskell"),
+                Comparison(
+                    comparator=Comparator.LT, attribute="stargazerCount", value=10
+                ),
+            ],
+        ),
+        limit=None,
+    )
+    calls = []
+
+    def create_query_constructor():
+        calls.append(1)
+        return RunnableLambda(lambda _: structured_query)
+
+    cache = ParsedQueryCache(str(tmp_path / "parsed.sqlite3"))
+
+    first = construct_query(
+        "a static site generator", vocabulary, create_query_constructor, "m", cache
+    )
+    second = construct_query(
+        "A  static site generator ", vocabulary, create_query_constructor, "m", cache
+    )
+    rules = construct_query(
+        "Python dataframe", vocabulary, create_query_constructor, "m", cache
+    )
+
+    assert first == (structured_query, "llm")
+    assert second == (structured_query, "cache")
+    assert rules[1] == "rules"
+    assert len(calls) == 1
+
+
+def test_filter_dict_round_trip():
+    filter = Operation(
+        operator=Operator.AND,
+        arguments=[language("R"), language("Python")],
+    )
+
+    assert filter_from_dict(filter_to_dict(filter)) == filter
+    assert filter_from_dict(filter_to_dict(None)) is None
+
+
+def test_translate_query():
+    assert translate_query(
+        StructuredQuery(query="web", filter=language("R"), limit=None)
+    ) == ("web", {"primaryLanguage": {"$eq": "R"}})
+
+
+def test_translate_query_drops_clauses_the_store_cant_evaluate():
+    contains = Comparison(
+        comparator=Comparator.CONTAIN, attribute="description", value="parser"
+    )
+    stars = Comparison(comparator=Comparator.GTE, attribute="stargazerCount", value=10)
+
+    assert translate_query(
+        StructuredQuery(
+            query="web",
+            filter=Operation(
+                operator=Operator.AND, arguments=[language("R"), contains, stars]
+            ),
+            limit=None,
+        )
+    ) == (
+        "web",
+        {
+            "$and": [
+                {"primaryLanguage": {"$eq": "R"}},
+                {"stargazerCount": {"$gte": 10}},
+            ]
+        },
+    )
+    # dropping one side of an `or` would narrow it, so the whole `or` is dropped
+    assert translate_query(
+        StructuredQuery(
+            query="web",
+            filter=Operation(
+                operator=Operator.AND,
+                arguments=[
+                    Operation(
+                        operator=Operator.OR, arguments=[language("R"), contains]
+                    ),
+                    stars,
+                ],
+            ),
+            limit=None,
+        )
+    ) == ("web", {"stargazerCount": {"$gte": 10}})
+    assert translate_query(
+        StructuredQuery(
+            query="web",
+            filter=Operation(operator=Operator.NOT, arguments=[language("R")]),
+            limit=None,
+        )
+    ) == ("web", None)
+
+
+def test_astrologer_without_the_llm(vocabulary, tmp_path):
+    path = str(tmp_path / "store")
+    embeddings = DeterministicFakeEmbedding(size=16)
+    documents = [
+        Document(
+            page_content="dataframe library",
+            metadata={
+                "nameWithOwner": f"owner/{name}",
+                "primaryLanguage": primary_language,
+                "stargazerCount": 10,
+            },
+        )
+        for name, primary_language in [("pandas", "Python"), ("dplyr", "R")]
+    ]
+    NumpyVectorStore(path, embeddings).add_documents(
+        documents, ids=[document.metadata["nameWithOwner"] for document in documents]
+    )
+    save_store_info(path, {"store_backend": "numpy"})
+    save_vocabulary(path, vocabulary)
+
+    engine = QueryEngine(path)
+    engine.vectorstore._embedding_function = embeddings
+    engine._parsed_query_cache = ParsedQueryCache(str(tmp_path / "parsed.sqlite3"))
+
+    results = engine.astrologer("R dataframe packages", k=2)
+
+    assert [document.metadata["nameWithOwner"] for document in results] == [
+        "owner/dplyr"
+    ]
+    assert engine._query_constructor is None
@@ -0,0 +1,192 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from langchain.schema.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores.utils import filter_complex_metadata
+
+from starpilot.utils.cache import CachedEmbeddings, EmbeddingCache
+from starpilot.utils.compact import build_compact_index
+from starpilot.utils.lexical import LexicalIndex
+from starpilot.utils.server import (
+    QueryEngine,
+    answer_batch,
+    create_request_handler,
+    query_server,
+)
+from starpilot.utils.sync import save_store_info, save_users, user_flag
+from starpilot.utils.utils import (
+    Quantisations,
+    StoreBackends,
+    create_document,
+    create_vectorstore,
+)
+
+
+class FakeEngine:
+    """
+    Stands in for a QueryEngine without loading a vectorstore
+    """
+
+    def __init__(self, vectorstore_path: str):
+        self.vectorstore_path = vectorstore_path
+
+    def shoot(self, query: str, method: str = "similarity", k: int = 3):
+        return [
+            Document(page_content=f"{query} {number}", metadata={"method": method})
+            for number in range(k)
+        ]
+
+    def astrologer(self, query: str, k: int = 3):
+        raise ValueError("no LLM in tests")
+
+
+@pytest.fixture
+def server_url(tmp_path):
+    httpd = HTTPServer(
+        ("127.0.0.1", 0), create_request_handler(FakeEngine(str(tmp_path)))
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_query_server(server_url, tmp_path):
+    results = query_server(
+        "shoot",
+        {"query": "dataframes", "method": "mmr", "k": 2},
+        str(tmp_path),
+        server_url=server_url,
+    )
+
+    assert [document.page_content for document in results] == [
+        "dataframes 0",
+        "dataframes 1",
+    ]
+    assert results[0].metadata == {"method": "mmr"}
+
+
+def test_query_server_for_another_store(server_url, tmp_path):
+    assert (
+        query_server(
+            "shoot", {"query": "dataframes"}, str(tmp_path / "other"), server_url
+        )
+        is None
+    )
+
+
+def test_query_server_reports_errors(server_url, tmp_path):
+    with pytest.raises(Exception, match="no LLM in tests"):
+        query_server("astrologer", {"query": "dataframes"}, str(tmp_path), server_url)
+
+
+@pytest.mark.parametrize("status", [200, 404, 500])
+def test_query_server_when_something_else_is_listening(tmp_path, status):
+    class HTMLHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            if status == 200:
+                body = b"<html>Hello</html>"
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(status)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), HTMLHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert (
+            query_server(
+                "shoot",
+                {"query": "dataframes"},
+                str(tmp_path),
+                server_url=f"http://127.0.0.1:{httpd.server_port}",
+            )
+            is None
+        )
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_query_server_not_running(tmp_path):
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+
+    assert (
+        query_server(
+            "shoot",
+            {"query": "dataframes"},
+            str(tmp_path),
+            server_url=f"http://127.0.0.1:{port}",
+        )
+        is None
+    )
+
+
+WORDS = "python rust data frames testing web async cli parser plot".split()
+
+
+@pytest.mark.parametrize(
+    "store_backend, quantisation",
+    [
+        (StoreBackends.numpy, None),
+        (StoreBackends.chroma, None),
+        (StoreBackends.numpy, Quantisations.int8),
+    ],
+)
+def test_shoot_batch_matches_shoot(tmp_path, store_backend, quantisation):
+    path = str(tmp_path / "store")
+    embeddings = DeterministicFakeEmbedding(size=16)
+    repos = [
+        {
+            "name": f"repo-{number}",
+            "nameWithOwner": f"owner/repo-{number}",
+            "stargazerCount": number,
+            "content": " ".join(
+                [f"repo-{number}", *WORDS[number % 7 : number % 7 + 3]]
+            ),
+        }
+        for number in range(30)
+    ]
+    documents = filter_complex_metadata([create_document(repo) for repo in repos])
+    for document in documents:
+        document.metadata[user_flag("alice")] = document.metadata["stargazerCount"] < 20
+
+    vectorstore = create_vectorstore(path, store_backend, embeddings)
+    vectorstore.add_documents(documents, ids=[repo["nameWithOwner"] for repo in repos])
+    save_store_info(path, {"store_backend": store_backend.value})
+    save_users(path, {"alice": [repo["nameWithOwner"] for repo in repos[:20]]})
+    LexicalIndex.build(repos).save(path)
+    if quantisation is not None:
+        build_compact_index(vectorstore, quantisation).save(path)
+
+    engine = QueryEngine(path)
+    engine.vectorstore._embedding_function = CachedEmbeddings(
+        embeddings, model="fake", cache=EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    )
+    queries = ["rust data", "web async cli", "parser", "rust data"]
+
+    for method in ["similarity", "hybrid", "lexical", "mmr"]:
+        for options in [{}, {"user": "alice", "rerank": 10}]:
+            batch = engine.shoot_batch(queries, method=method, k=4, **options)
+
+            assert batch == [
+                engine.shoot(query, method=method, k=4, **options) for query in queries
+            ]
+            assert all(batch)
+
+    records = answer_batch(queries[:2], {"k": 2, "method": "lexical"}, path)
+
+    assert [record["query"] for record in records] == queries[:2]
+    assert [len(record["documents"]) for record in records] == [2, 2]
@@ -0,0 +1,120 @@
+import json
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+import pytest
+
+# modules that take most of a second or more each to import
+HEAVY_PACKAGES = {
+    "aiohttp",
+    "chromadb",
+    "gql",
+    "graphql_query",
+    "langchain",
+    "langchain_community",
+    "langchain_core",
+    "langchain_openai",
+    "numpy",
+    "openai",
+    "tiktoken",
+}
+
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def import_profile(module: str) -> Tuple[Dict[str, int], int]:
+    """
+    Import a module in a fresh interpreter with `-X importtime`
+
+    Returns the cumulative import time in microseconds of every module it loaded, and of the module itself
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative_us, name = line.split("|")
+        cumulative[name.strip()] = int(cumulative_us)
+
+    return cumulative, cumulative[module]
+
+
+@pytest.mark.parametrize("module", ["starpilot.main", "starpilot.utils.server"])
+def test_cli_startup_skips_heavy_dependencies(module):
+    cumulative, _ = import_profile(module)
+
+    loaded = {name.split(".")[0] for name in cumulative}
+
+    assert loaded & HEAVY_PACKAGES == set()
+
+
+def test_cli_startup_within_budget():
+    _, total_us = import_profile("starpilot.main")
+
+    assert total_us / 1e6 < IMPORT_BUDGET_SECONDS
+
+
+QUERY_SCRIPT = """
+import json
+import sys
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+import starpilot.utils.utils as utils
+from starpilot.utils.server import QueryEngine
+
+utils.create_embedding_function = lambda **_: DeterministicFakeEmbedding(size=16)
+engine = QueryEngine(sys.argv[1])
+
+loaded = {}
+engine.shoot("dataframes")
+loaded["shoot"] = sorted(sys.modules)
+engine.astrologer("Python dataframes")
+loaded["astrologer"] = sorted(sys.modules)
+print(json.dumps(loaded))
+"""
+
+
+def test_queries_only_load_what_they_need(tmp_path):
+    from langchain.schema.document import Document
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+
+    from starpilot.utils.numpy_store import NumpyVectorStore
+    from starpilot.utils.sync import save_store_info
+    from starpilot.utils.vocabulary import build_vocabulary, save_vocabulary
+
+    path = str(tmp_path)
+    repos = [{"nameWithOwner": "owner/pandas", "primaryLanguage": "Python"}]
+    NumpyVectorStore(path, DeterministicFakeEmbedding(size=16)).add_documents(
+        [Document(page_content="dataframes", metadata=repos[0])],
+        ids=["owner/pandas"],
+    )
+    save_store_info(path, {"store_backend": "numpy"})
+    save_vocabulary(path, build_vocabulary(repos))
+
+    result = subprocess.run(
+        [sys.executable, "-c", QUERY_SCRIPT, path],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = json.loads(result.stdout.splitlines()[-1])
+
+    def _packages(modules):
+        return {name.split(".")[0] for name in modules} | {
+            name for name in modules if "query_constructor" in name
+        }
+
+    # shoot never parses a query, and a query the rules parse never calls the LLM
+    assert {"lark", "langchain.chains.query_constructor"}.isdisjoint(
+        _packages(loaded["shoot"])
+    )
+    assert {"langchain_openai", "openai"}.isdisjoint(_packages(loaded["astrologer"]))
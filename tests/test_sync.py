@@ -0,0 +1,220 @@
+import pytest
+from langchain.schema.document import Document
+from langchain_community.vectorstores import Chroma
+
+from helpers import CountingEmbeddings, make_repo
+from starpilot.utils.sync import (
+    diff_manifest,
+    hash_document,
+    load_manifest,
+    save_manifest,
+    stream_into_vectorstore,
+    user_flag,
+)
+from starpilot.utils.utils import load_stored_repos
+
+
+def make_document(name: str, content: str, stars: int) -> Document:
+    return Document(
+        page_content=content,
+        metadata={
+            "name": name,
+            "nameWithOwner": f"owner/{name}",
+            "stargazerCount": stars,
+        },
+    )
+
+
+@pytest.fixture
+def documents():
+    return [
+        make_document("pytest", "pytest testing python", 10),
+        make_document("polars", "polars dataframes rust", 20),
+        make_document("tibble", "tibble data frame r", 30),
+    ]
+
+
+def test_diff_manifest(documents):
+    manifest = {
+        "owner/pytest": {"content": "stale", "metadata": "stale"},
+        "owner/polars": hash_document(documents[1]),
+        "owner/gone": {"content": "gone", "metadata": "gone"},
+    }
+    changed_metadata = make_document("polars", "polars dataframes rust", 21)
+
+    diff = diff_manifest(manifest, [documents[0], changed_metadata, documents[2]])
+
+    assert [d.metadata["name"] for d in diff.added] == ["tibble"]
+    assert [d.metadata["name"] for d in diff.updated_content] == ["pytest"]
+    assert [d.metadata["name"] for d in diff.updated_metadata] == ["polars"]
+    assert diff.deleted == ["owner/gone"]
+
+
+def test_stream_into_vectorstore_only_embeds_changes(tmp_path):
+    embeddings = CountingEmbeddings(size=8, embedded=[])
+    vectorstore = Chroma(persist_directory=str(tmp_path), embedding_function=embeddings)
+    repos = [
+        make_repo("pytest", 10, "testing python"),
+        make_repo("polars", 20, "dataframes rust"),
+        make_repo("tibble", 30, "data frame r"),
+    ]
+
+    manifest, _ = stream_into_vectorstore(vectorstore, iter([repos]), {}, k=None)
+    save_manifest(str(tmp_path), manifest)
+    assert len(embeddings.embedded) == 3
+
+    embeddings.embedded.clear()
+    fresh = [
+        make_repo("pytest", 11, "testing python"),
+        make_repo("polars", 20, "blazingly fast dataframes rust"),
+    ]
+    manifest, _ = stream_into_vectorstore(
+        vectorstore, iter([fresh]), load_manifest(str(tmp_path)), k=None
+    )
+
+    assert embeddings.embedded == ["polars blazingly fast dataframes rust"]
+    assert set(manifest.keys()) == {"owner/pytest", "owner/polars"}
+
+    stored = vectorstore.get()
+    assert sorted(stored["ids"]) == ["owner/polars", "owner/pytest"]
+    stars = {
+        metadata["name"]: metadata["stargazerCount"] for metadata in stored["metadatas"]
+    }
+    assert stars == {"pytest": 11, "polars": 20}
+
+
+def test_load_manifest_missing(tmp_path):
+    assert load_manifest(str(tmp_path)) is None
+
+
+def test_stream_into_vectorstore_keeps_top_k(tmp_path):
+    embeddings = CountingEmbeddings(size=8, embedded=[])
+    vectorstore = Chroma(persist_directory=str(tmp_path), embedding_function=embeddings)
+    pages = [
+        [make_repo("small", 1), make_repo("medium", 50)],
+        [make_repo("large", 100), make_repo("tiny", 0)],
+    ]
+    batches = []
+
+    manifest, kept = stream_into_vectorstore(
+        vectorstore,
+        iter(pages),
+        manifest={},
+        k=2,
+        batch_size=1,
+        on_batch=lambda stored: batches.append(sorted(stored)),
+    )
+
+    assert [repo["name"] for repo in kept] == ["large", "medium"]
+    assert sorted(manifest) == ["owner/large", "owner/medium"]
+    assert sorted(vectorstore.get()["ids"]) == ["owner/large", "owner/medium"]
+    # the first page was written before the second was read
+    assert batches[0] == ["owner/medium", "owner/small"]
+
+    embeddings.embedded.clear()
+    pages = [[make_repo("large", 101), make_repo("medium", 50, "now described")]]
+    manifest, _ = stream_into_vectorstore(vectorstore, iter(pages), manifest, k=2)
+
+    assert embeddings.embedded == ["medium now described"]
+
+
+def test_stream_into_vectorstore_shares_repos_between_users(tmp_path):
+    embeddings = CountingEmbeddings(size=8, embedded=[])
+    vectorstore = Chroma(persist_directory=str(tmp_path), embedding_function=embeddings)
+
+    manifest, alice = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("shared", 10), make_repo("alices", 5)]]),
+        manifest={},
+        k=None,
+        user="Alice",
+    )
+    users = {"alice": [repo["nameWithOwner"] for repo in alice]}
+
+    embeddings.embedded.clear()
+    manifest, bob = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("shared", 10), make_repo("bobs", 7)]]),
+        manifest=manifest,
+        k=None,
+        user="bob",
+        other_users=users,
+    )
+    users["bob"] = [repo["nameWithOwner"] for repo in bob]
+
+    # the repo both users starred is flagged for both, but only embedded once
+    assert embeddings.embedded == ["bobs"]
+    assert sorted(manifest) == ["owner/alices", "owner/bobs", "owner/shared"]
+    assert sorted(vectorstore.get(where={user_flag("bob"): True})["ids"]) == [
+        "owner/bobs",
+        "owner/shared",
+    ]
+
+    # alice unstarring the shared repo unflags it rather than deleting it from under bob
+    manifest, alice = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("alices", 5)]]),
+        manifest=manifest,
+        k=None,
+        user="alice",
+        other_users={"bob": users["bob"]},
+    )
+
+    assert sorted(vectorstore.get()["ids"]) == [
+        "owner/alices",
+        "owner/bobs",
+        "owner/shared",
+    ]
+    assert vectorstore.get(where={user_flag("alice"): True})["ids"] == ["owner/alices"]
+
+    # reading bob again only embeds what changed
+    embeddings.embedded.clear()
+    manifest, _ = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("shared", 10), make_repo("bobs", 7, "now described")]]),
+        manifest=manifest,
+        k=None,
+        user="bob",
+        other_users={"alice": [repo["nameWithOwner"] for repo in alice]},
+    )
+
+    assert embeddings.embedded == ["bobs now described"]
+    assert sorted(manifest) == ["owner/alices", "owner/bobs", "owner/shared"]
+
+
+def test_stream_into_vectorstore_carries_over_repos_already_read(tmp_path):
+    embeddings = CountingEmbeddings(size=8, embedded=[])
+    vectorstore = Chroma(persist_directory=str(tmp_path), embedding_function=embeddings)
+
+    manifest, _ = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("medium", 50), make_repo("small", 1)]]),
+        manifest={},
+        k=2,
+        user="alice",
+    )
+    medium = manifest["owner/medium"]
+
+    def carry_over():
+        return [
+            repo
+            for repo in load_stored_repos(vectorstore)
+            if repo.get(user_flag("alice"))
+        ]
+
+    # only the star made since the last read is fetched
+    embeddings.embedded.clear()
+    manifest, kept = stream_into_vectorstore(
+        vectorstore,
+        iter([[make_repo("large", 100)]]),
+        manifest=manifest,
+        k=2,
+        user="alice",
+        carry_over=carry_over,
+    )
+
+    assert [repo["name"] for repo in kept] == ["large", "medium"]
+    assert embeddings.embedded == ["large"]
+    # the carried repo is unchanged, and the one pushed out of the top k is deleted
+    assert manifest["owner/medium"] == medium
+    assert sorted(vectorstore.get()["ids"]) == ["owner/large", "owner/medium"]
@@ -0,0 +1,43 @@
+from typing import List
+
+import pytest
+
+import starpilot.utils.tokens as tokens
+from starpilot.utils.tokens import TokenCounter
+
+
+class WhitespaceEncoding:
+    """
+    A stand in for a tiktoken encoding that splits on whitespace and records what it encoded
+    """
+
+    name = "whitespace"
+
+    def __init__(self):
+        self.encoded: List[str] = []
+
+    def encode_ordinary_batch(self, texts: List[str], num_threads: int = 8):
+        self.encoded.extend(texts)
+        return [text.split() for text in texts]
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    encoding = WhitespaceEncoding()
+    monkeypatch.setattr(tokens, "get_encoding", lambda model: encoding)
+    return encoding
+
+
+def test_token_counter_caches_counts_across_runs(tmp_path, encoding):
+    cache_path = str(tmp_path / "tokens.sqlite3")
+
+    counter = TokenCounter(model="text-embedding-3-large", cache_path=cache_path)
+    assert counter.count(["pytest testing", "polars", "pytest testing"]) == [2, 1, 2]
+    assert encoding.encoded == ["pytest testing", "polars"]
+
+    counter = TokenCounter(model="text-embedding-3-large", cache_path=cache_path)
+    assert counter.count(["polars", "tibble data frame"]) == [1, 3]
+    assert encoding.encoded == ["pytest testing", "polars", "tibble data frame"]
+
+    assert counter.total_tokens == 4
+    assert counter.cost(1_000_000) == pytest.approx(0.13)
@@ -1,7 +1,19 @@
+import json
+import os
+
 import pytest
 from langchain.schema.document import Document
 
-from starpilot.utils.utils import format_repo, prepare_documents
+from starpilot.utils.sync import save_store_info
+from starpilot.utils.utils import (
+    EmbeddingBackends,
+    TopKRepos,
+    check_embedding_backend,
+    format_repo,
+    load_repo_contents_from_disk,
+    prepare_documents,
+    save_repo_contents_to_disk,
+)
 
 
 @pytest.fixture(scope="session")
@@ -223,8 +235,17 @@ def test_format_repo(request, repo_fixture, expectation_fixture):
         assert value != ""
 
 
-def test_prepare_document():
-    result = prepare_documents("./tests/test_data/")
+@pytest.fixture
+def test_data_repos():
+    repos = []
+    for file in sorted(os.listdir("./tests/test_data/")):
+        with open(os.path.join("./tests/test_data/", file)) as test_data:
+            repos.append(json.load(test_data))
+    return repos
+
+
+def test_prepare_document(test_data_repos):
+    result = prepare_documents(test_data_repos)
 
     assert len(result) == 3
 
@@ -275,3 +296,59 @@ def test_prepare_document():
                 == "🔎 search your github issues interactively "
             )
             assert document.metadata["languages"] == "Go"
+
+
+def test_top_k_repos_keeps_most_starred():
+    top_k = TopKRepos(k=2)
+
+    evicted = [
+        top_k.push({"nameWithOwner": name, "stargazerCount": stars})
+        for name, stars in [("a/a", 5), ("b/b", 1), ("c/c", 10), ("d/d", 0)]
+    ]
+
+    assert [repo and repo["nameWithOwner"] for repo in evicted] == [
+        None,
+        None,
+        "b/b",
+        "d/d",
+    ]
+    assert [repo["nameWithOwner"] for repo in top_k.sorted()] == ["c/c", "a/a"]
+
+
+def test_repo_contents_round_trip(tmp_path, test_data_repos):
+    repo_contents_path = str(tmp_path / "repo_content.jsonl")
+
+    save_repo_contents_to_disk(test_data_repos[:2], repo_contents_path)
+    save_repo_contents_to_disk(test_data_repos[2:], repo_contents_path, append=True)
+
+    assert list(load_repo_contents_from_disk(repo_contents_path)) == test_data_repos
+
+
+def test_check_embedding_backend(tmp_path):
+    # stores built before the backend was recorded were embedded with OpenAI
+    assert check_embedding_backend(str(tmp_path)) is EmbeddingBackends.openai
+
+    save_store_info(str(tmp_path), {"embedding_backend": "local"})
+
+    assert check_embedding_backend(str(tmp_path)) is EmbeddingBackends.local
+    assert (
+        check_embedding_backend(str(tmp_path), EmbeddingBackends.local)
+        is EmbeddingBackends.local
+    )
+    with pytest.raises(Exception, match="embedded with the local backend"):
+        check_embedding_backend(str(tmp_path), EmbeddingBackends.openai)
+
+
+def test_prepare_documents_counts_tokens_with_a_counter(test_data_repos):
+    class RecordingCounter:
+        def __init__(self):
+            self.counted = []
+
+        def count(self, texts):
+            self.counted.extend(texts)
+            return [1] * len(texts)
+
+    counter = RecordingCounter()
+    documents = prepare_documents(test_data_repos, token_counter=counter)
+
+    assert counter.counted == [document.page_content for document in documents]